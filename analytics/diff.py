@@ -0,0 +1,244 @@
+"""Month over month price diff between two reference table snapshots.
+
+Both snapshots are keyed by (model, model year) packed into a single int64
+(`model * 1_000_000 + year * 10 + fuel type`), so aligning them is one
+`np.intersect1d` instead of a self-join of `preco` on text columns. Added, removed
+and changed model years and their percent changes then come out of a few array
+operations.
+
+    diff = diff_snapshots(previous_snapshot, snapshot)
+    diff.summary()
+    save_diff(db_session, diff)  # rows of `preco_variacao`
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+from sqlalchemy import Connection, delete, insert
+from sqlalchemy.orm import Session
+
+from analytics.snapshot import SnapshotIndex
+from db import readers as db_readers
+from db.models.all_models import CarPriceChange
+
+ADDED = 1
+REMOVED = 2
+CHANGED = 3
+
+
+def model_year_keys(snapshot: SnapshotIndex) -> np.ndarray:
+    """One int64 key per price of `snapshot`, unique per (model, model year)."""
+    columns = snapshot.columns
+    return (
+        columns["model_id"].astype(np.int64) * 1_000_000
+        + columns["year"].astype(np.int64) * 10
+        + columns["fuel_type"].astype(np.int64)
+    )
+
+
+@dataclass
+class SnapshotDiff:
+    """Differences between `previous` and `current`.
+
+    `added` are positions in `current`, `removed` positions in `previous`, and
+    `changed_previous` / `changed_current` the aligned positions of the changed
+    prices in each snapshot, with their `change_percent`.
+    """
+
+    previous: SnapshotIndex
+    current: SnapshotIndex
+    added: np.ndarray
+    removed: np.ndarray
+    changed_previous: np.ndarray
+    changed_current: np.ndarray
+    change_percent: np.ndarray
+    unchanged: int
+
+    def summary(self) -> dict:
+        _finite = self.change_percent[np.isfinite(self.change_percent)]
+        return {
+            "previous_reference_table_id": self.previous.reference_table_id,
+            "reference_table_id": self.current.reference_table_id,
+            "added": len(self.added),
+            "removed": len(self.removed),
+            "changed": len(self.changed_current),
+            "unchanged": self.unchanged,
+            "mean_change_percent": float(_finite.mean()) if len(_finite) else None,
+            "median_change_percent": (
+                float(np.median(_finite)) if len(_finite) else None
+            ),
+        }
+
+    def records(self) -> list[dict]:
+        """`CarPriceChange` rows, by attribute name."""
+        _base = {
+            "reference_table_id": self.current.reference_table_id,
+            "previous_reference_table_id": self.previous.reference_table_id,
+        }
+        previous_columns = self.previous.columns
+        current_columns = self.current.columns
+
+        records = [
+            dict(
+                _base,
+                model_id=model_id,
+                model_year_id=model_year_id,
+                change_type=ADDED,
+                previous_value=None,
+                value=value,
+                change_percent=None,
+            )
+            for model_id, model_year_id, value in zip(
+                current_columns["model_id"][self.added].tolist(),
+                current_columns["model_year_id"][self.added].tolist(),
+                current_columns["value"][self.added].tolist(),
+            )
+        ]
+        records.extend(
+            dict(
+                _base,
+                model_id=model_id,
+                model_year_id=model_year_id,
+                change_type=REMOVED,
+                previous_value=previous_value,
+                value=None,
+                change_percent=None,
+            )
+            for model_id, model_year_id, previous_value in zip(
+                previous_columns["model_id"][self.removed].tolist(),
+                previous_columns["model_year_id"][self.removed].tolist(),
+                previous_columns["value"][self.removed].tolist(),
+            )
+        )
+        records.extend(
+            dict(
+                _base,
+                model_id=model_id,
+                model_year_id=model_year_id,
+                change_type=CHANGED,
+                previous_value=previous_value,
+                value=value,
+                change_percent=None if np.isnan(change_percent) else change_percent,
+            )
+            for model_id, model_year_id, previous_value, value, change_percent in zip(
+                current_columns["model_id"][self.changed_current].tolist(),
+                current_columns["model_year_id"][self.changed_current].tolist(),
+                previous_columns["value"][self.changed_previous].tolist(),
+                current_columns["value"][self.changed_current].tolist(),
+                self.change_percent.tolist(),
+            )
+        )
+        return records
+
+
+def _unique_keys(snapshot: SnapshotIndex) -> tuple[np.ndarray, np.ndarray]:
+    """Sorted model year keys of `snapshot` and the position of each one's price."""
+    keys, positions, counts = np.unique(
+        model_year_keys(snapshot), return_index=True, return_counts=True
+    )
+    duplicated = counts > 1
+    if duplicated.any():
+        raise ValueError(
+            f"Reference table {snapshot.reference_table_id} has "
+            f"{int(duplicated.sum())} model years with more than one price, ex. "
+            f"{snapshot.columns['model_id'][positions[duplicated][0]]} "
+            f"{snapshot.columns['model_year_id'][positions[duplicated][0]]}"
+        )
+
+    return keys, positions
+
+
+def diff_snapshots(
+    previous: SnapshotIndex, current: SnapshotIndex, tolerance: float = 0.0
+) -> SnapshotDiff:
+    """Model years added, removed and changed (by more than `tolerance`) from
+    `previous` to `current`.
+
+    Raises:
+        - ValueError: A snapshot has more than one price for a model year.
+    """
+    previous_keys, previous_positions = _unique_keys(previous)
+    current_keys, current_positions = _unique_keys(current)
+
+    _, previous_common, current_common = np.intersect1d(
+        previous_keys, current_keys, assume_unique=True, return_indices=True
+    )
+
+    in_current = np.zeros(len(previous_keys), dtype=bool)
+    in_current[previous_common] = True
+    in_previous = np.zeros(len(current_keys), dtype=bool)
+    in_previous[current_common] = True
+
+    aligned_previous = previous_positions[previous_common]
+    aligned_current = current_positions[current_common]
+    old = previous.values[aligned_previous]
+    new = current.values[aligned_current]
+
+    delta = new - old
+    is_changed = np.abs(delta) > tolerance
+    change_percent = np.divide(
+        delta[is_changed] * 100,
+        old[is_changed],
+        out=np.full(int(is_changed.sum()), np.nan),
+        where=old[is_changed] != 0,
+    )
+
+    return SnapshotDiff(
+        previous=previous,
+        current=current,
+        added=current_positions[~in_previous],
+        removed=previous_positions[~in_current],
+        changed_previous=aligned_previous[is_changed],
+        changed_current=aligned_current[is_changed],
+        change_percent=change_percent,
+        unchanged=int((~is_changed).sum()),
+    )
+
+
+def previous_reference_table_id(
+    db_conn: Connection | Session, reference_table_id: str
+) -> str | None:
+    """The reference table right before `reference_table_id`, chronologically.
+
+    Raises:
+        - KeyError: `reference_table_id` does not exist.
+    """
+    reference_table_ids = [
+        reference_table.fipe_id
+        for reference_table in db_readers.read_reference_tables(db_conn)
+    ]
+    if reference_table_id not in reference_table_ids:
+        raise KeyError(f"Unknown reference table {reference_table_id}")
+
+    position = reference_table_ids.index(reference_table_id)
+    return reference_table_ids[position - 1] if position else None
+
+
+def save_diff(db_session: Session, diff: SnapshotDiff, chunk_size: int = 10_000) -> int:
+    """Replace the `preco_variacao` rows of the diff reference tables. Does not
+    commit. Returns the number of rows written."""
+    db_session.execute(
+        delete(CarPriceChange).where(
+            CarPriceChange.reference_table_id == diff.current.reference_table_id,
+            CarPriceChange.previous_reference_table_id
+            == diff.previous.reference_table_id,
+        )
+    )
+
+    records = diff.records()
+    for start in range(0, len(records), chunk_size):
+        db_session.execute(insert(CarPriceChange), records[start : start + chunk_size])
+
+    return len(records)
+
+
+__all__ = [
+    "ADDED",
+    "CHANGED",
+    "REMOVED",
+    "SnapshotDiff",
+    "diff_snapshots",
+    "model_year_keys",
+    "previous_reference_table_id",
+    "save_diff",
+]
@@ -0,0 +1,401 @@
+"""Memory-mapped price matrix: one row per model year, one column per month.
+
+Values are stored as a dense float32 matrix (NaN where there is no price) in a `.npy`
+file that any process opens memory-mapped. Rows are contiguous, so the whole price
+history of a model year is a zero-copy slice of the file and costs one lookup in the
+key index:
+
+    matrix = PriceMatrix.load("cache/matrix")
+    matrix.history(model_year_key)      # float32 view, one value per month
+    matrix.months                       # month ordinals of the columns
+    matrix.histories([key, key, ...])   # 2-D copy, one row per key
+
+Rows are keyed by `ano_modelo.id` (`model_year_key`), kept in `keys.npy`. Columns are
+the months with prices, in chronological order, described by `months.npy` (month
+ordinals, int32) and `reference_table_ids.npy`. The file has room for
+`SPARE_ROWS` more model years and `SPARE_COLUMNS` more months than it holds. A new
+month is written in place, and the file is only reallocated when that room runs out.
+
+float32 has a 24-bit significand: prices up to R$ 131.072 are stored within half a
+centavo, and the step between stored values only reaches a whole real at
+R$ 8.388.608. That is plenty for series analytics; use `preco` when cents must be
+exact.
+
+`update_matrix` adds the months that landed since the last update, and rewrites the
+latest one in case it was still being crawled. It also reads archived months and the
+validity ranges of `preco_intervalo` (`--storage changes`); a model year with a price
+in both keeps the one in `preco`. A month older than the last column, ex. from a
+backfill, triggers a full rebuild.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from db import archive as db_archive
+from db import readers as db_readers
+from db.intervals import month_ordinal
+from db.models.all_models import CarPrice, CarPriceInterval, ReferenceTable
+
+logger = logging.getLogger(__name__)
+
+MATRIX_DIR = "cache/matrix"
+FORMAT_VERSION = 1
+
+# Room left for model years and months that have not landed yet
+SPARE_ROWS = 4096
+SPARE_COLUMNS = 24
+
+_PRICES_PER_MONTH_STMT = select(CarPrice.reference_table_id, func.count()).group_by(
+    CarPrice.reference_table_id
+)
+
+_REFERENCE_TABLE_ORDINAL = ReferenceTable.year * 12 + ReferenceTable.month - 1
+
+# Months covered by a validity range, as the `preco_mensal` view expands them
+_INTERVALS_PER_MONTH_STMT = (
+    select(ReferenceTable.fipe_id, func.count())
+    .join(
+        CarPriceInterval,
+        _REFERENCE_TABLE_ORDINAL.between(
+            CarPriceInterval.valid_from, CarPriceInterval.valid_to
+        ),
+    )
+    .group_by(ReferenceTable.fipe_id)
+)
+
+
+class PriceMatrix:
+    """Dense model year x month price matrix, see the module docstring.
+
+    Only the first `rows` rows and `columns` columns of `values` are in use; the rest
+    is spare capacity, NaN.
+
+    Args:
+        - directory (str): Where the matrix files are.
+        - values (np.ndarray): float32 matrix, usually memory-mapped.
+        - keys (np.ndarray): int32 model year key of each row.
+        - months (np.ndarray): int32 month ordinal of each column.
+        - reference_table_ids (np.ndarray): Reference table of each column.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        values: np.ndarray,
+        keys: np.ndarray,
+        months: np.ndarray,
+        reference_table_ids: np.ndarray,
+    ) -> None:
+        self.directory = directory
+        self._values = values
+        self.keys = keys
+        self.months = months
+        self.reference_table_ids = reference_table_ids
+
+        # Rows are appended in arrival order, lookups go through the sorted keys
+        self._key_order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[self._key_order]
+
+    @property
+    def rows(self) -> int:
+        return len(self.keys)
+
+    @property
+    def columns(self) -> int:
+        return len(self.months)
+
+    @property
+    def values(self) -> np.ndarray:
+        """The used part of the matrix, a view."""
+        return self._values[: self.rows, : self.columns]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @classmethod
+    def create(
+        cls,
+        directory: str,
+        row_capacity: int = SPARE_ROWS,
+        column_capacity: int = SPARE_COLUMNS,
+    ) -> "PriceMatrix":
+        """An empty matrix, replacing any in `directory`."""
+        os.makedirs(directory, exist_ok=True)
+        matrix = cls(
+            directory,
+            np.full((row_capacity, column_capacity), np.nan, dtype=np.float32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype="U10"),
+        )
+        matrix._write_values(matrix._values)
+        matrix._values = np.load(matrix._path("values.npy"), mmap_mode="r+")
+        matrix._save_index()
+        return matrix
+
+    @classmethod
+    def load(cls, directory: str, writable: bool = False) -> "PriceMatrix":
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported matrix format {meta['format_version']}")
+
+        def _load(name: str) -> np.ndarray:
+            return np.load(os.path.join(directory, name))
+
+        rows, columns = meta["rows"], meta["columns"]
+        return cls(
+            directory,
+            np.load(
+                os.path.join(directory, "values.npy"),
+                mmap_mode="r+" if writable else "r",
+            ),
+            _load("keys.npy")[:rows],
+            _load("months.npy")[:columns],
+            _load("reference_table_ids.npy")[:columns],
+        )
+
+    def _write_values(self, values: np.ndarray) -> None:
+        # Write then rename, so readers never map a partial file
+        _tmp_path = self._path("values.tmp.npy")
+        np.save(_tmp_path, values)
+        os.replace(_tmp_path, self._path("values.npy"))
+
+    def _save_index(self) -> None:
+        for name, array in (
+            ("keys.npy", self.keys),
+            ("months.npy", self.months),
+            ("reference_table_ids.npy", self.reference_table_ids),
+        ):
+            _tmp_path = self._path(f"{name}.tmp.npy")
+            np.save(_tmp_path, array)
+            os.replace(_tmp_path, self._path(name))
+
+        # Written last: readers only look at the rows and columns it counts
+        _tmp_path = self._path("meta.json.tmp")
+        with open(_tmp_path, "w") as f:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "rows": self.rows,
+                    "columns": self.columns,
+                    "row_capacity": self._values.shape[0],
+                    "column_capacity": self._values.shape[1],
+                },
+                f,
+            )
+        os.replace(_tmp_path, self._path("meta.json"))
+
+    def _reserve(self, rows: int, columns: int) -> None:
+        """Reallocate the matrix if `rows` x `columns` does not fit, with spare room."""
+        row_capacity, column_capacity = self._values.shape
+        if rows <= row_capacity and columns <= column_capacity:
+            return
+
+        grown = np.full(
+            (
+                max(row_capacity, rows + SPARE_ROWS),
+                max(column_capacity, columns + SPARE_COLUMNS),
+            ),
+            np.nan,
+            dtype=np.float32,
+        )
+        grown[:row_capacity, :column_capacity] = self._values
+        self._write_values(grown)
+        self._values = np.load(self._path("values.npy"), mmap_mode="r+")
+        logger.info("Price matrix grown to %s x %s", *grown.shape)
+
+    def rows_of(self, keys: np.ndarray) -> np.ndarray:
+        """Row of each model year key, -1 for the unknown ones."""
+        keys = np.asarray(keys, dtype=np.int32)
+        positions = np.searchsorted(self._sorted_keys, keys)
+        positions = np.minimum(positions, len(self._sorted_keys) - 1)
+
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._sorted_keys):
+            found = self._sorted_keys[positions] == keys
+            rows[found] = self._key_order[positions[found]]
+
+        return rows
+
+    def history(self, model_year_key: int) -> np.ndarray:
+        """Price of a model year in every month, a view of the file.
+
+        Raises:
+            - KeyError: The model year has no prices in the matrix.
+        """
+        (row,) = self.rows_of(np.array([model_year_key]))
+        if row < 0:
+            raise KeyError(f"Unknown model year key {model_year_key}")
+
+        return self._values[row, : self.columns]
+
+    def histories(self, model_year_keys: list[int] | np.ndarray) -> np.ndarray:
+        """Prices of several model years, one row each, NaN for unknown ones."""
+        rows = self.rows_of(model_year_keys)
+
+        result = np.full((len(rows), self.columns), np.nan, dtype=np.float32)
+        found = rows >= 0
+        result[found] = self._values[rows[found], : self.columns]
+        return result
+
+    def column_of(self, reference_table_id: str) -> int:
+        (column,) = np.flatnonzero(self.reference_table_ids == reference_table_id)
+        return int(column)
+
+    def write_month(
+        self,
+        reference_table_id: str,
+        month: int,
+        model_year_keys: np.ndarray,
+        values: np.ndarray,
+    ) -> None:
+        """Write the prices of a month, replacing its column if it has one.
+
+        New months must come after the last column.
+        """
+        model_year_keys = np.asarray(model_year_keys, dtype=np.int32)
+        rows = self.rows_of(model_year_keys)
+
+        new_keys = np.unique(model_year_keys[rows < 0])
+        if reference_table_id in self.reference_table_ids:
+            column = self.column_of(reference_table_id)
+        elif self.columns and month <= self.months[-1]:
+            raise ValueError(
+                f"Reference table {reference_table_id} is older than the last column"
+            )
+        else:
+            column = self.columns
+
+        self._reserve(self.rows + len(new_keys), column + 1)
+        if len(new_keys):
+            self.keys = np.concatenate([self.keys, new_keys])
+            self._key_order = np.argsort(self.keys, kind="stable")
+            self._sorted_keys = self.keys[self._key_order]
+            rows = self.rows_of(model_year_keys)
+        if column == self.columns:
+            self.months = np.append(self.months, np.int32(month))
+            self.reference_table_ids = np.append(
+                self.reference_table_ids, reference_table_id
+            ).astype("U10")
+
+        # The whole column at once, readers never see it emptied
+        _column = np.full(self._values.shape[0], np.nan, dtype=np.float32)
+        _column[rows] = values
+        self._values[:, column] = _column
+        self._values.flush()
+
+        self._save_index()
+
+
+def _read_month(
+    db_session: Session, reference_table_id: str, month: int, archived: bool
+) -> tuple[np.ndarray, np.ndarray]:
+    # Read first, so that prices in `preco` win over ranges of the same model year
+    intervals = db_session.execute(
+        select(CarPriceInterval.model_year_key, CarPriceInterval.value).where(
+            CarPriceInterval.valid_from <= month, CarPriceInterval.valid_to >= month
+        )
+    ).all()
+    keys = [key for key, _ in intervals]
+    values = [value for _, value in intervals]
+
+    if archived:
+        rows = list(
+            db_archive.iter_archived_car_prices(
+                db_session,
+                columns=["model_year_key", "value"],
+                reference_table_id=reference_table_id,
+            )
+        )
+        # Older archives resolve keys from the catalog, unknown model years are None
+        keys += [key for key, _ in rows if key is not None]
+        values += [value for key, value in rows if key is not None]
+    else:
+        columns = db_readers.read_car_prices(
+            db_session,
+            reference_table_id=reference_table_id,
+            columns=["model_year_key", "value"],
+            as_columns=True,
+        )
+        keys += columns["model_year_key"]
+        values += columns["value"]
+
+    prices = dict(zip(keys, values))
+    return (
+        np.asarray(list(prices.keys()), dtype=np.int32),
+        np.asarray(list(prices.values()), dtype=np.float32),
+    )
+
+
+def update_matrix(
+    db_session: Session, directory: str = MATRIX_DIR, rebuild: bool = False
+) -> list[str]:
+    """Bring the matrix in `directory` up to date with the database.
+
+    Returns:
+        - list[str]: Reference tables written.
+    """
+    _counts = dict(db_session.execute(_PRICES_PER_MONTH_STMT).all())
+    for reference_table_id, _count in db_session.execute(_INTERVALS_PER_MONTH_STMT):
+        _counts[reference_table_id] = _counts.get(reference_table_id, 0) + _count
+    archived = {
+        archived.reference_table_id
+        for archived in db_archive.list_archived_reference_tables(db_session)
+    }
+    months = [
+        (row.fipe_id, month_ordinal(row.year, row.month))
+        for row in db_readers.read_reference_tables(db_session)
+        if _counts.get(row.fipe_id) or row.fipe_id in archived
+    ]
+
+    matrix = None
+    if not rebuild:
+        try:
+            matrix = PriceMatrix.load(directory, writable=True)
+        except FileNotFoundError:
+            pass
+
+    if matrix is not None and matrix.columns:
+        _written = set(matrix.reference_table_ids.tolist())
+        _last = int(matrix.months[-1])
+        if any(
+            month < _last and reference_table_id not in _written
+            for reference_table_id, month in months
+        ):
+            logger.info("Older months landed, rebuilding the price matrix")
+            matrix = None
+        else:
+            # The last month is written again, it may have been crawled since
+            months = [
+                (reference_table_id, month)
+                for reference_table_id, month in months
+                if month >= _last
+            ]
+
+    if matrix is None:
+        matrix = PriceMatrix.create(
+            directory, column_capacity=len(months) + SPARE_COLUMNS
+        )
+
+    written = []
+    for reference_table_id, month in months:
+        keys, values = _read_month(
+            db_session, reference_table_id, month, reference_table_id in archived
+        )
+        matrix.write_month(reference_table_id, month, keys, values)
+        written.append(reference_table_id)
+
+    logger.info(
+        "Price matrix has %s model years x %s months", matrix.rows, matrix.columns
+    )
+    return written
+
+
+__all__ = ["MATRIX_DIR", "PriceMatrix", "update_matrix"]
@@ -0,0 +1,246 @@
+"""Array-backed price snapshot of a single reference table.
+
+Every price of the reference table is loaded into numpy columns sorted by `value`, so
+"every vehicle between X and Y", "the N most expensive" and "the N closest to X" are
+binary searches (`np.searchsorted`) over the value column instead of scans of `preco`.
+
+Snapshots are saved as a directory of `.npy` files, one per column, and loaded back
+memory-mapped: opening one is almost free and pages are only read when queried.
+
+    snapshot = SnapshotIndex.from_database(db_session, "308")
+    snapshot.save("cache/snapshots/308")
+
+    snapshot = SnapshotIndex.load("cache/snapshots/308")
+    snapshot.records(snapshot.price_range(50_000, 60_000, fuel_type=1))
+"""
+
+import json
+import os
+
+import numpy as np
+from sqlalchemy import Connection
+from sqlalchemy.orm import Session
+
+from db import archive as db_archive
+from db import readers as db_readers
+
+SNAPSHOT_DIR = "cache/snapshots"
+FORMAT_VERSION = 1
+
+COLUMNS = {
+    "id": np.int64,
+    "value": np.float64,
+    "manufacturer_id": "U10",
+    "model_id": "U10",
+    "model_year_id": "U10",
+    "fipe_vehicle_code": "U10",
+    "vehicle_type_id": np.int8,
+    "year": np.int32,
+    "fuel_type": np.int8,
+}
+
+
+class SnapshotIndex:
+    """Prices of one reference table, sorted by value.
+
+    Query methods return positions in the snapshot (numpy integer arrays), which
+    `records` turns into dicts. They can all be narrowed by `fuel_type` and `year`
+    (the model year).
+
+    Args:
+        - reference_table_id (str): Reference table of the prices.
+        - columns (dict[str, np.ndarray]): One array per name in `COLUMNS`, all
+            sorted by `value`.
+    """
+
+    def __init__(self, reference_table_id: str, columns: dict[str, np.ndarray]) -> None:
+        self.reference_table_id = reference_table_id
+        self.columns = columns
+        self.values = columns["value"]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @classmethod
+    def from_columns(
+        cls, reference_table_id: str, columns: dict[str, list]
+    ) -> "SnapshotIndex":
+        """Build from unsorted `CAR_PRICE_COLUMNS` lists, ex. `read_car_prices(...,
+        as_columns=True)`."""
+        model_year_ids = columns["model_year_id"]
+        # `ano_modelo` codes are "<year>-<fuel type>"
+        _year_fuel = [model_year_id.split("-") for model_year_id in model_year_ids]
+
+        _columns = {
+            "id": columns["id"],
+            "value": columns["value"],
+            "manufacturer_id": columns["manufacturer_id"],
+            "model_id": columns["model_id"],
+            "model_year_id": model_year_ids,
+            "fipe_vehicle_code": columns["fipe_vehicle_code"],
+            "vehicle_type_id": columns["vehicle_type_id"],
+            "year": [int(year) for year, _ in _year_fuel],
+            "fuel_type": [int(fuel_type) for _, fuel_type in _year_fuel],
+        }
+        arrays = {
+            name: np.asarray(_columns[name], dtype=dtype)
+            for name, dtype in COLUMNS.items()
+        }
+
+        order = np.argsort(arrays["value"], kind="stable")
+        return cls(
+            reference_table_id, {name: array[order] for name, array in arrays.items()}
+        )
+
+    @classmethod
+    def from_database(
+        cls, db_conn: Connection | Session, reference_table_id: str
+    ) -> "SnapshotIndex":
+        """Snapshot of the prices in `preco`, or in the archive once archived."""
+        if db_archive.list_archived_reference_tables(db_conn, reference_table_id):
+            rows = db_archive.iter_archived_car_prices(
+                db_conn,
+                columns=list(db_readers.CAR_PRICE_COLUMNS),
+                reference_table_id=reference_table_id,
+            )
+            columns = dict(zip(db_readers.CAR_PRICE_COLUMNS, map(list, zip(*rows))))
+            if not columns:
+                columns = {name: [] for name in db_readers.CAR_PRICE_COLUMNS}
+        else:
+            columns = db_readers.read_car_prices(
+                db_conn, reference_table_id=reference_table_id, as_columns=True
+            )
+
+        return cls.from_columns(reference_table_id, columns)
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name, array in self.columns.items():
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+
+        # Written last: a directory without it is an incomplete snapshot
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "reference_table_id": self.reference_table_id,
+                    "rows": len(self),
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "SnapshotIndex":
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {meta['format_version']}")
+
+        columns = {
+            name: np.load(
+                os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None
+            )
+            for name in COLUMNS
+        }
+        return cls(meta["reference_table_id"], columns)
+
+    def _mask(
+        self, positions: np.ndarray, fuel_type: int | None, year: int | None
+    ) -> np.ndarray:
+        if fuel_type is not None:
+            positions = positions[self.columns["fuel_type"][positions] == fuel_type]
+        if year is not None:
+            positions = positions[self.columns["year"][positions] == year]
+
+        return positions
+
+    def _filtered(self, fuel_type: int | None, year: int | None) -> np.ndarray:
+        positions = np.arange(len(self))
+        if fuel_type is None and year is None:
+            return positions
+
+        return self._mask(positions, fuel_type, year)
+
+    def price_range(
+        self,
+        low: float | None = None,
+        high: float | None = None,
+        fuel_type: int | None = None,
+        year: int | None = None,
+        limit: int | None = None,
+    ) -> np.ndarray:
+        """Positions of the prices within `[low, high]`, cheapest first."""
+        start = 0 if low is None else np.searchsorted(self.values, low, "left")
+        stop = (
+            len(self) if high is None else np.searchsorted(self.values, high, "right")
+        )
+
+        positions = self._mask(np.arange(start, stop), fuel_type, year)
+        return positions[:limit]
+
+    def top(
+        self,
+        n: int = 10,
+        cheapest: bool = False,
+        fuel_type: int | None = None,
+        year: int | None = None,
+    ) -> np.ndarray:
+        """Positions of the `n` most expensive prices (or cheapest), in that order."""
+        positions = self._filtered(fuel_type, year)
+        if cheapest:
+            return positions[:n]
+
+        return positions[::-1][:n]
+
+    def nearest(
+        self,
+        value: float,
+        n: int = 10,
+        fuel_type: int | None = None,
+        year: int | None = None,
+    ) -> np.ndarray:
+        """Positions of the `n` prices closest to `value`, closest first."""
+        if fuel_type is None and year is None:
+            positions, values = None, self.values
+        else:
+            positions = self._filtered(fuel_type, year)
+            values = self.values[positions]
+
+        # The n closest are within n positions of where `value` would be inserted
+        center = int(np.searchsorted(values, value))
+        window = np.arange(max(center - n, 0), min(center + n, len(values)))
+        closest = window[np.argsort(np.abs(values[window] - value), kind="stable")]
+
+        return closest[:n] if positions is None else positions[closest[:n]]
+
+    def records(self, positions: np.ndarray) -> list[dict]:
+        return [
+            {name: column[position].item() for name, column in self.columns.items()}
+            for position in positions
+        ]
+
+
+def snapshot_path(reference_table_id: str, snapshot_dir: str = SNAPSHOT_DIR) -> str:
+    return os.path.join(snapshot_dir, reference_table_id)
+
+
+def load_or_build_snapshot(
+    db_conn: Connection | Session,
+    reference_table_id: str,
+    snapshot_dir: str = SNAPSHOT_DIR,
+) -> SnapshotIndex:
+    """The saved snapshot of a reference table, or one built from the database."""
+    try:
+        return SnapshotIndex.load(snapshot_path(reference_table_id, snapshot_dir))
+    except FileNotFoundError:
+        return SnapshotIndex.from_database(db_conn, reference_table_id)
+
+
+__all__ = [
+    "COLUMNS",
+    "SNAPSHOT_DIR",
+    "SnapshotIndex",
+    "load_or_build_snapshot",
+    "snapshot_path",
+]
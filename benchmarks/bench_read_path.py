@@ -0,0 +1,186 @@
+"""Compare the ORM queries in `db.services` against the Core reads in `db.readers`.
+
+By default the benchmark fills an in-memory SQLite database with synthetic catalog and
+price rows. Pass `--database-uri` to run it against an existing database instead (it
+is only read from in that case).
+
+    python -m benchmarks.bench_read_path --models 2000 --repeat 5
+    python -m benchmarks.bench_read_path --database-uri postgresql+psycopg://...
+"""
+
+import argparse
+import random
+import time
+from typing import Callable
+
+from sqlalchemy import Engine, create_engine, insert
+from sqlalchemy.orm import Session
+
+from db import readers as db_readers
+from db import services as db_services
+from db.models import all_models as db_models
+from db.models.base import mapper_registry
+
+YEAR_GTE = 1995
+
+
+def populate(engine: Engine, models: int, years_per_model: int, months: int) -> None:
+    mapper_registry.metadata.create_all(engine)
+
+    _random = random.Random(0)
+    model_years = [
+        {
+            # Surrogate keys are given explicitly so prices can point to them
+            "id": model * years_per_model + year + 1,
+            "fipe_id": f"{1990 + year}-{model % 3 + 1}",
+            "model_key": model + 1,
+            "model_id": str(model),
+            "display_name": f"{1990 + year}",
+            "year": 1990 + year,
+            "fuel_type": model % 3 + 1,
+        }
+        for model in range(models)
+        for year in range(years_per_model)
+    ]
+
+    # ORM bulk inserts, so rows can be given by attribute name
+    with Session(engine) as db_session:
+        db_session.execute(
+            insert(db_models.Manufacturer),
+            [{"id": 1, "fipe_id": "1", "display_name": "Bench", "vehicle_type_id": 1}],
+        )
+        db_session.execute(
+            insert(db_models.CarModel),
+            [
+                {
+                    "id": model + 1,
+                    "fipe_id": str(model),
+                    "display_name": "M",
+                    "manufacturer_key": 1,
+                    "manufacturer_id": "1",
+                }
+                for model in range(models)
+            ],
+        )
+        db_session.execute(
+            insert(db_models.ReferenceTable),
+            [
+                {
+                    "fipe_id": str(month),
+                    "display_name": str(month),
+                    "month": month % 12 + 1,
+                    "year": 2001 + month // 12,
+                }
+                for month in range(months)
+            ],
+        )
+        db_session.execute(insert(db_models.CarModelYear), model_years)
+        db_session.execute(
+            insert(db_models.CarPrice),
+            [
+                {
+                    "model_year_key": row["id"],
+                    "manufacturer_id": "1",
+                    "model_id": row["model_id"],
+                    "model_year_id": row["fipe_id"],
+                    "vehicle_type_id": 1,
+                    "reference_table_id": str(month),
+                    "authentication": f"{row['model_id']}-{row['fipe_id']}-{month}",
+                    "query_date": "",
+                    "reference_month": "",
+                    "fipe_vehicle_code": f"{row['model_id']:0>6}-1",
+                    "value": _random.uniform(5_000, 500_000),
+                    "raw_data": {},
+                }
+                for row in model_years
+                for month in range(months)
+            ],
+        )
+        db_session.commit()
+
+
+def timed(fn: Callable[[], object], repeat: int) -> tuple[float, int]:
+    best = float("inf")
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        rows = len(
+            result if not isinstance(result, dict) else next(iter(result.values()))
+        )
+        best = min(best, time.perf_counter() - start)
+
+    return best, rows
+
+
+def run(engine: Engine, repeat: int) -> None:
+    with Session(engine) as db_session:
+        reference_table_id = db_readers.read_reference_tables(db_session)[-1].fipe_id
+
+        cases: list[tuple[str, Callable[[], object]]] = [
+            (
+                "model years / ORM list_car_models_years",
+                lambda: db_services.list_car_models_years(
+                    db_session, year_gte=YEAR_GTE
+                ),
+            ),
+            (
+                "model years / ORM iter_car_models_years",
+                lambda: list(
+                    db_services.iter_car_models_years(db_session, year_gte=YEAR_GTE)
+                ),
+            ),
+            (
+                "model years / Core rows",
+                lambda: db_readers.read_car_models_years(db_session, year_gte=YEAR_GTE),
+            ),
+            (
+                "model years / Core columns",
+                lambda: db_readers.read_car_models_years(
+                    db_session, year_gte=YEAR_GTE, as_columns=True
+                ),
+            ),
+            (
+                "prices of a month / ORM query",
+                lambda: (
+                    db_session.query(db_models.CarPrice)
+                    .filter(db_models.CarPrice.reference_table_id == reference_table_id)
+                    .all()
+                ),
+            ),
+            (
+                "prices of a month / Core rows",
+                lambda: db_readers.read_car_prices(
+                    db_session, reference_table_id=reference_table_id
+                ),
+            ),
+        ]
+
+        print(f"{'case':<44} {'rows':>8} {'best (ms)':>10}")
+        for name, fn in cases:
+            # Nothing from a previous run may be served from the identity map
+            db_session.expunge_all()
+            best, rows = timed(fn, repeat)
+            print(f"{name:<44} {rows:>8} {best * 1000:>10.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-uri")
+    parser.add_argument("--models", type=int, default=2000)
+    parser.add_argument("--years-per-model", type=int, default=10)
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.database_uri:
+        engine = create_engine(args.database_uri)
+    else:
+        engine = create_engine("sqlite://")
+        populate(engine, args.models, args.years_per_model, args.months)
+
+    run(engine, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""Cold storage for the prices of closed reference tables.
+
+Old reference tables are never updated again and are only read by the occasional
+backfill, yet their rows make `preco` indexes and vacuums slower.
+`archive_reference_table` moves the prices of a reference table into a zstd-compressed
+Parquet file, partitioned like `archive/preco/ano=2005/mes=03/<fipe_id>.parquet`,
+records it in `preco_arquivo` and deletes the rows from `preco`.
+`iter_archived_car_prices` reads them back with the same columns and filters as
+`db.services.iter_car_prices`, after checking each file against its recorded sha256
+the first time it is read (and again whenever its size or mtime changes).
+
+Files archived before `preco` had `model_year_key` lack that column; it is resolved
+from the catalog through the FIPE codes of each price when read.
+
+The crawler and `PriceCoverage` skip archived reference tables, so their prices are
+never written to `preco` again.
+
+Requires `pyarrow`, which is only imported when archiving or reading archives.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Iterator, Sequence
+
+from sqlalchemy import Connection, delete, inspect, select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from db import readers as db_readers
+from db.models.all_models import (
+    ArchivedReferenceTable,
+    CarModel,
+    CarModelYear,
+    CarPrice,
+    Manufacturer,
+    ReferenceTable,
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "archive/preco"
+
+# `iter_car_prices` filters that can be pushed down to the Parquet reader
+_FILTERS = (
+    "reference_table_id",
+    "manufacturer_id",
+    "model_id",
+    "model_year_id",
+    "fipe_vehicle_code",
+)
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("model_year_key", pa.int64()),
+            ("manufacturer_id", pa.string()),
+            ("model_id", pa.string()),
+            ("model_year_id", pa.string()),
+            ("vehicle_type_id", pa.int16()),
+            ("reference_table_id", pa.string()),
+            ("authentication", pa.string()),
+            ("query_date", pa.string()),
+            ("reference_month", pa.string()),
+            ("fipe_vehicle_code", pa.string()),
+            ("value", pa.float64()),
+            # JSON text, decoded back into a dict when read
+            ("raw_data", pa.string()),
+        ]
+    )
+
+
+def archive_path(reference_table: Any, archive_dir: str = ARCHIVE_DIR) -> str:
+    return os.path.join(
+        archive_dir,
+        f"ano={reference_table.year}",
+        f"mes={reference_table.month:02d}",
+        f"{reference_table.fipe_id}.parquet",
+    )
+
+
+# FIPE codes a model year key is resolved from, in files that lack the key
+_MODEL_YEAR_CODES = ("vehicle_type_id", "manufacturer_id", "model_id", "model_year_id")
+
+_MODEL_YEAR_KEYS_STMT = (
+    select(
+        Manufacturer.vehicle_type_id,
+        Manufacturer.fipe_id,
+        CarModel.fipe_id,
+        CarModelYear.fipe_id,
+        CarModelYear.id,
+    )
+    .join(CarModel, CarModel.manufacturer_key == Manufacturer.id)
+    .join(CarModelYear, CarModelYear.model_key == CarModel.id)
+)
+
+
+def _model_year_keys(db_conn: Connection | Session) -> dict[tuple, int]:
+    """Surrogate key of every model year, by `_MODEL_YEAR_CODES`."""
+    return {tuple(row[:-1]): row[-1] for row in db_conn.execute(_MODEL_YEAR_KEYS_STMT)}
+
+
+def _sha256(path: str) -> str:
+    _hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            _hash.update(chunk)
+
+    return _hash.hexdigest()
+
+
+# path -> (mtime, size, sha256) of the archives already checked by this process
+_verified_archives: dict[str, tuple[int, int, str]] = {}
+
+
+def _verify_archive(path: str, sha256: str) -> None:
+    """Raise if the file at `path` does not match `sha256`, hashing it only once."""
+    _stat = os.stat(path)
+    _state = (_stat.st_mtime_ns, _stat.st_size, sha256)
+    if _verified_archives.get(path) == _state:
+        return
+
+    if _sha256(path) != sha256:
+        raise RuntimeError(f"Archive {path} does not match its sha256")
+
+    _verified_archives[path] = _state
+
+
+def archive_reference_table(
+    db_session: Session,
+    reference_table_id: str,
+    archive_dir: str = ARCHIVE_DIR,
+    compression_level: int = 9,
+) -> ArchivedReferenceTable | None:
+    """Move the prices of a reference table to a Parquet file and commit.
+
+    The file is written and verified before the catalog row is added and the prices
+    are deleted, in a single transaction, so an interrupted run can simply be
+    started again.
+
+    Returns:
+        - ArchivedReferenceTable | None: The catalog entry, None if there was
+            nothing to archive.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    reference_table = db_session.get(ReferenceTable, reference_table_id)
+    if reference_table is None:
+        raise KeyError(f"Unknown reference table {reference_table_id}")
+
+    if db_session.get(ArchivedReferenceTable, reference_table_id) is not None:
+        logger.info("Reference table %s is already archived", reference_table_id)
+        return None
+
+    schema = _arrow_schema()
+    columns = db_readers.read_car_prices(
+        db_session,
+        reference_table_id=reference_table_id,
+        columns=schema.names,
+        as_columns=True,
+    )
+    rows = len(columns["id"])
+    if not rows:
+        return None
+
+    columns["raw_data"] = [json.dumps(raw_data) for raw_data in columns["raw_data"]]
+    table = pa.Table.from_pydict(columns, schema=schema)
+
+    path = archive_path(reference_table, archive_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _tmp_path = f"{path}.tmp"
+    pq.write_table(
+        table,
+        _tmp_path,
+        compression="zstd",
+        compression_level=compression_level,
+    )
+
+    written_rows = pq.ParquetFile(_tmp_path).metadata.num_rows
+    if written_rows != rows:
+        os.remove(_tmp_path)
+        raise RuntimeError(
+            f"Archive of {reference_table_id} has {written_rows} rows, expected {rows}"
+        )
+    os.replace(_tmp_path, path)
+
+    archived = ArchivedReferenceTable(
+        reference_table_id=reference_table_id,
+        path=path,
+        rows=rows,
+        size_bytes=os.path.getsize(path),
+        sha256=_sha256(path),
+        archived_at=datetime.datetime.now(datetime.UTC).replace(tzinfo=None),
+    )
+    _stat = os.stat(path)
+    _verified_archives[path] = (_stat.st_mtime_ns, _stat.st_size, archived.sha256)
+    db_session.add(archived)
+    db_session.execute(
+        delete(CarPrice).where(CarPrice.reference_table_id == reference_table_id)
+    )
+    db_session.commit()
+
+    logger.info(
+        "Archived %s prices of %s to %s (%s bytes)",
+        rows,
+        reference_table.display_name,
+        path,
+        archived.size_bytes,
+    )
+    return archived
+
+
+def list_archived_reference_tables(
+    db_conn: Connection | Session,
+    reference_table_id: str | None = None,
+) -> Sequence[Row]:
+    """`preco_arquivo` rows, as named tuples of the `ArchivedReferenceTable`
+    attributes."""
+    c = inspect(ArchivedReferenceTable).columns
+    stmt = select(*db_readers.columns_of(ArchivedReferenceTable)).order_by(
+        c.reference_table_id
+    )
+    if reference_table_id is not None:
+        stmt = stmt.where(c.reference_table_id == reference_table_id)
+
+    return db_readers.fetch(db_conn, stmt)
+
+
+def iter_archived_car_prices(
+    db_conn: Connection | Session,
+    columns: list[str] | None = None,
+    batch_size: int = 10_000,
+    **kwargs,
+) -> Iterator[tuple]:
+    """Archived prices as tuples of `columns` (every `preco` column by default).
+
+    Accepts the same filters as `db.services.iter_car_prices`, a list of values
+    matches any of them.
+    """
+    archived = list_archived_reference_tables(db_conn, kwargs.get("reference_table_id"))
+    if not archived:
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = list(columns or inspect(CarPrice).columns.keys())
+    filters = [
+        (attr, "in", kwargs[attr])
+        if isinstance(kwargs[attr], (list, tuple, set))
+        else (attr, "==", kwargs[attr])
+        for attr in _FILTERS
+        if kwargs.get(attr) is not None
+    ]
+
+    decode_raw_data = "raw_data" in columns
+    raw_data_index = columns.index("raw_data") if decode_raw_data else None
+
+    model_year_keys = None
+    for archived_reference_table in archived:
+        path = archived_reference_table.path
+        _verify_archive(path, archived_reference_table.sha256)
+
+        _read_columns = columns
+        resolve_keys = (
+            "model_year_key" in columns
+            and "model_year_key" not in pq.read_schema(path).names
+        )
+        if resolve_keys:
+            _read_columns = [name for name in columns if name != "model_year_key"]
+            _read_columns += [
+                name for name in _MODEL_YEAR_CODES if name not in _read_columns
+            ]
+
+        table = pq.read_table(path, columns=_read_columns, filters=filters or None)
+        if resolve_keys:
+            if model_year_keys is None:
+                model_year_keys = _model_year_keys(db_conn)
+            _codes = zip(
+                *(table.column(name).to_pylist() for name in _MODEL_YEAR_CODES)
+            )
+            table = table.append_column(
+                "model_year_key",
+                pa.array(
+                    [model_year_keys.get(codes) for codes in _codes], type=pa.int64()
+                ),
+            )
+        for batch in table.to_batches(max_chunksize=batch_size):
+            for row in zip(*(batch.column(name).to_pylist() for name in columns)):
+                if decode_raw_data:
+                    row = list(row)
+                    row[raw_data_index] = json.loads(row[raw_data_index])
+                    row = tuple(row)
+                yield row
+
+
+__all__ = [
+    "ARCHIVE_DIR",
+    "archive_path",
+    "archive_reference_table",
+    "iter_archived_car_prices",
+    "list_archived_reference_tables",
+]
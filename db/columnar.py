@@ -0,0 +1,74 @@
+"""DuckDB over the application database, for scan-heavy analyses.
+
+`connect_duckdb` attaches the SQLite file or the Postgres database read-only, so
+aggregations over `preco` run on DuckDB's columnar, vectorized engine against the live
+tables, with nothing to export first:
+
+    con = connect_duckdb()
+    con.sql("SELECT modelo_id, avg(valor) FROM preco GROUP BY modelo_id").df()
+
+Requires `duckdb` (`pip install duckdb`), which is only imported when connecting.
+DuckDB downloads its `sqlite` or `postgres` extension the first time it attaches one.
+"""
+
+from sqlalchemy.engine import make_url
+
+from db.engine import DATABASE_URI
+
+ATTACHED_DATABASE = "fipe"
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def attach_statement(database_uri: str | None = None) -> str:
+    """DuckDB `ATTACH` of a SQLAlchemy database URL, read-only.
+
+    Raises:
+        - ValueError: The database is an in-memory SQLite one.
+        - NotImplementedError: DuckDB cannot attach the backend.
+    """
+    url = make_url(database_uri or DATABASE_URI)
+    backend = url.get_backend_name()
+
+    if backend == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            raise ValueError("An in-memory SQLite database cannot be attached")
+        return (
+            f"ATTACH {_quote(url.database)} AS {ATTACHED_DATABASE} "
+            "(TYPE sqlite, READ_ONLY)"
+        )
+
+    if backend == "postgresql":
+        _params = {
+            "host": url.host,
+            "port": url.port,
+            "dbname": url.database,
+            "user": url.username,
+            "password": url.password,
+        }
+        dsn = " ".join(
+            f"{name}={value}" for name, value in _params.items() if value is not None
+        )
+        return f"ATTACH {_quote(dsn)} AS {ATTACHED_DATABASE} (TYPE postgres, READ_ONLY)"
+
+    raise NotImplementedError(f"DuckDB cannot attach {backend} databases")
+
+
+def connect_duckdb(database_uri: str | None = None, duckdb_path: str = ":memory:"):
+    """A DuckDB connection with the application database attached and selected.
+
+    Args:
+        - database_uri (str | None): SQLAlchemy URL, `DATABASE_URI` by default.
+        - duckdb_path (str): DuckDB's own database, for tables the analysis creates.
+    """
+    import duckdb
+
+    con = duckdb.connect(duckdb_path)
+    con.execute(attach_statement(database_uri))
+    con.execute(f"USE {ATTACHED_DATABASE}")
+    return con
+
+
+__all__ = ["ATTACHED_DATABASE", "attach_statement", "connect_duckdb"]
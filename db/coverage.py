@@ -0,0 +1,459 @@
+"""Price coverage of every model year across reference tables.
+
+Cars must have a price for every month since they started being produced. Instead of
+anti-joining `preco` against every (model year x reference table) pair, coverage is
+kept as one bitmap per model year, where bit `i` is set when there is a price in the
+`i`-th reference table (in chronological order). Python integers are used as the
+bitmaps, so finding the holes of a model year is a handful of bitwise operations.
+
+Model years are first published with the year `32000` ("zero km") and get their real
+year once they stop being new, so a zero km model year is expected to have prices
+only between its first and last appearance. A model year of the catalog without any
+price is expected in the latest reference table.
+
+Prices are read from `preco`, from the archive and from the validity ranges of
+`preco_intervalo`. Archived reference tables (see `db.archive`) are never reported as
+gaps either, otherwise `repair` would crawl them into `preco` again.
+
+`update_coverage` keeps the bitmaps of `preco` and of the archive in
+`cache/coverage.json`, with the highest `preco.id` they include, so each run only reads
+the prices stored since the last one. Validity ranges are updated in place and the
+catalog is small, both are read again every time. Prices committed out of `preco.id`
+order while the file was updated are only picked up by a rebuild.
+"""
+
+import bisect
+import json
+import logging
+import os
+from typing import Iterable, Iterator, NamedTuple
+
+from sqlalchemy import Connection, func, select
+from sqlalchemy.orm import Session
+
+from db import archive as db_archive
+from db import readers as db_readers
+from db.intervals import month_ordinal
+from db.models.all_models import (
+    CarModel,
+    CarModelYear,
+    CarPrice,
+    CarPriceInterval,
+    Manufacturer,
+)
+
+logger = logging.getLogger(__name__)
+
+ZERO_KM_YEAR = 32000
+
+COVERAGE_PATH = "cache/coverage.json"
+FORMAT_VERSION = 1
+
+# Columns of the rows accepted by `PriceCoverage.add`
+_PRICE_COLUMNS = [
+    "reference_table_id",
+    "manufacturer_id",
+    "model_id",
+    "model_year_id",
+    "vehicle_type_id",
+]
+
+_LATEST_CAR_PRICE_ID_STMT = select(func.max(CarPrice.id))
+
+_INTERVALS_STMT = select(
+    CarPriceInterval.valid_from,
+    CarPriceInterval.valid_to,
+    CarPriceInterval.manufacturer_id,
+    CarPriceInterval.model_id,
+    CarPriceInterval.model_year_id,
+    CarPriceInterval.vehicle_type_id,
+)
+
+_CATALOG_STMT = (
+    select(
+        Manufacturer.fipe_id,
+        CarModel.fipe_id,
+        CarModelYear.fipe_id,
+        Manufacturer.vehicle_type_id,
+    )
+    .join(CarModel, CarModel.manufacturer_key == Manufacturer.id)
+    .join(CarModelYear, CarModelYear.model_key == CarModel.id)
+)
+
+
+class CoverageGap(NamedTuple):
+    reference_table_id: str
+    manufacturer_id: str
+    model_id: str
+    model_year_id: str
+    vehicle_type_id: int
+
+
+def is_zero_km(model_year_id: str) -> bool:
+    return int(model_year_id.split("-")[0]) == ZERO_KM_YEAR
+
+
+def iter_set_bits(bitmap: int) -> Iterator[int]:
+    """Positions of the bits set in `bitmap`, lowest first."""
+    while bitmap:
+        lowest = bitmap & -bitmap
+        yield lowest.bit_length() - 1
+        bitmap ^= lowest
+
+
+class PriceCoverage:
+    """Bitmaps of which reference tables have a price, per model year.
+
+    Args:
+        - reference_table_ids (list[str]): Every reference table, oldest first.
+        - archived_reference_table_ids (Iterable[str]): Reference tables whose prices
+            are archived, never reported as gaps.
+        - months (list[int] | None): Month ordinals of `reference_table_ids`, needed
+            by `add_range`.
+    """
+
+    def __init__(
+        self,
+        reference_table_ids: list[str],
+        archived_reference_table_ids: Iterable[str] = (),
+        months: list[int] | None = None,
+    ) -> None:
+        self.reference_table_ids = list(reference_table_ids)
+        self.archived_reference_table_ids = list(archived_reference_table_ids)
+        self.months = list(months) if months is not None else None
+        self._positions = {
+            reference_table_id: position
+            for position, reference_table_id in enumerate(self.reference_table_ids)
+        }
+        # Highest `preco.id` included, see `update_coverage`
+        self.last_car_price_id = 0
+
+        self._archived_bitmap = 0
+        for reference_table_id in self.archived_reference_table_ids:
+            position = self._positions.get(reference_table_id)
+            if position is not None:
+                self._archived_bitmap |= 1 << position
+
+        # (model_id, model_year_id) -> bitmap
+        self._bitmaps: dict[tuple[str, str], int] = {}
+        # (model_id, model_year_id) -> (manufacturer_id, vehicle_type_id, zero km)
+        self._owners: dict[tuple[str, str], tuple[str, int, bool]] = {}
+
+    def __len__(self) -> int:
+        return len(self._bitmaps)
+
+    def add(
+        self,
+        reference_table_id: str,
+        manufacturer_id: str,
+        model_id: str,
+        model_year_id: str,
+        vehicle_type_id: int = 1,
+    ) -> None:
+        """Mark the price of a model year in a reference table as present."""
+        position = self._positions.get(reference_table_id)
+        if position is None:
+            raise KeyError(f"Unknown reference table {reference_table_id}")
+
+        self._add_bits(
+            1 << position, manufacturer_id, model_id, model_year_id, vehicle_type_id
+        )
+
+    def add_range(
+        self,
+        valid_from: int,
+        valid_to: int,
+        manufacturer_id: str,
+        model_id: str,
+        model_year_id: str,
+        vehicle_type_id: int = 1,
+    ) -> None:
+        """Mark the prices of a model year in every reference table between two month
+        ordinals (inclusive) as present, ex. a `preco_intervalo` row."""
+        if self.months is None:
+            raise ValueError("Ranges need the months of the reference tables")
+
+        first = bisect.bisect_left(self.months, valid_from)
+        end = bisect.bisect_right(self.months, valid_to)
+        self._add_bits(
+            ((1 << end) - 1) ^ ((1 << first) - 1),
+            manufacturer_id,
+            model_id,
+            model_year_id,
+            vehicle_type_id,
+        )
+
+    def add_model_year(
+        self,
+        manufacturer_id: str,
+        model_id: str,
+        model_year_id: str,
+        vehicle_type_id: int = 1,
+    ) -> None:
+        """Track a model year of the catalog, with or without prices."""
+        self._add_bits(0, manufacturer_id, model_id, model_year_id, vehicle_type_id)
+
+    def _add_bits(
+        self,
+        bits: int,
+        manufacturer_id: str,
+        model_id: str,
+        model_year_id: str,
+        vehicle_type_id: int,
+    ) -> None:
+        _key = (model_id, model_year_id)
+        bitmap = self._bitmaps.get(_key)
+        if bitmap is None:
+            bitmap = 0
+            self._owners[_key] = (
+                manufacturer_id,
+                vehicle_type_id,
+                is_zero_km(model_year_id),
+            )
+
+        self._bitmaps[_key] = bitmap | bits
+
+    def bitmap(self, model_id: str, model_year_id: str) -> int:
+        return self._bitmaps.get((model_id, model_year_id), 0)
+
+    def missing_bitmap(self, bitmap: int, zero_km: bool, until_latest: bool) -> int:
+        """Bits expected to be set in `bitmap` but that are not.
+
+        A model year is expected to have prices from its first reference table up to
+        its last one or, with `until_latest`, up to the latest reference table (zero km
+        model years always stop at their last appearance). Without any price, only the
+        latest reference table is expected.
+        """
+        if not bitmap:
+            latest = 1 << len(self.reference_table_ids) >> 1
+            return latest & ~self._archived_bitmap
+
+        first = (bitmap & -bitmap).bit_length() - 1
+        last = bitmap.bit_length() - 1
+        if until_latest and not zero_km:
+            last = len(self.reference_table_ids) - 1
+
+        expected = ((1 << (last + 1)) - 1) ^ ((1 << first) - 1)
+        return expected & ~bitmap & ~self._archived_bitmap
+
+    def gaps(self, until_latest: bool = False) -> Iterator[CoverageGap]:
+        """Every missing (model year x reference table) price."""
+        for _key, bitmap in self._bitmaps.items():
+            manufacturer_id, vehicle_type_id, zero_km = self._owners[_key]
+            missing = self.missing_bitmap(bitmap, zero_km, until_latest)
+            if not missing:
+                continue
+
+            model_id, model_year_id = _key
+            for position in iter_set_bits(missing):
+                yield CoverageGap(
+                    self.reference_table_ids[position],
+                    manufacturer_id,
+                    model_id,
+                    model_year_id,
+                    vehicle_type_id,
+                )
+
+    def count_gaps(self, until_latest: bool = False) -> int:
+        return sum(
+            self.missing_bitmap(bitmap, self._owners[_key][2], until_latest).bit_count()
+            for _key, bitmap in self._bitmaps.items()
+        )
+
+    @classmethod
+    def from_rows(
+        cls,
+        reference_table_ids: list[str],
+        rows: Iterable[tuple],
+        archived_reference_table_ids: Iterable[str] = (),
+    ) -> "PriceCoverage":
+        """Build from (reference_table_id, manufacturer_id, model_id, model_year_id,
+        vehicle_type_id) rows."""
+        coverage = cls(reference_table_ids, archived_reference_table_ids)
+        for row in rows:
+            coverage.add(*row)
+
+        return coverage
+
+    def save(self, path: str) -> None:
+        """Write the bitmaps to `path` as JSON, replacing it atomically."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        _tmp_path = f"{path}.tmp"
+        with open(_tmp_path, "w") as f:
+            json.dump(
+                {
+                    "format_version": FORMAT_VERSION,
+                    "reference_table_ids": self.reference_table_ids,
+                    "archived_reference_table_ids": self.archived_reference_table_ids,
+                    "last_car_price_id": self.last_car_price_id,
+                    "model_years": [
+                        [*_key, *self._owners[_key][:2], format(bitmap, "x")]
+                        for _key, bitmap in self._bitmaps.items()
+                    ],
+                },
+                f,
+            )
+        os.replace(_tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PriceCoverage":
+        """Read bitmaps written by `save`.
+
+        Raises:
+            - FileNotFoundError: There is no coverage at `path`.
+            - ValueError: The file was written by an incompatible version.
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        if data.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported coverage format in {path}")
+
+        coverage = cls(
+            data["reference_table_ids"], data["archived_reference_table_ids"]
+        )
+        coverage.last_car_price_id = data["last_car_price_id"]
+        for model_id, model_year_id, manufacturer_id, vehicle_type_id, bitmap in data[
+            "model_years"
+        ]:
+            coverage._add_bits(
+                int(bitmap, 16),
+                manufacturer_id,
+                model_id,
+                model_year_id,
+                vehicle_type_id,
+            )
+
+        return coverage
+
+    @classmethod
+    def from_database(
+        cls, db_conn: Connection | Session, batch_size: int = 10_000
+    ) -> "PriceCoverage":
+        """Build the coverage of every price in the database, without the file kept
+        by `update_coverage`."""
+        coverage = _empty_coverage(db_conn)
+        _add_stored_prices(coverage, db_conn, batch_size=batch_size)
+        _add_intervals_and_catalog(coverage, db_conn)
+        return coverage
+
+
+def _empty_coverage(db_conn: Connection | Session) -> PriceCoverage:
+    reference_tables = db_readers.read_reference_tables(db_conn)
+    return PriceCoverage(
+        [reference_table.fipe_id for reference_table in reference_tables],
+        [
+            archived.reference_table_id
+            for archived in db_archive.list_archived_reference_tables(db_conn)
+        ],
+        [
+            month_ordinal(reference_table.year, reference_table.month)
+            for reference_table in reference_tables
+        ],
+    )
+
+
+def _add_stored_prices(
+    coverage: PriceCoverage,
+    db_conn: Connection | Session,
+    archived_read: Iterable[str] = (),
+    batch_size: int = 10_000,
+) -> None:
+    """Add the prices of `preco` above `coverage.last_car_price_id` and of the archives
+    not in `archived_read`."""
+    last_car_price_id = db_conn.execute(_LATEST_CAR_PRICE_ID_STMT).scalar() or 0
+    stmt = (
+        select(*db_readers.columns_of(CarPrice, _PRICE_COLUMNS))
+        .where(CarPrice.id.between(coverage.last_car_price_id + 1, last_car_price_id))
+        .distinct()
+        .execution_options(yield_per=batch_size)
+    )
+    for row in db_conn.execute(stmt):
+        coverage.add(*row)
+    coverage.last_car_price_id = max(coverage.last_car_price_id, last_car_price_id)
+
+    _archived_read = set(archived_read)
+    for reference_table_id in coverage.archived_reference_table_ids:
+        if reference_table_id in _archived_read:
+            continue
+
+        for row in db_archive.iter_archived_car_prices(
+            db_conn,
+            _PRICE_COLUMNS,
+            batch_size=batch_size,
+            reference_table_id=reference_table_id,
+        ):
+            coverage.add(*row)
+
+
+def _add_intervals_and_catalog(
+    coverage: PriceCoverage, db_conn: Connection | Session
+) -> None:
+    for row in db_conn.execute(_INTERVALS_STMT):
+        coverage.add_range(*row)
+
+    for row in db_conn.execute(_CATALOG_STMT):
+        coverage.add_model_year(*row)
+
+
+def update_coverage(
+    db_conn: Connection | Session,
+    path: str = COVERAGE_PATH,
+    rebuild: bool = False,
+    batch_size: int = 10_000,
+) -> PriceCoverage:
+    """Coverage of every price in the database, reading only the prices stored since
+    the bitmaps in `path` were saved, see the module docstring.
+
+    Args:
+        - db_conn (Connection | Session): Connection or session to read from.
+        - path (str): Where the bitmaps are kept.
+        - rebuild (bool): Read every price again, ex. after prices were deleted.
+        - batch_size (int): Rows fetched at a time.
+    """
+    coverage = _empty_coverage(db_conn)
+
+    stored = None
+    if not rebuild:
+        try:
+            stored = PriceCoverage.load(path)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.info("Coverage in %s is outdated, rebuilding it", path)
+
+    # New reference tables are appended to the bitmaps, older ones shift their bits
+    _count = len(stored.reference_table_ids) if stored is not None else 0
+    if stored is not None and (
+        stored.reference_table_ids != coverage.reference_table_ids[:_count]
+    ):
+        logger.info("Older reference tables landed, rebuilding the coverage")
+        stored = None
+
+    archived_read: list[str] = []
+    if stored is not None:
+        for (model_id, model_year_id), bitmap in stored._bitmaps.items():
+            manufacturer_id, vehicle_type_id, _ = stored._owners[
+                (model_id, model_year_id)
+            ]
+            coverage._add_bits(
+                bitmap, manufacturer_id, model_id, model_year_id, vehicle_type_id
+            )
+        coverage.last_car_price_id = stored.last_car_price_id
+        archived_read = stored.archived_reference_table_ids
+
+    _add_stored_prices(coverage, db_conn, archived_read, batch_size=batch_size)
+    coverage.save(path)
+
+    _add_intervals_and_catalog(coverage, db_conn)
+    return coverage
+
+
+__all__ = [
+    "COVERAGE_PATH",
+    "ZERO_KM_YEAR",
+    "CoverageGap",
+    "PriceCoverage",
+    "is_zero_km",
+    "update_coverage",
+]
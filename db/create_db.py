@@ -7,8 +7,9 @@ from db.models.base import mapper_registry
 def create_db(_engine: Engine):
     """Create the database tables."""
 
-    # We must import all models to create the tables
-    from db.models import all_models  # noqa
+    # We must import all models to create the tables, and the views and indexes
+    # built on them
+    from db.models import all_models, search, views  # noqa
 
     mapper_registry.metadata.create_all(_engine)
 
@@ -0,0 +1,67 @@
+"""Change-only price storage.
+
+Most vehicles keep the same `valor` for many consecutive reference tables, so instead
+of one `preco` row per month, prices can be stored as validity ranges: "this model
+year was worth X from reference table A to reference table B". Reference tables are
+placed on a timeline by their month ordinal (`year * 12 + month - 1`), so consecutive
+months are consecutive integers whatever their FIPE codes are.
+"""
+
+from typing import Iterable, Iterator, NamedTuple
+
+
+class PriceInterval(NamedTuple):
+    start: int
+    end: int
+    value: float
+
+
+def month_ordinal(year: int, month: int) -> int:
+    return year * 12 + month - 1
+
+
+def apply_observation(
+    intervals: Iterable[PriceInterval], ordinal: int, value: float
+) -> list[PriceInterval]:
+    """Intervals after observing `value` at month `ordinal`.
+
+    `intervals` only needs to contain the intervals touching `ordinal - 1`, `ordinal`
+    or `ordinal + 1`, that is every interval the observation can split or merge with.
+    The result is sorted by `start` and has no two adjacent intervals with the same
+    value.
+    """
+    pieces = [PriceInterval(ordinal, ordinal, value)]
+    for interval in intervals:
+        if not interval.start <= ordinal <= interval.end:
+            pieces.append(interval)
+            continue
+
+        # The observation replaces this month of the interval, keep both sides
+        if interval.start < ordinal:
+            pieces.append(PriceInterval(interval.start, ordinal - 1, interval.value))
+        if interval.end > ordinal:
+            pieces.append(PriceInterval(ordinal + 1, interval.end, interval.value))
+
+    merged: list[PriceInterval] = []
+    for piece in sorted(pieces):
+        previous = merged[-1] if merged else None
+        if (
+            previous is not None
+            and previous.end + 1 >= piece.start
+            and previous.value == piece.value
+        ):
+            merged[-1] = previous._replace(end=max(previous.end, piece.end))
+        else:
+            merged.append(piece)
+
+    return merged
+
+
+def expand_intervals(intervals: Iterable[PriceInterval]) -> Iterator[tuple[int, float]]:
+    """Dense (month ordinal, value) series of the given intervals."""
+    for interval in sorted(intervals):
+        for ordinal in range(interval.start, interval.end + 1):
+            yield ordinal, interval.value
+
+
+__all__ = ["PriceInterval", "apply_observation", "expand_intervals", "month_ordinal"]
@@ -0,0 +1,184 @@
+"""Schema migrations for databases created by older versions.
+
+`create_db` only creates missing tables, so a schema change to an existing table is
+written here as a migration and run by `python main.py db migrate`. Each migration
+checks whether it is needed, so running them again is a no-op.
+
+Migrations only use SQL that both Postgres and SQLite understand.
+"""
+
+import logging
+from typing import Callable
+
+from sqlalchemy import Connection, Engine, inspect, text
+
+from db.models.base import mapper_registry
+
+logger = logging.getLogger(__name__)
+
+# Drop order, children first. Databases created before the change-only storage have
+# no `preco_intervalo`, it is only created.
+_CATALOG_TABLES = ("preco", "preco_intervalo", "ano_modelo", "modelo", "marca")
+
+# Model year codes of each model, by the old table they are read from
+_MODEL_YEAR_CODES = {
+    "ano_modelo": "SELECT modelo_id, fipe_id AS ano_modelo_id FROM ano_modelo_old",
+    "preco": "SELECT modelo_id, ano_modelo_id FROM preco_old",
+    "preco_intervalo": "SELECT modelo_id, ano_modelo_id FROM preco_intervalo_old",
+}
+
+# (old table, statement copying it back), skipped when the old table did not exist
+_COPY_CATALOG = [
+    (
+        "marca",
+        """
+        INSERT INTO marca (fipe_id, display_name, tipo_veiculo)
+        SELECT fipe_id, display_name, tipo_veiculo
+        FROM marca_old
+        ORDER BY tipo_veiculo, fipe_id
+        """,
+    ),
+    (
+        "modelo",
+        """
+        INSERT INTO modelo (fipe_id, display_name, marca_key, marca_id)
+        SELECT mo.fipe_id, mo.display_name, m.id, mo.marca_id
+        FROM modelo_old mo
+        JOIN marca m ON m.fipe_id = mo.marca_id
+        ORDER BY m.id, mo.fipe_id
+        """,
+    ),
+    # `ano_modelo` used to be keyed by the model year code alone, so only the first
+    # model crawled with a given code kept its row. The codes of the other models are
+    # recovered from their prices; the name, year and fuel only depend on the code.
+    (
+        "ano_modelo",
+        """
+        INSERT INTO ano_modelo
+            (fipe_id, modelo_key, modelo_id, display_name, ano, tipo_combustivel)
+        SELECT c.ano_modelo_id, mo.id, c.modelo_id, a.display_name, a.ano,
+            a.tipo_combustivel
+        FROM ({model_year_codes}) c
+        JOIN modelo mo ON mo.fipe_id = c.modelo_id
+        JOIN ano_modelo_old a ON a.fipe_id = c.ano_modelo_id
+        ORDER BY mo.id, c.ano_modelo_id
+        """,
+    ),
+    # Prices had no unique constraint; the latest row of a model year and month wins
+    (
+        "preco",
+        """
+        INSERT INTO preco (
+            ano_modelo_key, marca_id, modelo_id, ano_modelo_id, codigo_tipo_veiculo,
+            codigo_tabela_referencia, autenticacao, data_consulta, mes_referencia,
+            codigo_fipe_veiculo, valor, raw_data
+        )
+        SELECT a.id, p.marca_id, p.modelo_id, p.ano_modelo_id, p.codigo_tipo_veiculo,
+            p.codigo_tabela_referencia, p.autenticacao, p.data_consulta,
+            p.mes_referencia, p.codigo_fipe_veiculo, p.valor, p.raw_data
+        FROM preco_old p
+        JOIN modelo mo ON mo.fipe_id = p.modelo_id
+        JOIN ano_modelo a ON a.modelo_key = mo.id AND a.fipe_id = p.ano_modelo_id
+        WHERE p.id IN (
+            SELECT max(id)
+            FROM preco_old
+            GROUP BY modelo_id, ano_modelo_id, codigo_tabela_referencia
+        )
+        ORDER BY p.id
+        """,
+    ),
+    (
+        "preco_intervalo",
+        """
+        INSERT INTO preco_intervalo (
+            ano_modelo_key, marca_id, modelo_id, ano_modelo_id, codigo_tipo_veiculo,
+            codigo_fipe_veiculo, valor, tabela_inicio_id, tabela_fim_id, inicio, fim
+        )
+        SELECT a.id, pi.marca_id, pi.modelo_id, pi.ano_modelo_id,
+            pi.codigo_tipo_veiculo, pi.codigo_fipe_veiculo, pi.valor,
+            pi.tabela_inicio_id, pi.tabela_fim_id, pi.inicio, pi.fim
+        FROM preco_intervalo_old pi
+        JOIN modelo mo ON mo.fipe_id = pi.modelo_id
+        JOIN ano_modelo a ON a.modelo_key = mo.id AND a.fipe_id = pi.ano_modelo_id
+        ORDER BY pi.id
+        """,
+    ),
+]
+
+
+def _count(conn: Connection, table: str) -> int:
+    return conn.execute(text(f"SELECT count(*) FROM {table}")).scalar_one()
+
+
+def _needs_catalog_keys(conn: Connection) -> bool:
+    _inspector = inspect(conn)
+    return _inspector.has_table("marca") and "id" not in {
+        column["name"] for column in _inspector.get_columns("marca")
+    }
+
+
+def _migrate_catalog_keys(conn: Connection) -> None:
+    """Integer surrogate keys for `marca`, `modelo` and `ano_modelo`, composite
+    natural keys, and `*_key` columns in the tables pointing to them.
+
+    The old tables are copied aside, recreated with the new schema and filled back,
+    resolving the keys from the FIPE codes.
+    """
+    # Import the views and indexes built on the recreated tables
+    from db.models import all_models, search, views  # noqa
+
+    _inspector = inspect(conn)
+    old_tables = [table for table in _CATALOG_TABLES if _inspector.has_table(table)]
+    for table in old_tables:
+        conn.execute(text(f"CREATE TABLE {table}_old AS SELECT * FROM {table}"))
+
+    conn.execute(text(f"DROP VIEW IF EXISTS {views.DENSE_CAR_PRICES_VIEW}"))
+    for table in old_tables:
+        conn.execute(text(f"DROP TABLE {table}"))
+
+    mapper_registry.metadata.create_all(
+        conn,
+        tables=[mapper_registry.metadata.tables[table] for table in _CATALOG_TABLES],
+    )
+    model_year_codes = " UNION ".join(
+        _MODEL_YEAR_CODES[table] for table in old_tables if table in _MODEL_YEAR_CODES
+    )
+    for table, statement in _COPY_CATALOG:
+        if table in old_tables:
+            conn.execute(text(statement.format(model_year_codes=model_year_codes)))
+
+    for table in old_tables:
+        logger.info(
+            "%s: %s rows before, %s after",
+            table,
+            _count(conn, f"{table}_old"),
+            _count(conn, table),
+        )
+        conn.execute(text(f"DROP TABLE {table}_old"))
+
+
+MIGRATIONS: list[tuple[str, Callable[[Connection], bool], Callable]] = [
+    ("catalog_keys", _needs_catalog_keys, _migrate_catalog_keys),
+]
+
+
+def migrate(engine: Engine) -> list[str]:
+    """Run every pending migration, each in its own transaction.
+
+    Returns:
+        - list[str]: Names of the migrations that ran.
+    """
+    applied = []
+    for name, is_needed, run in MIGRATIONS:
+        with engine.begin() as conn:
+            if not is_needed(conn):
+                continue
+
+            logger.info("Running migration %s", name)
+            run(conn)
+            applied.append(name)
+
+    return applied
+
+
+__all__ = ["MIGRATIONS", "migrate"]
@@ -1,6 +1,26 @@
-"""Database models for the reference tables."""
-
-from sqlalchemy import JSON, Float, ForeignKey, Integer, String, SmallInteger
+"""Database models for the reference tables.
+
+Catalog rows (`marca`, `modelo`, `ano_modelo`) have an integer surrogate `id`, and
+their FIPE codes are only unique within their parent: model year codes such as
+`2019-1` repeat across every model. Tables pointing to a catalog row do it through an
+integer `*_key` column, which is what joins and indexes use; the FIPE codes are kept
+next to it in `*_id` columns for filtering and display.
+"""
+
+import datetime
+
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    SmallInteger,
+    UniqueConstraint,
+)
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from sqlalchemy.orm import Session
 from db.models.base import SQLAlchemyDeclarativeBase
@@ -31,8 +51,12 @@ class Manufacturer(SQLAlchemyDeclarativeBase):
     """Car manufacturers."""
 
     __tablename__ = "marca"
+    __table_args__ = (
+        UniqueConstraint("tipo_veiculo", "fipe_id", name="uq_marca_tipo_veiculo"),
+    )
 
-    fipe_id: Mapped[str] = mapped_column("fipe_id", String(10), primary_key=True)
+    id: Mapped[int] = mapped_column("id", Integer, primary_key=True)
+    fipe_id: Mapped[str] = mapped_column("fipe_id", String(10))
     display_name: Mapped[str] = mapped_column("display_name", String(255))
     vehicle_type_id: Mapped[int] = mapped_column("tipo_veiculo", SmallInteger)
 
@@ -43,12 +67,15 @@ class CarModel(SQLAlchemyDeclarativeBase):
     """Car models."""
 
     __tablename__ = "modelo"
+    __table_args__ = (UniqueConstraint("marca_key", "fipe_id", name="uq_modelo_marca"),)
 
-    fipe_id: Mapped[str] = mapped_column("fipe_id", String(10), primary_key=True)
+    id: Mapped[int] = mapped_column("id", Integer, primary_key=True)
+    fipe_id: Mapped[str] = mapped_column("fipe_id", String(10))
     display_name: Mapped[str] = mapped_column("display_name", String(255))
-    manufacturer_id: Mapped[str] = mapped_column(
-        "marca_id", String(10), ForeignKey("marca.fipe_id")
+    manufacturer_key: Mapped[int] = mapped_column(
+        "marca_key", Integer, ForeignKey("marca.id")
     )
+    manufacturer_id: Mapped[str] = mapped_column("marca_id", String(10))
 
     manufacturer = relationship("Manufacturer", back_populates="models", lazy="joined")
     model_years = relationship("CarModelYear", back_populates="car_model")
@@ -58,11 +85,16 @@ class CarModelYear(SQLAlchemyDeclarativeBase):
     """Car model years."""
 
     __tablename__ = "ano_modelo"
+    __table_args__ = (
+        UniqueConstraint("modelo_key", "fipe_id", name="uq_ano_modelo_modelo"),
+    )
 
-    fipe_id: Mapped[str] = mapped_column("fipe_id", String(10), primary_key=True)
-    model_id: Mapped[str] = mapped_column(
-        "modelo_id", String(10), ForeignKey("modelo.fipe_id")
+    id: Mapped[int] = mapped_column("id", Integer, primary_key=True)
+    fipe_id: Mapped[str] = mapped_column("fipe_id", String(10))
+    model_key: Mapped[int] = mapped_column(
+        "modelo_key", Integer, ForeignKey("modelo.id")
     )
+    model_id: Mapped[str] = mapped_column("modelo_id", String(10))
     display_name: Mapped[str] = mapped_column("display_name", String(255))
     year: Mapped[int] = mapped_column("ano", Integer)
     fuel_type: Mapped[int] = mapped_column("tipo_combustivel", Integer)
@@ -74,17 +106,22 @@ class CarPrice(SQLAlchemyDeclarativeBase):
     """Car prices."""
 
     __tablename__ = "preco"
+    __table_args__ = (
+        # One price per model year and month, also the index of model year lookups
+        UniqueConstraint(
+            "ano_modelo_key",
+            "codigo_tabela_referencia",
+            name="uq_preco_ano_modelo_tabela_referencia",
+        ),
+    )
 
     id: Mapped[int] = mapped_column("id", Integer, primary_key=True)
-    manufacturer_id: Mapped[str] = mapped_column(
-        "marca_id", String(10), ForeignKey("marca.fipe_id")
-    )
-    model_id: Mapped[str] = mapped_column(
-        "modelo_id", String(10), ForeignKey("modelo.fipe_id")
-    )
-    model_year_id: Mapped[str] = mapped_column(
-        "ano_modelo_id", String(10), ForeignKey("ano_modelo.fipe_id")
+    model_year_key: Mapped[int] = mapped_column(
+        "ano_modelo_key", Integer, ForeignKey("ano_modelo.id")
     )
+    manufacturer_id: Mapped[str] = mapped_column("marca_id", String(10))
+    model_id: Mapped[str] = mapped_column("modelo_id", String(10))
+    model_year_id: Mapped[str] = mapped_column("ano_modelo_id", String(10))
     vehicle_type_id: Mapped[int] = mapped_column("codigo_tipo_veiculo", Integer)
     reference_table_id: Mapped[str] = mapped_column(
         "codigo_tabela_referencia", String(10), ForeignKey("tabela_referencia.fipe_id")
@@ -96,10 +133,101 @@ class CarPrice(SQLAlchemyDeclarativeBase):
     value: Mapped[float] = mapped_column("valor", Float)
     raw_data: Mapped[dict] = mapped_column("raw_data", JSON)
 
-    manufacturer = relationship("Manufacturer")
-    model = relationship("CarModel")
     model_year = relationship("CarModelYear")
     reference_table = relationship("ReferenceTable")
 
 
-__all__ = ["ReferenceTable", "Manufacturer", "CarModel", "CarModelYear", "CarPrice"]
+class CarPriceInterval(SQLAlchemyDeclarativeBase):
+    """Car prices stored only when they change.
+
+    Each row is a price that stayed the same from the reference table `valid_from_id`
+    to `valid_to_id`, both included. `valid_from` and `valid_to` are the month
+    ordinals (`year * 12 + month - 1`) of those reference tables.
+    """
+
+    __tablename__ = "preco_intervalo"
+    __table_args__ = (
+        Index("ix_preco_intervalo_ano_modelo_key", "ano_modelo_key", "inicio"),
+    )
+
+    id: Mapped[int] = mapped_column("id", Integer, primary_key=True)
+    model_year_key: Mapped[int] = mapped_column(
+        "ano_modelo_key", Integer, ForeignKey("ano_modelo.id")
+    )
+    manufacturer_id: Mapped[str] = mapped_column("marca_id", String(10))
+    model_id: Mapped[str] = mapped_column("modelo_id", String(10))
+    model_year_id: Mapped[str] = mapped_column("ano_modelo_id", String(10))
+    vehicle_type_id: Mapped[int] = mapped_column("codigo_tipo_veiculo", Integer)
+    fipe_vehicle_code: Mapped[str] = mapped_column("codigo_fipe_veiculo", String(10))
+    value: Mapped[float] = mapped_column("valor", Float)
+    valid_from_id: Mapped[str] = mapped_column(
+        "tabela_inicio_id", String(10), ForeignKey("tabela_referencia.fipe_id")
+    )
+    valid_to_id: Mapped[str] = mapped_column(
+        "tabela_fim_id", String(10), ForeignKey("tabela_referencia.fipe_id")
+    )
+    valid_from: Mapped[int] = mapped_column("inicio", Integer)
+    valid_to: Mapped[int] = mapped_column("fim", Integer)
+
+
+class CarPriceChange(SQLAlchemyDeclarativeBase):
+    """Month over month price differences, see `analytics.diff`.
+
+    Only model years that appeared (`change_type` 1), disappeared (2) or changed
+    price (3) between `previous_reference_table_id` and `reference_table_id` are
+    stored; unchanged prices are left out.
+    """
+
+    __tablename__ = "preco_variacao"
+    __table_args__ = (
+        Index(
+            "ix_preco_variacao_tabela_referencia",
+            "tabela_referencia_id",
+            "tipo_variacao",
+        ),
+    )
+
+    id: Mapped[int] = mapped_column("id", Integer, primary_key=True)
+    reference_table_id: Mapped[str] = mapped_column(
+        "tabela_referencia_id", String(10), ForeignKey("tabela_referencia.fipe_id")
+    )
+    previous_reference_table_id: Mapped[str] = mapped_column(
+        "tabela_anterior_id", String(10), ForeignKey("tabela_referencia.fipe_id")
+    )
+    model_id: Mapped[str] = mapped_column("modelo_id", String(10))
+    model_year_id: Mapped[str] = mapped_column("ano_modelo_id", String(10))
+    change_type: Mapped[int] = mapped_column("tipo_variacao", SmallInteger)
+    previous_value: Mapped[float | None] = mapped_column("valor_anterior", Float)
+    value: Mapped[float | None] = mapped_column("valor", Float)
+    change_percent: Mapped[float | None] = mapped_column("variacao_percentual", Float)
+
+
+class ArchivedReferenceTable(SQLAlchemyDeclarativeBase):
+    """Reference tables whose prices were moved out of `preco` into Parquet files,
+    see `db.archive`."""
+
+    __tablename__ = "preco_arquivo"
+
+    reference_table_id: Mapped[str] = mapped_column(
+        "tabela_referencia_id",
+        String(10),
+        ForeignKey("tabela_referencia.fipe_id"),
+        primary_key=True,
+    )
+    path: Mapped[str] = mapped_column("caminho", String(255))
+    rows: Mapped[int] = mapped_column("linhas", Integer)
+    size_bytes: Mapped[int] = mapped_column("tamanho_bytes", BigInteger)
+    sha256: Mapped[str] = mapped_column("sha256", String(64))
+    archived_at: Mapped[datetime.datetime] = mapped_column("arquivado_em", DateTime)
+
+
+__all__ = [
+    "ReferenceTable",
+    "Manufacturer",
+    "CarModel",
+    "CarModelYear",
+    "CarPrice",
+    "CarPriceInterval",
+    "CarPriceChange",
+    "ArchivedReferenceTable",
+]
@@ -0,0 +1,35 @@
+"""Postgres trigram indexes for name search, created right after the tables by
+`create_db`.
+
+`unaccent` is not immutable, so it cannot be used in an index expression directly;
+`f_unaccent` wraps it with the dictionary pinned, which makes it safe to index.
+"""
+
+from sqlalchemy import DDL, event
+
+from db.models.base import mapper_registry
+
+_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """
+    CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_marca_display_name_trgm
+    ON marca USING gin (f_unaccent(lower(display_name)) gin_trgm_ops)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_modelo_display_name_trgm
+    ON modelo USING gin (f_unaccent(lower(display_name)) gin_trgm_ops)
+    """,
+]
+
+for _statement in _SEARCH_DDL:
+    event.listen(
+        mapper_registry.metadata,
+        "after_create",
+        DDL(_statement).execute_if(dialect="postgresql"),
+    )
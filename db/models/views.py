@@ -0,0 +1,49 @@
+"""Database views, created right after the tables by `create_db`."""
+
+from sqlalchemy import DDL, event
+
+from db.models.base import mapper_registry
+
+DENSE_CAR_PRICES_VIEW = "preco_mensal"
+
+# One row per (model year x reference table) rebuilt from `preco_intervalo`, with the
+# same shape as the matching columns of `preco`
+_DENSE_CAR_PRICES_SELECT = """
+SELECT
+    pi.ano_modelo_key,
+    pi.marca_id,
+    pi.modelo_id,
+    pi.ano_modelo_id,
+    pi.codigo_tipo_veiculo,
+    pi.codigo_fipe_veiculo,
+    tr.fipe_id AS codigo_tabela_referencia,
+    tr.ano,
+    tr.mes,
+    pi.valor
+FROM preco_intervalo pi
+JOIN tabela_referencia tr
+    ON tr.ano * 12 + tr.mes - 1 BETWEEN pi.inicio AND pi.fim
+"""
+
+event.listen(
+    mapper_registry.metadata,
+    "after_create",
+    DDL(
+        f"CREATE OR REPLACE VIEW {DENSE_CAR_PRICES_VIEW} AS {_DENSE_CAR_PRICES_SELECT}"
+    ).execute_if(dialect="postgresql"),
+)
+event.listen(
+    mapper_registry.metadata,
+    "after_create",
+    DDL(
+        f"CREATE VIEW IF NOT EXISTS {DENSE_CAR_PRICES_VIEW} AS {_DENSE_CAR_PRICES_SELECT}"
+    ).execute_if(dialect="sqlite"),
+)
+event.listen(
+    mapper_registry.metadata,
+    "before_drop",
+    DDL(f"DROP VIEW IF EXISTS {DENSE_CAR_PRICES_VIEW}"),
+)
+
+
+__all__ = ["DENSE_CAR_PRICES_VIEW"]
@@ -0,0 +1,185 @@
+"""Lightweight read path on top of SQLAlchemy Core.
+
+The ORM models eager-join their parents (`lazy="joined"`) and every row read through
+them goes through the identity map. The functions here run plain Core `select()`
+statements instead, returning named tuples (`Row`) whose fields are the ORM attribute
+names, or whole columns as lists when `as_columns` is set. Use them wherever entities
+are not going to be modified: crawler bookkeeping, exports and analytics.
+
+Every function accepts either a `Connection` or a `Session`.
+"""
+
+from typing import Iterable, Sequence
+
+from sqlalchemy import Connection, Label, Select, inspect, select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from db.models.all_models import (
+    CarModel,
+    CarModelYear,
+    CarPrice,
+    Manufacturer,
+    ReferenceTable,
+)
+
+# Columns selected by default, `raw_data` is only read when asked for
+CAR_PRICE_COLUMNS = (
+    "id",
+    "manufacturer_id",
+    "model_id",
+    "model_year_id",
+    "vehicle_type_id",
+    "reference_table_id",
+    "fipe_vehicle_code",
+    "value",
+)
+
+
+def columns_of(entity: type, keys: Iterable[str] | None = None) -> list[Label]:
+    """Core columns of a mapped class, labelled with their attribute names."""
+    _columns = inspect(entity).columns
+    return [_columns[key].label(key) for key in (keys or _columns.keys())]
+
+
+def fetch(
+    db_conn: Connection | Session,
+    stmt: Select,
+    as_columns: bool = False,
+) -> Sequence[Row] | dict[str, list]:
+    """Run `stmt` and return its rows, or a `{column: values}` dict with `as_columns`."""
+    result = db_conn.execute(stmt)
+    if not as_columns:
+        return result.all()
+
+    keys = list(result.keys())
+    rows = result.all()
+    if not rows:
+        return {key: [] for key in keys}
+
+    return {key: list(values) for key, values in zip(keys, zip(*rows))}
+
+
+def read_reference_tables(
+    db_conn: Connection | Session,
+    year_gte: int | None = None,
+    year_lte: int | None = None,
+    descending: bool = False,
+    as_columns: bool = False,
+) -> Sequence[Row] | dict[str, list]:
+    """Reference tables in chronological order (or the reverse, with `descending`)."""
+    c = inspect(ReferenceTable).columns
+    stmt = select(*columns_of(ReferenceTable))
+
+    if year_gte is not None:
+        stmt = stmt.where(c.year >= year_gte)
+
+    if year_lte is not None:
+        stmt = stmt.where(c.year <= year_lte)
+
+    if descending:
+        stmt = stmt.order_by(c.year.desc(), c.month.desc())
+    else:
+        stmt = stmt.order_by(c.year, c.month)
+
+    return fetch(db_conn, stmt, as_columns)
+
+
+def read_manufacturers(
+    db_conn: Connection | Session,
+    vehicle_type_id: int | None = None,
+    as_columns: bool = False,
+) -> Sequence[Row] | dict[str, list]:
+    c = inspect(Manufacturer).columns
+    stmt = select(*columns_of(Manufacturer)).order_by(c.fipe_id)
+
+    if vehicle_type_id is not None:
+        stmt = stmt.where(c.vehicle_type_id == vehicle_type_id)
+
+    return fetch(db_conn, stmt, as_columns)
+
+
+def read_car_models(
+    db_conn: Connection | Session,
+    manufacturer_id: str | None = None,
+    as_columns: bool = False,
+) -> Sequence[Row] | dict[str, list]:
+    c = inspect(CarModel).columns
+    stmt = select(*columns_of(CarModel)).order_by(c.fipe_id)
+
+    if manufacturer_id is not None:
+        stmt = stmt.where(c.manufacturer_id == manufacturer_id)
+
+    return fetch(db_conn, stmt, as_columns)
+
+
+def read_car_models_years(
+    db_conn: Connection | Session,
+    year_gte: int | None = None,
+    model_id: str | None = None,
+    with_manufacturer: bool = False,
+    as_columns: bool = False,
+) -> Sequence[Row] | dict[str, list]:
+    """Car model years, without building `CarModelYear` or `CarModel` entities.
+
+    Args:
+        - db_conn (Connection | Session): Connection or session to read from.
+        - year_gte (int | None): Only model years from this year on.
+        - model_id (str | None): Only model years of this car model.
+        - with_manufacturer (bool): Also select the `manufacturer_id` of the model.
+        - as_columns (bool): Return a `{column: values}` dict instead of rows.
+    """
+    c = inspect(CarModelYear).columns
+    stmt = select(*columns_of(CarModelYear))
+
+    if with_manufacturer:
+        model_c = inspect(CarModel).columns
+        stmt = stmt.add_columns(model_c.manufacturer_id.label("manufacturer_id")).join(
+            CarModel.__table__, c.model_key == model_c.id
+        )
+
+    if year_gte is not None:
+        stmt = stmt.where(c.year >= year_gte)
+
+    if model_id is not None:
+        stmt = stmt.where(c.model_id == model_id)
+
+    stmt = stmt.order_by(c.model_key, c.fipe_id)
+
+    return fetch(db_conn, stmt, as_columns)
+
+
+def read_car_prices(
+    db_conn: Connection | Session,
+    reference_table_id: str | None = None,
+    model_year_id: str | None = None,
+    fipe_vehicle_code: str | None = None,
+    columns: Iterable[str] = CAR_PRICE_COLUMNS,
+    as_columns: bool = False,
+) -> Sequence[Row] | dict[str, list]:
+    """Car prices, only with the requested `columns` (see `CAR_PRICE_COLUMNS`)."""
+    c = inspect(CarPrice).columns
+    stmt = select(*columns_of(CarPrice, columns)).order_by(c.id)
+
+    if reference_table_id is not None:
+        stmt = stmt.where(c.reference_table_id == reference_table_id)
+
+    if model_year_id is not None:
+        stmt = stmt.where(c.model_year_id == model_year_id)
+
+    if fipe_vehicle_code is not None:
+        stmt = stmt.where(c.fipe_vehicle_code == fipe_vehicle_code)
+
+    return fetch(db_conn, stmt, as_columns)
+
+
+__all__ = [
+    "CAR_PRICE_COLUMNS",
+    "columns_of",
+    "fetch",
+    "read_reference_tables",
+    "read_manufacturers",
+    "read_car_models",
+    "read_car_models_years",
+    "read_car_prices",
+]
@@ -1,6 +1,26 @@
-from db.models.all_models import CarModelYear, ReferenceTable, Manufacturer
+from typing import Any, Iterator
 
-from sqlalchemy.orm import Session
+from db import archive as db_archive
+from db.models.all_models import (
+    CarModel,
+    CarModelYear,
+    CarPrice,
+    CarPriceInterval,
+    ReferenceTable,
+    Manufacturer,
+)
+
+from sqlalchemy import (
+    ColumnElement,
+    String,
+    bindparam,
+    func,
+    inspect,
+    select,
+    tuple_,
+)
+from sqlalchemy.engine import Row, RowMapping
+from sqlalchemy.orm import InstrumentedAttribute, Session, lazyload
 
 
 def list_reference_tables(db_session: Session, **kwargs) -> list[ReferenceTable]:
@@ -63,6 +83,560 @@ def list_car_models_years(
     return car_models_years_qs.all()
 
 
+def iter_reference_tables(
+    db_session: Session,
+    page_size: int = 10_000,
+    batch_size: int = 1_000,
+    as_tuples: bool = False,
+    **kwargs,
+) -> Iterator[ReferenceTable | Row]:
+    """Streams reference tables ordered by year and month.
+
+    Accepts the same filters as `list_reference_tables` (`year`, `year_gte`, `year_lte`
+    and `month`) and the streaming options of `iter_car_models_years`. `descending`
+    walks from the most recent reference table back.
+    """
+    filters = []
+    if year := kwargs.get("year"):
+        filters.append(ReferenceTable.year == year)
+
+    if year_gte := kwargs.get("year_gte"):
+        filters.append(ReferenceTable.year >= year_gte)
+
+    if year_lte := kwargs.get("year_lte"):
+        filters.append(ReferenceTable.year <= year_lte)
+
+    if month := kwargs.get("month"):
+        filters.append(ReferenceTable.month == month)
+
+    return _iter_keyset(
+        db_session,
+        ReferenceTable,
+        filters,
+        keyset=(ReferenceTable.year, ReferenceTable.month, ReferenceTable.fipe_id),
+        page_size=page_size,
+        batch_size=batch_size,
+        as_tuples=as_tuples,
+        descending=kwargs.get("descending", False),
+    )
+
+
+def iter_car_models_years(
+    db_session: Session,
+    page_size: int = 10_000,
+    batch_size: int = 1_000,
+    as_tuples: bool = False,
+    columns: list[str] | None = None,
+    **kwargs,
+) -> Iterator[CarModelYear | Row]:
+    """Streaming version of `list_car_models_years`.
+
+    Rows are read in keyset-paginated pages of `page_size` (no OFFSET scans) and each
+    page goes through a server-side cursor in chunks of `batch_size`, so memory stays
+    bounded no matter how many model years match. The `car_model` relationship is not
+    eager-joined here; it is only loaded if accessed.
+
+    Args:
+        - db_session (Session): SQLAlchemy session.
+        - page_size (int): Rows per keyset page, ie. per query.
+        - batch_size (int): Rows fetched from the cursor at a time.
+        - as_tuples (bool): Yield plain rows instead of `CarModelYear` entities.
+        - columns (list[str] | None): Attributes to select when `as_tuples` is set.
+            Defaults to every column.
+
+    Yields:
+        - CarModelYear | Row: Car model years, ordered by id.
+    """
+    filters = []
+    if year_gte := kwargs.get("year_gte"):
+        filters.append(CarModelYear.year >= year_gte)
+
+    if model_id := kwargs.get("model_id"):
+        filters.append(CarModelYear.model_id == model_id)
+
+    return _iter_keyset(
+        db_session,
+        CarModelYear,
+        filters,
+        keyset=(CarModelYear.id,),
+        page_size=page_size,
+        batch_size=batch_size,
+        as_tuples=as_tuples,
+        columns=columns,
+    )
+
+
+def iter_car_prices(
+    db_session: Session,
+    page_size: int = 10_000,
+    batch_size: int = 1_000,
+    as_tuples: bool = False,
+    columns: list[str] | None = None,
+    **kwargs,
+) -> Iterator[CarPrice | Row]:
+    """Streams car prices ordered by id.
+
+    Filters by `reference_table_id`, `manufacturer_id`, `model_id`, `model_year_id`
+    and `fipe_vehicle_code`. With `as_tuples`, pass `columns` to leave heavy columns
+    such as `raw_data` out of the query. See `iter_car_models_years` for the
+    streaming options.
+    """
+    filters = [
+        getattr(CarPrice, attr) == kwargs[attr]
+        for attr in (
+            "reference_table_id",
+            "manufacturer_id",
+            "model_id",
+            "model_year_id",
+            "fipe_vehicle_code",
+        )
+        if kwargs.get(attr) is not None
+    ]
+
+    return _iter_keyset(
+        db_session,
+        CarPrice,
+        filters,
+        keyset=(CarPrice.id,),
+        page_size=page_size,
+        batch_size=batch_size,
+        as_tuples=as_tuples,
+        columns=columns,
+    )
+
+
+def iter_all_car_prices(
+    db_session: Session,
+    columns: list[str],
+    page_size: int = 10_000,
+    batch_size: int = 1_000,
+    **kwargs,
+) -> Iterator[tuple]:
+    """Streams car prices as tuples of `columns`, from `preco` and from the archive.
+
+    Archived reference tables no longer have rows in `preco` (see `db.archive`), so
+    hot prices are read first, then the archived ones, without duplicates. Accepts
+    the filters of `iter_car_prices`.
+    """
+    yield from iter_car_prices(
+        db_session,
+        page_size=page_size,
+        batch_size=batch_size,
+        as_tuples=True,
+        columns=columns,
+        **kwargs,
+    )
+    yield from db_archive.iter_archived_car_prices(
+        db_session, columns, batch_size=page_size, **kwargs
+    )
+
+
+def _iter_keyset(
+    db_session: Session,
+    entity: type,
+    filters: list[ColumnElement[bool]],
+    keyset: tuple[InstrumentedAttribute, ...],
+    page_size: int,
+    batch_size: int,
+    as_tuples: bool = False,
+    columns: list[str] | None = None,
+    descending: bool = False,
+) -> Iterator[Any]:
+    """Yields every row of `entity` matching `filters`, one keyset page at a time.
+
+    Each page is `WHERE (keyset) > (last key seen) ORDER BY keyset LIMIT page_size`,
+    which keeps every query an index range scan, and is fetched through a server-side
+    cursor (`yield_per`) in chunks of `batch_size`.
+    """
+    _keys = [attr.key for attr in keyset]
+
+    if as_tuples:
+        _columns = list(columns or [attr.key for attr in inspect(entity).column_attrs])
+        # Keyset columns are always selected, they are needed to find the next page
+        _columns += [key for key in _keys if key not in _columns]
+        base_stmt = select(*[getattr(entity, key) for key in _columns])
+    else:
+        base_stmt = select(entity).options(lazyload("*"))
+
+    _order_by = [attr.desc() if descending else attr for attr in keyset]
+    base_stmt = base_stmt.where(*filters).order_by(*_order_by).limit(page_size)
+
+    last_key = None
+    while True:
+        stmt = base_stmt
+        if last_key is not None:
+            _keyset = tuple_(*keyset) if len(keyset) > 1 else keyset[0]
+            _last = tuple_(*last_key) if len(keyset) > 1 else last_key[0]
+            stmt = stmt.where(_keyset < _last if descending else _keyset > _last)
+
+        result = db_session.execute(stmt.execution_options(yield_per=batch_size))
+        if not as_tuples:
+            result = result.scalars()
+
+        _count = 0
+        row = None
+        for row in result:
+            _count += 1
+            yield row
+
+        if _count < page_size:
+            return
+
+        last_key = tuple(getattr(row, key) for key in _keys)
+
+
+def get_latest_reference_table_id(db_session: Session) -> str | None:
+    return db_session.execute(_LATEST_REFERENCE_TABLE_ID_STMT).scalar()
+
+
+def get_latest_car_price_id(db_session: Session) -> int | None:
+    """Highest `preco.id`, it grows with every price a crawl stores."""
+    return db_session.execute(_LATEST_CAR_PRICE_ID_STMT).scalar()
+
+
+def list_manufacturers(
+    db_session: Session, vehicle_type_id: int = 1
+) -> list[RowMapping]:
+    return (
+        db_session.execute(_MANUFACTURERS_STMT, {"vehicle_type_id": vehicle_type_id})
+        .mappings()
+        .all()
+    )
+
+
+def list_car_models(db_session: Session, manufacturer_id: str) -> list[RowMapping]:
+    return (
+        db_session.execute(_CAR_MODELS_STMT, {"manufacturer_id": manufacturer_id})
+        .mappings()
+        .all()
+    )
+
+
+def search_car_models(
+    db_session: Session, query: str, limit: int = 10
+) -> list[RowMapping]:
+    """Car models whose names look like `query`, best match first.
+
+    Postgres only: accent-insensitive trigram matching (`pg_trgm` word similarity),
+    served by the indexes created in `db.models.search`.
+    """
+    return (
+        db_session.execute(_SEARCH_CAR_MODELS_STMT, {"query": query, "limit": limit})
+        .mappings()
+        .all()
+    )
+
+
+def get_car_price_by_fipe_code(
+    db_session: Session,
+    fipe_vehicle_code: str,
+    model_year: int,
+) -> RowMapping | None:
+    """Returns the price of the most recent reference table for a FIPE code and year.
+
+    Args:
+        - db_session (Session): SQLAlchemy session.
+        - fipe_vehicle_code (str): FIPE vehicle code, ex. "003376-6".
+        - model_year (int): Model year, `32000` for zero km vehicles.
+
+    Returns:
+        - RowMapping | None: The price row, or None when there is no price.
+    """
+    price = (
+        db_session.execute(
+            _LATEST_PRICE_STMT,
+            {"fipe_vehicle_code": fipe_vehicle_code, "model_year": model_year},
+        )
+        .mappings()
+        .first()
+    )
+    if price is not None:
+        return price
+
+    # Every price of the vehicle may have been archived
+    archived = _list_archived_prices(db_session, [(fipe_vehicle_code, model_year)])
+    return archived[0] if archived else None
+
+
+def list_car_price_history(
+    db_session: Session,
+    fipe_vehicle_code: str,
+    model_year: int,
+) -> list[RowMapping]:
+    """Returns every price of a FIPE code and year, archived ones included, most
+    recent first."""
+    history = (
+        db_session.execute(
+            _PRICE_HISTORY_STMT,
+            {"fipe_vehicle_code": fipe_vehicle_code, "model_year": model_year},
+        )
+        .mappings()
+        .all()
+    )
+    archived = _list_archived_prices(db_session, [(fipe_vehicle_code, model_year)])
+    if not archived:
+        return history
+
+    return sorted(
+        [*history, *archived],
+        key=lambda price: (price["reference_year"], price["reference_month"]),
+        reverse=True,
+    )
+
+
+def _list_archived_prices(
+    db_session: Session,
+    lookups: list[tuple[str, int]],
+) -> list[dict]:
+    """Archived prices of (FIPE code, model year) pairs, most recent first.
+
+    Same keys as the rows of `_price_columns`, the model year and the reference
+    table are read from the catalog.
+    """
+    rows = list(
+        db_archive.iter_archived_car_prices(
+            db_session,
+            columns=[
+                "model_year_key",
+                "fipe_vehicle_code",
+                "manufacturer_id",
+                "model_id",
+                "model_year_id",
+                "reference_table_id",
+                "value",
+            ],
+            fipe_vehicle_code=sorted({code for code, _ in lookups}),
+        )
+    )
+    if not rows:
+        return []
+
+    model_years = {
+        row.id: row
+        for row in db_session.execute(
+            select(CarModelYear.id, CarModelYear.year, CarModelYear.fuel_type).where(
+                CarModelYear.id.in_({row[0] for row in rows if row[0] is not None})
+            )
+        )
+    }
+    reference_tables = {
+        row.fipe_id: row
+        for row in db_session.execute(
+            select(ReferenceTable.fipe_id, ReferenceTable.year, ReferenceTable.month)
+        )
+    }
+
+    _lookups = {(code, int(year)) for code, year in lookups}
+    prices = []
+    for (
+        key,
+        code,
+        manufacturer_id,
+        model_id,
+        model_year_id,
+        reference_table_id,
+        value,
+    ) in rows:
+        model_year = model_years.get(key)
+        if model_year is None or (code, model_year.year) not in _lookups:
+            continue
+
+        reference_table = reference_tables[reference_table_id]
+        prices.append(
+            {
+                "fipe_vehicle_code": code,
+                "model_year": model_year.year,
+                "fuel_type": model_year.fuel_type,
+                "manufacturer_id": manufacturer_id,
+                "model_id": model_id,
+                "model_year_id": model_year_id,
+                "reference_table_id": reference_table_id,
+                "reference_year": reference_table.year,
+                "reference_month": reference_table.month,
+                "value": value,
+            }
+        )
+
+    return sorted(
+        prices,
+        key=lambda price: (price["reference_year"], price["reference_month"]),
+        reverse=True,
+    )
+
+
+def list_latest_car_prices_by_fipe_codes(
+    db_session: Session,
+    lookups: list[tuple[str, int]],
+) -> list[RowMapping]:
+    """Batch version of `get_car_price_by_fipe_code`, in a single round trip.
+
+    Args:
+        - db_session (Session): SQLAlchemy session.
+        - lookups (list[tuple[str, int]]): (FIPE vehicle code, model year) pairs.
+
+    Returns:
+        - list[RowMapping]: The most recent price of each pair that has one.
+    """
+    if not lookups:
+        return []
+
+    _ranked = (
+        _price_columns()
+        .add_columns(
+            func.row_number()
+            .over(
+                partition_by=(CarPrice.fipe_vehicle_code, CarModelYear.year),
+                order_by=(ReferenceTable.year.desc(), ReferenceTable.month.desc()),
+            )
+            .label("rank")
+        )
+        .where(
+            tuple_(CarPrice.fipe_vehicle_code, CarModelYear.year).in_(
+                [(code, int(year)) for code, year in lookups]
+            )
+        )
+        .subquery()
+    )
+    stmt = select(*[c for c in _ranked.c if c.name != "rank"]).where(
+        _ranked.c.rank == 1
+    )
+
+    prices = list(db_session.execute(stmt).mappings().all())
+
+    # Pairs without a price in `preco` may still have archived ones
+    _found = {(price["fipe_vehicle_code"], price["model_year"]) for price in prices}
+    _missing = [
+        (code, int(year)) for code, year in lookups if (code, int(year)) not in _found
+    ]
+    if _missing:
+        for price in _list_archived_prices(db_session, _missing):
+            _lookup = (price["fipe_vehicle_code"], price["model_year"])
+            if _lookup not in _found:
+                _found.add(_lookup)
+                prices.append(price)
+
+    return prices
+
+
+def list_car_price_series(
+    db_session: Session,
+    model_id: str,
+    model_year_id: str,
+) -> list[RowMapping]:
+    """Dense monthly prices of a model year rebuilt from `preco_intervalo`.
+
+    Same rows as the `preco_mensal` view, one per reference table in every stored
+    validity range, oldest first.
+    """
+    return (
+        db_session.execute(
+            _CAR_PRICE_SERIES_STMT,
+            {"model_id": model_id, "model_year_id": model_year_id},
+        )
+        .mappings()
+        .all()
+    )
+
+
+def _price_columns():
+    return (
+        select(
+            CarPrice.fipe_vehicle_code,
+            CarModelYear.year.label("model_year"),
+            CarModelYear.fuel_type,
+            CarPrice.manufacturer_id,
+            CarPrice.model_id,
+            CarPrice.model_year_id,
+            CarPrice.reference_table_id,
+            ReferenceTable.year.label("reference_year"),
+            ReferenceTable.month.label("reference_month"),
+            CarPrice.value,
+        )
+        .join(CarModelYear, CarPrice.model_year_key == CarModelYear.id)
+        .join(ReferenceTable, CarPrice.reference_table_id == ReferenceTable.fipe_id)
+    )
+
+
+# Statements are built once and reused, so SQLAlchemy compiles each of them a single
+# time and psycopg can turn them into server-side prepared statements
+_LATEST_REFERENCE_TABLE_ID_STMT = (
+    select(ReferenceTable.fipe_id)
+    .order_by(ReferenceTable.year.desc(), ReferenceTable.month.desc())
+    .limit(1)
+)
+
+_LATEST_CAR_PRICE_ID_STMT = select(func.max(CarPrice.id))
+
+_MANUFACTURERS_STMT = (
+    select(
+        Manufacturer.fipe_id,
+        Manufacturer.display_name,
+        Manufacturer.vehicle_type_id,
+    )
+    .where(Manufacturer.vehicle_type_id == bindparam("vehicle_type_id"))
+    .order_by(Manufacturer.display_name)
+)
+
+_CAR_MODELS_STMT = (
+    select(CarModel.fipe_id, CarModel.display_name, CarModel.manufacturer_id)
+    .where(CarModel.manufacturer_id == bindparam("manufacturer_id"))
+    .order_by(CarModel.display_name)
+)
+
+_SEARCH_QUERY = func.f_unaccent(func.lower(bindparam("query", type_=String)))
+_SEARCH_NAME = func.f_unaccent(func.lower(CarModel.display_name))
+_SEARCH_CAR_MODELS_STMT = (
+    select(
+        CarModel.fipe_id,
+        CarModel.display_name,
+        CarModel.manufacturer_id,
+        Manufacturer.display_name.label("manufacturer_name"),
+        func.word_similarity(_SEARCH_QUERY, _SEARCH_NAME).label("score"),
+    )
+    .join(Manufacturer, Manufacturer.id == CarModel.manufacturer_key)
+    .where(_SEARCH_QUERY.op("<%")(_SEARCH_NAME))
+    .order_by(
+        func.word_similarity(_SEARCH_QUERY, _SEARCH_NAME).desc(),
+        CarModel.display_name,
+    )
+    .limit(bindparam("limit"))
+)
+
+_PRICE_HISTORY_STMT = (
+    _price_columns()
+    .where(
+        CarPrice.fipe_vehicle_code == bindparam("fipe_vehicle_code"),
+        CarModelYear.year == bindparam("model_year"),
+    )
+    .order_by(ReferenceTable.year.desc(), ReferenceTable.month.desc())
+)
+
+_LATEST_PRICE_STMT = _PRICE_HISTORY_STMT.limit(1)
+
+_REFERENCE_TABLE_ORDINAL = ReferenceTable.year * 12 + ReferenceTable.month - 1
+
+_CAR_PRICE_SERIES_STMT = (
+    select(
+        ReferenceTable.fipe_id.label("reference_table_id"),
+        ReferenceTable.year,
+        ReferenceTable.month,
+        CarPriceInterval.value,
+    )
+    .join(
+        CarPriceInterval,
+        _REFERENCE_TABLE_ORDINAL.between(
+            CarPriceInterval.valid_from, CarPriceInterval.valid_to
+        ),
+    )
+    .join(CarModelYear, CarModelYear.id == CarPriceInterval.model_year_key)
+    .where(
+        CarModelYear.model_id == bindparam("model_id"),
+        CarModelYear.fipe_id == bindparam("model_year_id"),
+    )
+    .order_by(ReferenceTable.year, ReferenceTable.month)
+)
+
+
 """Cars must have a price for every month since the car was produced.
 
 When the car starts being produced, it will receive the year `32000` in the
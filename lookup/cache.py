@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class ResponseCache:
+    """Thread-safe LRU cache tied to a data version.
+
+    Entries are only valid for the `version` they were stored under. Moving the cache
+    to another version (ex. a new reference table landed) drops every entry at once.
+    """
+
+    def __init__(self, maxsize: int = 100_000) -> None:
+        self.maxsize = maxsize
+        self.version: Hashable = None
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, version: Hashable = None) -> None:
+        """Store `value`, unless it was read under a `version` that is now stale."""
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def set_version(self, version: Hashable) -> bool:
+        """Move the cache to `version`, clearing it if the version changed.
+
+        Returns:
+            - bool: Whether the cache was invalidated.
+        """
+        with self._lock:
+            if version == self.version:
+                return False
+
+            self.version = version
+            self._entries.clear()
+            return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+__all__ = ["ResponseCache"]
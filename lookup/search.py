@@ -0,0 +1,233 @@
+"""In-memory typeahead search over manufacturer and car model names.
+
+Names are normalized (lowercase, accents and punctuation stripped) and split into
+trigrams, and an inverted index maps each trigram to the names containing it. A query
+only touches the postings of its own trigrams, so results come back in well under a
+millisecond for the few thousand names FIPE has, typos included:
+
+    index.search("fusion titaniun 2.0")[0]["display_name"]
+    # 'Fusion Titanium 2.0 GTDI Eco. Awd Aut.'
+
+Results are ranked by the share of the query trigrams found in the name, then by how
+close the name length is to the query (Jaccard similarity), then by whether the name
+starts with the query.
+"""
+
+import math
+import re
+import unicodedata
+from array import array
+from typing import Literal, NamedTuple
+
+import numpy as np
+from sqlalchemy import Connection
+from sqlalchemy.orm import Session
+
+from db import readers as db_readers
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase, accent-free, single spaced `text`: "Citroën C4 (Picasso)" ->
+    "citroen c4 picasso"."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return _NON_ALNUM.sub(" ", stripped).strip()
+
+
+def trigrams(normalized: str) -> set[str]:
+    """Trigrams of every word, padded like Postgres `pg_trgm` ("  c", " ci", ...)."""
+    _trigrams = set()
+    for word in normalized.split():
+        padded = f"  {word} "
+        _trigrams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+
+    return _trigrams
+
+
+class SearchDocument(NamedTuple):
+    kind: Literal["manufacturer", "model"]
+    fipe_id: str
+    display_name: str
+    manufacturer_id: str
+    manufacturer_name: str
+    normalized: str
+    normalized_name: str
+    trigram_count: int
+
+
+class SearchIndex:
+    """Trigram inverted index of manufacturer and car model names.
+
+    Car models are indexed with their manufacturer name in front, so both "fusion"
+    and "ford fusion" find the Ford Fusion.
+
+    Args:
+        - min_score (float): Minimum share of the query trigrams a name must contain.
+    """
+
+    def __init__(self, min_score: float = 0.5) -> None:
+        self.min_score = min_score
+
+        self._documents: list[SearchDocument] = []
+        self._postings: dict[str, array] = {}
+
+        # Per document arrays used to score every candidate at once, rebuilt after adds
+        self._trigram_counts: np.ndarray | None = None
+        self._is_model: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add(
+        self,
+        kind: Literal["manufacturer", "model"],
+        fipe_id: str,
+        display_name: str,
+        manufacturer_id: str,
+        manufacturer_name: str,
+    ) -> None:
+        normalized_name = normalize(display_name)
+        if kind == "model":
+            normalized = f"{normalize(manufacturer_name)} {normalized_name}".strip()
+        else:
+            normalized = normalized_name
+
+        _trigrams = trigrams(normalized)
+        document_id = len(self._documents)
+        self._documents.append(
+            SearchDocument(
+                kind,
+                fipe_id,
+                display_name,
+                manufacturer_id,
+                manufacturer_name,
+                normalized,
+                normalized_name,
+                len(_trigrams),
+            )
+        )
+
+        for trigram in _trigrams:
+            postings = self._postings.get(trigram)
+            if postings is None:
+                postings = self._postings[trigram] = array("I")
+            postings.append(document_id)
+
+        self._trigram_counts = None
+
+    def _freeze(self) -> None:
+        self._trigram_counts = np.fromiter(
+            (document.trigram_count for document in self._documents),
+            dtype=np.int32,
+            count=len(self._documents),
+        )
+        self._is_model = np.fromiter(
+            (document.kind == "model" for document in self._documents),
+            dtype=bool,
+            count=len(self._documents),
+        )
+
+    def search(
+        self,
+        query: str,
+        limit: int = 10,
+        kind: Literal["manufacturer", "model"] | None = None,
+    ) -> list[dict]:
+        normalized = normalize(query)
+        query_trigrams = trigrams(normalized)
+        if not query_trigrams:
+            return []
+
+        if self._trigram_counts is None:
+            self._freeze()
+
+        postings = [
+            np.frombuffer(self._postings[trigram], dtype=np.uint32)
+            for trigram in query_trigrams
+            if trigram in self._postings
+        ]
+        if not postings:
+            return []
+
+        # Number of query trigrams found in each document
+        shared = np.bincount(np.concatenate(postings), minlength=len(self._documents))
+
+        needed = max(math.ceil(self.min_score * len(query_trigrams)), 1)
+        mask = shared >= needed
+        if kind is not None:
+            mask &= self._is_model == (kind == "model")
+
+        candidates = np.flatnonzero(mask)
+        count = shared[candidates]
+        containment = count / len(query_trigrams)
+        jaccard = count / (
+            len(query_trigrams) + self._trigram_counts[candidates] - count
+        )
+
+        # Best by containment then Jaccard; the prefix tie-break only needs to look at
+        # a few more than `limit`
+        order = np.lexsort((-jaccard, -containment))[: limit * 2]
+        ranked = sorted(
+            (
+                (
+                    -containment[position],
+                    -jaccard[position],
+                    not self._is_prefix(candidates[position], normalized),
+                ),
+                int(candidates[position]),
+                float(jaccard[position]),
+            )
+            for position in order
+        )
+
+        return [
+            {
+                "kind": self._documents[document_id].kind,
+                "fipe_id": self._documents[document_id].fipe_id,
+                "display_name": self._documents[document_id].display_name,
+                "manufacturer_id": self._documents[document_id].manufacturer_id,
+                "manufacturer_name": self._documents[document_id].manufacturer_name,
+                "score": round(score, 4),
+            }
+            for _, document_id, score in ranked[:limit]
+        ]
+
+    def _is_prefix(self, document_id: int, normalized: str) -> bool:
+        # Prefix of the name, or of the model name without the manufacturer
+        document = self._documents[document_id]
+        return document.normalized.startswith(
+            normalized
+        ) or document.normalized_name.startswith(normalized)
+
+    @classmethod
+    def from_database(
+        cls, db_conn: Connection | Session, min_score: float = 0.5
+    ) -> "SearchIndex":
+        index = cls(min_score=min_score)
+
+        manufacturer_names = {}
+        for manufacturer in db_readers.read_manufacturers(db_conn):
+            manufacturer_names[manufacturer.id] = manufacturer.display_name
+            index.add(
+                "manufacturer",
+                manufacturer.fipe_id,
+                manufacturer.display_name,
+                manufacturer.fipe_id,
+                manufacturer.display_name,
+            )
+
+        for car_model in db_readers.read_car_models(db_conn):
+            index.add(
+                "model",
+                car_model.fipe_id,
+                car_model.display_name,
+                car_model.manufacturer_id,
+                manufacturer_names.get(car_model.manufacturer_key, ""),
+            )
+
+        return index
+
+
+__all__ = ["SearchIndex", "normalize", "trigrams"]
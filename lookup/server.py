@@ -0,0 +1,520 @@
+"""HTTP price lookup service.
+
+Serves current and historical FIPE prices straight from the database, with an
+in-memory response cache that is dropped whenever new prices are stored.
+
+    GET  /health
+    GET  /manufacturers?vehicle_type_id=1
+    GET  /manufacturers/<manufacturer_id>/models
+    GET  /prices/<codigo_fipe_veiculo>/<model_year>
+    GET  /prices/<codigo_fipe_veiculo>/<model_year>/history
+    POST /prices/batch  {"lookups": [{"fipe_vehicle_code": "003376-6", "model_year": 2019}]}
+    GET  /prices/range?min=50000&max=60000[&fuel_type=1][&year=2019][&limit=100]
+    GET  /prices/top?n=10[&cheapest=1][&fuel_type=1][&year=2019]
+    GET  /prices/nearest?value=55000[&n=10][&fuel_type=1][&year=2019]
+    GET  /search?q=fusion titanium[&limit=10][&kind=manufacturer|model]
+
+The `range`, `top` and `nearest` queries are answered from the `SnapshotIndex` of the
+latest reference table (or `reference_table_id=` in the query string), loaded from
+`cache/snapshots` when it was saved there and built from the database otherwise. The
+latest month may still be crawled, so its snapshot is rebuilt when its price count
+changes, checked every `snapshot_check_interval` seconds at most.
+`search` uses an in-memory `SearchIndex`, rebuilt whenever a new reference table lands.
+
+Run it with `python -m lookup.server [host] [port]`.
+"""
+
+import json
+import logging
+import sys
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from sqlalchemy import Engine, func, select
+from sqlalchemy.orm import Session
+
+from analytics.snapshot import SNAPSHOT_DIR, SnapshotIndex, load_or_build_snapshot
+from db import services as db_services
+from db.engine import create_db_engine
+from db.models.all_models import CarPrice, ReferenceTable
+from lookup.cache import ResponseCache
+from lookup.search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 1000
+MAX_BODY_SIZE = 1 << 20
+MAX_SNAPSHOT_ROWS = 1000
+MAX_CACHED_SNAPSHOTS = 12
+
+
+class LookupService:
+    """Cached read operations behind the HTTP handlers.
+
+    Args:
+        - engine: Database engine to read from.
+        - cache_size: Maximum number of cached responses.
+        - version_check_interval: Seconds between checks for a new reference table.
+        - snapshot_dir: Where saved price snapshots are looked up.
+        - snapshot_check_interval: Seconds between price counts of the latest month,
+            to rebuild its snapshot while it is being crawled.
+        - max_snapshots: Maximum number of snapshots kept in memory.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        cache_size: int = 100_000,
+        version_check_interval: float = 5.0,
+        snapshot_dir: str = SNAPSHOT_DIR,
+        snapshot_check_interval: float = 60.0,
+        max_snapshots: int = MAX_CACHED_SNAPSHOTS,
+    ) -> None:
+        self._engine = engine
+        self.cache = ResponseCache(maxsize=cache_size)
+        self.version_check_interval = version_check_interval
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_check_interval = snapshot_check_interval
+
+        # reference_table_id -> (snapshot, when it was last checked)
+        self._snapshots = ResponseCache(maxsize=max_snapshots)
+        self._snapshots_lock = threading.Lock()
+
+        self._search_index: SearchIndex | None = None
+        self._search_index_lock = threading.Lock()
+
+        # Latest reference table, its prices may still be crawled
+        self.reference_table_id: str | None = None
+        self._version_checked_at = 0.0
+        self._version_lock = threading.Lock()
+
+    def refresh_version(self, force: bool = False) -> None:
+        """Invalidate the cache if prices were stored since the last check.
+
+        The cache version is the latest reference table and the highest price id, the
+        reference table lands before its crawl starts.
+        """
+        now = time.monotonic()
+        if not force and now - self._version_checked_at < self.version_check_interval:
+            return
+
+        # Only one thread queries the version, the others keep serving
+        if not self._version_lock.acquire(blocking=False):
+            return
+
+        try:
+            with Session(self._engine) as db_session:
+                latest_reference_table_id = db_services.get_latest_reference_table_id(
+                    db_session
+                )
+                latest_car_price_id = db_services.get_latest_car_price_id(db_session)
+
+            if self.cache.set_version((latest_reference_table_id, latest_car_price_id)):
+                logger.info(
+                    "Reference table %s up to price %s, response cache cleared",
+                    latest_reference_table_id,
+                    latest_car_price_id,
+                )
+
+            if latest_reference_table_id != self.reference_table_id:
+                self.reference_table_id = latest_reference_table_id
+                self.on_new_version(latest_reference_table_id)
+
+            self._version_checked_at = now
+        finally:
+            self._version_lock.release()
+
+    def on_new_version(self, reference_table_id: str | None) -> None:
+        """Hook called when a new reference table lands."""
+        # A crawl may have added manufacturers and models
+        self._search_index = None
+        # The snapshot of the previous month may have been taken mid crawl
+        self._snapshots.set_version(reference_table_id)
+
+    def get_search_index(self) -> SearchIndex:
+        search_index = self._search_index
+        if search_index is not None:
+            return search_index
+
+        with self._search_index_lock:
+            if self._search_index is None:
+                with Session(self._engine) as db_session:
+                    self._search_index = SearchIndex.from_database(db_session)
+                logger.info("Search index built with %s names", len(self._search_index))
+
+            return self._search_index
+
+    def search(
+        self, query: str, limit: int = 10, kind: str | None = None
+    ) -> list[dict]:
+        return self.get_search_index().search(query, limit=limit, kind=kind)
+
+    def get_price(self, fipe_vehicle_code: str, model_year: int) -> dict | None:
+        _key = ("price", fipe_vehicle_code, model_year)
+        price = self.cache.get(_key)
+        if price is None:
+            _version = self.cache.version
+            with Session(self._engine) as db_session:
+                row = db_services.get_car_price_by_fipe_code(
+                    db_session, fipe_vehicle_code, model_year
+                )
+
+            # Misses are cached too, as an empty dict
+            price = dict(row) if row else {}
+            self.cache.set(_key, price, _version)
+
+        return price or None
+
+    def get_price_history(self, fipe_vehicle_code: str, model_year: int) -> list[dict]:
+        _key = ("history", fipe_vehicle_code, model_year)
+        history = self.cache.get(_key)
+        if history is None:
+            _version = self.cache.version
+            with Session(self._engine) as db_session:
+                rows = db_services.list_car_price_history(
+                    db_session, fipe_vehicle_code, model_year
+                )
+
+            history = [dict(row) for row in rows]
+            self.cache.set(_key, history, _version)
+
+        return history
+
+    def get_prices(self, lookups: list[tuple[str, int]]) -> list[dict | None]:
+        """Latest price of each (FIPE code, model year), in the order they were asked."""
+        results: dict[tuple[str, int], dict] = {}
+        missing = []
+        for lookup in lookups:
+            price = self.cache.get(("price", *lookup))
+            if price is None:
+                missing.append(lookup)
+            else:
+                results[lookup] = price
+
+        if missing:
+            _version = self.cache.version
+            with Session(self._engine) as db_session:
+                rows = db_services.list_latest_car_prices_by_fipe_codes(
+                    db_session, missing
+                )
+
+            for row in rows:
+                results[(row["fipe_vehicle_code"], row["model_year"])] = dict(row)
+
+            for lookup in missing:
+                price = results.setdefault(lookup, {})
+                self.cache.set(("price", *lookup), price, _version)
+
+        return [results[lookup] or None for lookup in lookups]
+
+    def list_manufacturers(self, vehicle_type_id: int = 1) -> list[dict]:
+        _key = ("manufacturers", vehicle_type_id)
+        manufacturers = self.cache.get(_key)
+        if manufacturers is None:
+            _version = self.cache.version
+            with Session(self._engine) as db_session:
+                rows = db_services.list_manufacturers(db_session, vehicle_type_id)
+
+            manufacturers = [dict(row) for row in rows]
+            self.cache.set(_key, manufacturers, _version)
+
+        return manufacturers
+
+    def _is_fresh(self, reference_table_id: str, cached: tuple | None) -> bool:
+        if cached is None:
+            return False
+
+        # Only the latest month can still get prices
+        _, checked_at = cached
+        return (
+            reference_table_id != self.reference_table_id
+            or time.monotonic() - checked_at < self.snapshot_check_interval
+        )
+
+    def get_snapshot(self, reference_table_id: str | None = None) -> SnapshotIndex:
+        """Snapshot of a reference table, the latest one by default.
+
+        Raises:
+            - ValueError: `reference_table_id` is not a FIPE code.
+            - KeyError: The reference table does not exist.
+            - LookupError: No reference table was loaded yet.
+        """
+        reference_table_id = reference_table_id or self.reference_table_id
+        if reference_table_id is None:
+            raise LookupError("No reference table loaded yet")
+
+        # Also a path below `snapshot_dir`
+        if not reference_table_id.isdigit():
+            raise ValueError(f"Invalid reference table {reference_table_id!r}")
+
+        cached = self._snapshots.get(reference_table_id)
+        if self._is_fresh(reference_table_id, cached):
+            return cached[0]
+
+        with self._snapshots_lock:
+            cached = self._snapshots.get(reference_table_id)
+            if not self._is_fresh(reference_table_id, cached):
+                snapshot = self._load_snapshot(
+                    reference_table_id, cached[0] if cached else None
+                )
+                cached = (snapshot, time.monotonic())
+                self._snapshots.set(reference_table_id, cached)
+
+        return cached[0]
+
+    def _load_snapshot(
+        self, reference_table_id: str, cached: SnapshotIndex | None
+    ) -> SnapshotIndex:
+        with Session(self._engine) as db_session:
+            snapshot = cached
+            if snapshot is None:
+                if db_session.get(ReferenceTable, reference_table_id) is None:
+                    raise KeyError(f"Unknown reference table {reference_table_id}")
+
+                snapshot = load_or_build_snapshot(
+                    db_session, reference_table_id, self.snapshot_dir
+                )
+
+            if reference_table_id == self.reference_table_id:
+                _count = db_session.scalar(
+                    select(func.count())
+                    .select_from(CarPrice)
+                    .where(CarPrice.reference_table_id == reference_table_id)
+                )
+                if _count != len(snapshot):
+                    snapshot = SnapshotIndex.from_database(
+                        db_session, reference_table_id
+                    )
+
+        return snapshot
+
+    def list_car_models(self, manufacturer_id: str) -> list[dict]:
+        _key = ("models", manufacturer_id)
+        car_models = self.cache.get(_key)
+        if car_models is None:
+            _version = self.cache.version
+            with Session(self._engine) as db_session:
+                rows = db_services.list_car_models(db_session, manufacturer_id)
+
+            car_models = [dict(row) for row in rows]
+            self.cache.set(_key, car_models, _version)
+
+        return car_models
+
+
+class LookupRequestError(Exception):
+    def __init__(self, status: HTTPStatus, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, clients doing many lookups skip the TCP handshake
+    protocol_version = "HTTP/1.1"
+
+    server: "LookupHTTPServer"
+
+    def do_GET(self) -> None:
+        self._dispatch(self._route_get)
+
+    def do_POST(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+
+        if not 0 <= length <= MAX_BODY_SIZE:
+            # The body can't be skipped, so the connection can't be reused
+            self.close_connection = True
+            self._send_json(HTTPStatus.BAD_REQUEST, {"error": "invalid Content-Length"})
+            return
+
+        # Read before routing, an unread body would be parsed as the next request of a
+        # keep-alive connection
+        self._body = self.rfile.read(length)
+        self._dispatch(self._route_post)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _dispatch(self, route) -> None:
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            self.server.lookup_service.refresh_version()
+            body = route(parts, query)
+        except LookupRequestError as exc:
+            self._send_json(exc.status, {"error": str(exc)})
+        except Exception:
+            logger.exception("Error handling %s", self.path)
+            self._send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal"})
+        else:
+            self._send_json(HTTPStatus.OK, body)
+
+    def _route_get(self, parts: list[str], query: dict[str, str]):
+        service = self.server.lookup_service
+
+        match parts:
+            case ["health"]:
+                return {
+                    "status": "ok",
+                    "reference_table_id": service.reference_table_id,
+                }
+            case ["manufacturers"]:
+                vehicle_type_id = _parse_int(query.get("vehicle_type_id", "1"))
+                return service.list_manufacturers(vehicle_type_id)
+            case ["manufacturers", manufacturer_id, "models"]:
+                return service.list_car_models(manufacturer_id)
+            case ["search"]:
+                kind = query.get("kind")
+                if kind not in (None, "manufacturer", "model"):
+                    raise LookupRequestError(HTTPStatus.BAD_REQUEST, "invalid kind")
+                return service.search(
+                    query.get("q", ""),
+                    limit=min(_parse_int(query.get("limit", "10")), MAX_SNAPSHOT_ROWS),
+                    kind=kind,
+                )
+            case ["prices", "range" | "top" | "nearest" as query_name]:
+                return self._snapshot_query(query_name, query)
+            case ["prices", fipe_vehicle_code, model_year]:
+                price = service.get_price(fipe_vehicle_code, _parse_int(model_year))
+                if price is None:
+                    raise LookupRequestError(HTTPStatus.NOT_FOUND, "price not found")
+                return price
+            case ["prices", fipe_vehicle_code, model_year, "history"]:
+                return service.get_price_history(
+                    fipe_vehicle_code, _parse_int(model_year)
+                )
+
+        raise LookupRequestError(HTTPStatus.NOT_FOUND, "not found")
+
+    def _snapshot_query(self, query_name: str, query: dict[str, str]) -> list[dict]:
+        try:
+            snapshot = self.server.lookup_service.get_snapshot(
+                query.get("reference_table_id")
+            )
+        except ValueError as exc:
+            raise LookupRequestError(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+        except KeyError as exc:
+            raise LookupRequestError(HTTPStatus.NOT_FOUND, exc.args[0]) from exc
+        except LookupError as exc:
+            raise LookupRequestError(HTTPStatus.SERVICE_UNAVAILABLE, str(exc)) from exc
+
+        filters = {
+            "fuel_type": _parse_optional(query, "fuel_type", _parse_int),
+            "year": _parse_optional(query, "year", _parse_int),
+        }
+        n = min(_parse_int(query.get("n", "10")), MAX_SNAPSHOT_ROWS)
+
+        match query_name:
+            case "range":
+                positions = snapshot.price_range(
+                    _parse_optional(query, "min", _parse_float),
+                    _parse_optional(query, "max", _parse_float),
+                    limit=min(
+                        _parse_int(query.get("limit", MAX_SNAPSHOT_ROWS)),
+                        MAX_SNAPSHOT_ROWS,
+                    ),
+                    **filters,
+                )
+            case "top":
+                positions = snapshot.top(
+                    n, cheapest=query.get("cheapest") in ("1", "true"), **filters
+                )
+            case _:
+                if "value" not in query:
+                    raise LookupRequestError(
+                        HTTPStatus.BAD_REQUEST, "value is required"
+                    )
+                positions = snapshot.nearest(_parse_float(query["value"]), n, **filters)
+
+        return snapshot.records(positions)
+
+    def _route_post(self, parts: list[str], query: dict[str, str]):
+        if parts != ["prices", "batch"]:
+            raise LookupRequestError(HTTPStatus.NOT_FOUND, "not found")
+
+        try:
+            payload = json.loads(self._body or b"{}")
+            lookups = [
+                (str(item["fipe_vehicle_code"]), _parse_int(item["model_year"]))
+                for item in payload["lookups"]
+            ]
+        except (KeyError, TypeError, ValueError) as exc:
+            raise LookupRequestError(HTTPStatus.BAD_REQUEST, "invalid body") from exc
+
+        if len(lookups) > MAX_BATCH_SIZE:
+            raise LookupRequestError(
+                HTTPStatus.BAD_REQUEST, f"at most {MAX_BATCH_SIZE} lookups per batch"
+            )
+
+        return {"prices": self.server.lookup_service.get_prices(lookups)}
+
+    def _send_json(self, status: HTTPStatus, body) -> None:
+        data = json.dumps(body, separators=(",", ":")).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class LookupHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address: tuple[str, int], lookup_service: LookupService):
+        super().__init__(address, LookupRequestHandler)
+        self.lookup_service = lookup_service
+
+
+def _parse_int(value: str | int) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError) as exc:
+        raise LookupRequestError(
+            HTTPStatus.BAD_REQUEST, f"invalid integer {value!r}"
+        ) from exc
+
+
+def _parse_float(value: str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError) as exc:
+        raise LookupRequestError(
+            HTTPStatus.BAD_REQUEST, f"invalid number {value!r}"
+        ) from exc
+
+
+def _parse_optional(query: dict[str, str], key: str, parse):
+    return parse(query[key]) if key in query else None
+
+
+def serve(host: str = "127.0.0.1", port: int = 8080) -> None:
+    lookup_service = LookupService(create_db_engine())
+    lookup_service.refresh_version(force=True)
+
+    with LookupHTTPServer((host, port), lookup_service) as server:
+        logger.info("Lookup service listening on http://%s:%s", host, port)
+        server.serve_forever()
+
+
+__all__ = ["LookupService", "LookupHTTPServer", "serve"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s [%(levelname)s] %(message)s",
+    )
+
+    _host = sys.argv[1] if len(sys.argv) > 1 else "127.0.0.1"
+    _port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+
+    serve(_host, _port)
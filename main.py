@@ -1,39 +1,682 @@
+"""FIPE analytics command line.
+
+    python main.py crawl [--order ASC|DESC]     crawl from scratch
+    python main.py resume [--order ASC|DESC]    continue from the last checkpoint
+    python main.py replay [--order ASC|DESC] [--resume]
+                                                rebuild the database from cached responses
+    python main.py watch [--poll-interval 600]  crawl each new month as soon as FIPE publishes it
+    python main.py status                       show crawl checkpoints and watch freshness
+    python main.py gaps [--until-latest]        list missing prices
+    python main.py repair [--until-latest]      crawl the missing and the failed prices
+    python main.py export REFERENCE_TABLE_ID    export the prices of a month as CSV
+    python main.py archive --year-lte 2015      move closed months to Parquet files
+    python main.py snapshot [REFERENCE_TABLE_ID]  save a price snapshot for analytics
+    python main.py diff [REFERENCE_TABLE_ID]    compare a month with the previous one
+    python main.py matrix [--rebuild]           update the memory-mapped price matrix
+    python main.py cache export [REFERENCE_TABLE_ID ...] [--incremental]
+                                                bundle cached responses for other nodes
+    python main.py cache import BUNDLE ...      load bundles into the response cache
+    python main.py serve [--host] [--port]      run the price lookup service
+    python main.py db init                      create the database tables
+    python main.py db migrate                   upgrade a database created by an older version
+
+`python main.py ASC|DESC` still works, as `resume --order ASC|DESC`, and a bare
+`python main.py` is `resume --order ASC`.
+
+Commands use the database of the `FIPE_DATABASE_URI` environment variable, the
+docker-compose Postgres by default; `FIPE_DATABASE_URI=sqlite:///fipe.db` runs
+everything on a local SQLite file with no services.
+
+Crawls accept `--profile stages|sampling|cprofile`, and `kill -USR1 <pid>` samples
+a running crawl for `--profile-seconds`; results are written to `--profile-dir`.
+
+Heavy modules (SQLAlchemy, Pydantic, requests, tqdm) are only imported inside the
+command that needs them, so quick commands like `status` start instantly.
+"""
+
+import argparse
+import contextlib
 import json
 import logging
+import os
+import signal
 import sys
-
-from providers.fipe.crawler import FipeCrawler
-from tqdm.contrib.logging import logging_redirect_tqdm
+import time
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s [%(levelname)s] %(message)s",
 )
 
+logger = logging.getLogger(__name__)
+
+ORDERS = ("ASC", "DESC")
+
+# `providers.fipe.watch_state.WATCH_STATE_FILE`, imported lazily like every command
+WATCH_STATE_FILE = "watch_state.json"
 
-def main():
-    _order = "ASC"
-    if len(sys.argv) > 1:
-        _order = sys.argv[1].upper().strip()
 
-    checkpoint_file = f"{_order.lower()}_checkpoint.json"
+def _checkpoint_file(order: str, replay: bool = False) -> str:
+    # Replays keep their own position, apart from the live crawl's
+    if replay:
+        return f"replay_{order.lower()}_checkpoint.json"
 
+    return f"{order.lower()}_checkpoint.json"
+
+
+def _load_checkpoint(order: str, replay: bool = False) -> dict:
     try:
-        with open(checkpoint_file, "r") as f:
-            checkpoint = json.load(f)
+        with open(_checkpoint_file(order, replay), "r") as f:
+            return json.load(f)
     except FileNotFoundError:
-        checkpoint = {}
+        return {}
+
+
+def _save_checkpoint(order: str, checkpoint: dict, replay: bool = False) -> None:
+    with open(_checkpoint_file(order, replay), "w") as f:
+        json.dump(checkpoint, f)
+
+
+def _run_crawler(args: argparse.Namespace, checkpoint: dict, offline: bool = False):
+    from tqdm.contrib.logging import logging_redirect_tqdm
+
+    from providers.fipe.crawler import FipeCrawler
+    from providers.fipe.exceptions import CircuitOpenException
+    from providers.fipe.profiling import ProfilingController, install_signal_handler
+
+    profiling = ProfilingController(args.profile_dir, args.profile_seconds)
+    # `kill -USR1 <pid>` profiles the next --profile-seconds of the crawl
+    install_signal_handler(profiling)
+    if args.profile in ("stages", "cprofile"):
+        profiling.enable_stage_timing()
+    elif args.profile == "sampling":
+        profiling.start_window()
+
+    crawler = FipeCrawler(
+        order=args.order,
+        checkpoint=checkpoint,
+        prefetch_window=args.prefetch_window,
+        fetch_workers=args.fetch_workers,
+        persist_workers=args.persist_workers,
+        offline=offline,
+        storage_mode=args.storage,
+        hedge=args.hedge,
+    )
+
+    # Stop on SIGTERM the same way as on Ctrl+C: drain the pipeline, then checkpoint
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    call_profile = (
+        profiling.profile_calls()
+        if args.profile == "cprofile"
+        else contextlib.nullcontext()
+    )
+    with logging_redirect_tqdm(), call_profile:
+        stopped = False
+        try:
+            crawler.populate_reference_tables(vehicle_type_id=args.vehicle_type_id)
+        except KeyboardInterrupt:
+            logger.error("Process interrupted, flushing pending prices")
+            stopped = True
+        except CircuitOpenException as exc:
+            logger.error("FIPE API unavailable (%s), flushing pending prices", exc)
+            stopped = True
+        finally:
+            crawler.close()
+
+        # Prices cancelled by an open circuit are crawled again by `resume`
+        if stopped or crawler.price_pipeline.cancelled_jobs:
+            _save_checkpoint(args.order, crawler.get_checkpoint(), replay=offline)
+
+    # Write the window that was still running when the crawl ended
+    profiling.stop_window()
+    if args.profile in ("stages", "cprofile"):
+        profiling.write_stage_report()
+
+
+def cmd_crawl(args: argparse.Namespace) -> None:
+    _run_crawler(args, checkpoint={})
+
+
+def cmd_resume(args: argparse.Namespace) -> None:
+    _run_crawler(args, checkpoint=_load_checkpoint(args.order))
+
+
+def cmd_replay(args: argparse.Namespace) -> None:
+    checkpoint = _load_checkpoint(args.order, replay=True) if args.resume else {}
+    _run_crawler(args, checkpoint=checkpoint, offline=True)
+
+
+def cmd_watch(args: argparse.Namespace) -> None:
+    from sqlalchemy.orm import Session
+    from tqdm.contrib.logging import logging_redirect_tqdm
+
+    from db.engine import create_db_engine
+    from providers.fipe.crawler import FipeCrawler
+    from providers.fipe.watcher import ReferenceTableWatcher
+
+    _engine = create_db_engine()
 
-    crawler = FipeCrawler(order=_order, checkpoint=checkpoint)
+    def on_crawled(_reference_table_id: str) -> None:
+        from db.coverage import update_coverage
+
+        with Session(_engine) as db_session:
+            update_coverage(db_session)
+
+            if args.matrix_dir:
+                from analytics.matrix import update_matrix
+
+                update_matrix(db_session, args.matrix_dir)
+
+    watcher = ReferenceTableWatcher(
+        _engine,
+        lambda checkpoint: FipeCrawler(
+            checkpoint=checkpoint,
+            prefetch_window=args.prefetch_window,
+            fetch_workers=args.fetch_workers,
+            persist_workers=args.persist_workers,
+            storage_mode=args.storage,
+            hedge=args.hedge,
+        ),
+        vehicle_type_id=args.vehicle_type_id,
+        poll_interval=args.poll_interval,
+        state_file=args.state_file,
+        on_crawled=on_crawled,
+    )
+
+    # Stop on SIGTERM the same way as on Ctrl+C: checkpoint the running crawl
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with logging_redirect_tqdm():
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logger.info("Watch stopped")
+
+
+def cmd_status(args: argparse.Namespace) -> None:
+    for order in ORDERS:
+        path = _checkpoint_file(order)
+        if not os.path.exists(path):
+            print(f"{order}: no checkpoint")
+            continue
+
+        checkpoint = _load_checkpoint(order)
+        updated_at = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(path))
+        )
+        position = ", ".join(f"{key}={value}" for key, value in checkpoint.items())
+        print(f"{order}: {position or 'empty'} (updated {updated_at})")
+
+    for order in ORDERS:
+        path = _checkpoint_file(order, replay=True)
+        if os.path.exists(path):
+            checkpoint = _load_checkpoint(order, replay=True)
+            position = ", ".join(f"{key}={value}" for key, value in checkpoint.items())
+            print(f"replay {order}: {position or 'empty'}")
+
+    if os.path.exists(args.state_file):
+        from providers.fipe.watch_state import freshness, load_watch_state
+
+        print(f"watch: {json.dumps(freshness(load_watch_state(args.state_file)))}")
+
+
+def _load_coverage(rebuild: bool = False):
+    from sqlalchemy.orm import Session
+
+    from db.coverage import update_coverage
+    from db.engine import create_db_engine
+
+    with Session(create_db_engine()) as db_session:
+        return update_coverage(db_session, rebuild=rebuild)
+
+
+def cmd_gaps(args: argparse.Namespace) -> None:
+    coverage = _load_coverage(args.rebuild_coverage)
+
+    gaps = coverage.gaps(until_latest=args.until_latest)
+    for index, gap in enumerate(gaps):
+        if args.limit is not None and index >= args.limit:
+            break
+        print(json.dumps(gap._asdict()))
+
+    logger.info(
+        "%s model years, %s missing prices",
+        len(coverage),
+        coverage.count_gaps(until_latest=args.until_latest),
+    )
+
+
+def cmd_repair(args: argparse.Namespace) -> None:
+    import itertools
+
+    from tqdm.contrib.logging import logging_redirect_tqdm
+
+    from providers.fipe.crawler import FipeCrawler
+    from providers.fipe.pipeline import FAILED_JOBS_FILE, load_failed_jobs
+
+    # Jobs failing again are recorded in a fresh file, the ones being retried are
+    # kept aside until the repair finishes
+    _retry_file = f"{FAILED_JOBS_FILE}.retry"
+    if os.path.exists(FAILED_JOBS_FILE):
+        with open(FAILED_JOBS_FILE, "r") as src, open(_retry_file, "a") as dst:
+            dst.write(src.read())
+        os.remove(FAILED_JOBS_FILE)
+    failed_jobs = load_failed_jobs(_retry_file)
+
+    coverage = _load_coverage(args.rebuild_coverage)
+    crawler = FipeCrawler(
+        prefetch_window=0,
+        fetch_workers=args.fetch_workers,
+        persist_workers=args.persist_workers,
+    )
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
     with logging_redirect_tqdm():
         try:
-            crawler.populate_reference_tables(vehicle_type_id=1)
+            submitted = crawler.populate_prices_for_gaps(
+                itertools.chain(
+                    failed_jobs, coverage.gaps(until_latest=args.until_latest)
+                )
+            )
+            logger.info(
+                "Submitted %s missing and failed prices (%s failed before)",
+                submitted,
+                len(failed_jobs),
+            )
         except KeyboardInterrupt:
-            logging.error("Process interrupted by the user")
-            checkpoint = crawler.get_checkpoint()
-            with open(checkpoint_file, "w") as f:
-                json.dump(checkpoint, f)
+            logger.error("Process interrupted, flushing pending prices")
+            return
+        finally:
+            crawler.close()
+
+    if os.path.exists(_retry_file):
+        os.remove(_retry_file)
+
+
+def cmd_export(args: argparse.Namespace) -> None:
+    import csv
+
+    from sqlalchemy.orm import Session
+
+    from db import services as db_services
+    from db.engine import create_db_engine
+    from db.readers import CAR_PRICE_COLUMNS
+
+    with (
+        open(args.output, "w", newline="")
+        if args.output
+        else contextlib.nullcontext(sys.stdout)
+    ) as output:
+        writer = csv.writer(output)
+        writer.writerow(CAR_PRICE_COLUMNS)
+
+        with Session(create_db_engine()) as db_session:
+            rows = db_services.iter_all_car_prices(
+                db_session,
+                columns=list(CAR_PRICE_COLUMNS),
+                reference_table_id=args.reference_table_id,
+            )
+            writer.writerows(rows)
+
+
+def cmd_archive(args: argparse.Namespace) -> None:
+    from sqlalchemy.orm import Session
+
+    from db import archive as db_archive
+    from db import readers as db_readers
+    from db.engine import create_db_engine
+
+    with Session(create_db_engine()) as db_session:
+        if args.list:
+            for archived in db_archive.list_archived_reference_tables(db_session):
+                print(
+                    f"{archived.reference_table_id}: {archived.rows} prices, "
+                    f"{archived.size_bytes} bytes, {archived.path}"
+                )
+            return
+
+        reference_tables = db_readers.read_reference_tables(
+            db_session, year_lte=args.year_lte
+        )
+        # The latest reference table is never closed
+        latest = db_readers.read_reference_tables(db_session, descending=True)[:1]
+        for reference_table in reference_tables:
+            if reference_table in latest:
+                continue
+
+            if args.dry_run:
+                print(f"would archive {reference_table.fipe_id}")
+                continue
+
+            db_archive.archive_reference_table(
+                db_session, reference_table.fipe_id, args.archive_dir
+            )
+
+
+def cmd_snapshot(args: argparse.Namespace) -> None:
+    from sqlalchemy.orm import Session
+
+    from analytics.snapshot import SnapshotIndex, snapshot_path
+    from db import services as db_services
+    from db.engine import create_db_engine
+
+    with Session(create_db_engine()) as db_session:
+        reference_table_id = (
+            args.reference_table_id
+            or db_services.get_latest_reference_table_id(db_session)
+        )
+        snapshot = SnapshotIndex.from_database(db_session, reference_table_id)
+
+    path = snapshot_path(reference_table_id, args.snapshot_dir)
+    snapshot.save(path)
+    logger.info("Saved %s prices to %s", len(snapshot), path)
+
+
+def cmd_matrix(args: argparse.Namespace) -> None:
+    from sqlalchemy.orm import Session
+
+    from analytics.matrix import update_matrix
+    from db.engine import create_db_engine
+
+    with Session(create_db_engine()) as db_session:
+        written = update_matrix(db_session, args.matrix_dir, rebuild=args.rebuild)
+
+    logger.info("Wrote %s months to %s", len(written), args.matrix_dir)
+
+
+def cmd_diff(args: argparse.Namespace) -> None:
+    from sqlalchemy.orm import Session
+
+    from analytics.diff import diff_snapshots, previous_reference_table_id, save_diff
+    from analytics.snapshot import load_or_build_snapshot
+    from db import services as db_services
+    from db.engine import create_db_engine
+    from db.models.all_models import ReferenceTable
+
+    with Session(create_db_engine()) as db_session:
+        reference_table_id = (
+            args.reference_table_id
+            or db_services.get_latest_reference_table_id(db_session)
+        )
+        # An unknown month would be diffed as an empty snapshot
+        for _id in (args.reference_table_id, args.previous):
+            if _id is not None and db_session.get(ReferenceTable, _id) is None:
+                args.parser.error(f"unknown reference table {_id}")
+
+        try:
+            previous_id = args.previous or previous_reference_table_id(
+                db_session, reference_table_id
+            )
+        except KeyError as exc:
+            args.parser.error(exc.args[0])
+
+        if previous_id is None:
+            logger.error("No reference table before %s", reference_table_id)
+            return
+
+        diff = diff_snapshots(
+            load_or_build_snapshot(db_session, previous_id, args.snapshot_dir),
+            load_or_build_snapshot(db_session, reference_table_id, args.snapshot_dir),
+        )
+        print(json.dumps(diff.summary()))
+
+        if args.save:
+            written = save_diff(db_session, diff)
+            db_session.commit()
+            logger.info("Saved %s price changes", written)
+
+
+def cmd_cache_export(args: argparse.Namespace) -> None:
+    from providers.fipe.cache_bundle import export_bundle
+
+    path = export_bundle(
+        reference_table_ids=args.reference_table_ids or None,
+        incremental=args.incremental,
+        bundle_dir=args.bundle_dir,
+        preset=args.preset,
+    )
+    if path is not None:
+        print(path)
+
+
+def cmd_cache_import(args: argparse.Namespace) -> None:
+    from providers.fipe.cache_bundle import import_bundle
+
+    for path in args.bundles:
+        print(json.dumps(import_bundle(path)))
+
+
+def cmd_serve(args: argparse.Namespace) -> None:
+    from lookup.server import serve
+
+    serve(args.host, args.port)
+
+
+def cmd_db_init(args: argparse.Namespace) -> None:
+    from db.create_db import create_db
+    from db.engine import create_db_engine
+
+    create_db(create_db_engine())
+
+
+def cmd_db_migrate(args: argparse.Namespace) -> None:
+    from db.engine import create_db_engine
+    from db.migrations import migrate
+
+    applied = migrate(create_db_engine())
+    print(", ".join(applied) if applied else "database is up to date")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="main.py", description="FIPE analytics")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    crawl_options = argparse.ArgumentParser(add_help=False)
+    crawl_options.add_argument("--order", type=str.upper, choices=ORDERS, default="ASC")
+    crawl_options.add_argument("--vehicle-type-id", type=int, default=1)
+    crawl_options.add_argument("--prefetch-window", type=int, default=4)
+    crawl_options.add_argument("--fetch-workers", type=int, default=4)
+    crawl_options.add_argument("--persist-workers", type=int, default=1)
+    crawl_options.add_argument(
+        "--storage",
+        choices=("full", "changes"),
+        default="full",
+        help="'changes' only records prices that differ from the previous month",
+    )
+    crawl_options.add_argument(
+        "--hedge",
+        action="store_true",
+        help="duplicate requests slower than the endpoint p95 latency",
+    )
+    crawl_options.add_argument(
+        "--profile",
+        choices=("off", "stages", "sampling", "cprofile"),
+        default="off",
+        help="'stages' times each crawl stage, 'sampling' samples every thread for "
+        "--profile-seconds, 'cprofile' profiles the crawl thread for the whole run",
+    )
+    crawl_options.add_argument("--profile-seconds", type=float, default=60)
+    crawl_options.add_argument("--profile-dir", type=str, default="profiles")
+
+    crawl = commands.add_parser(
+        "crawl", parents=[crawl_options], help="crawl from scratch"
+    )
+    crawl.set_defaults(handler=cmd_crawl)
+
+    resume = commands.add_parser(
+        "resume", parents=[crawl_options], help="continue from the last checkpoint"
+    )
+    resume.set_defaults(handler=cmd_resume)
+
+    replay = commands.add_parser(
+        "replay",
+        parents=[crawl_options],
+        help="rebuild the database from cached responses, without network",
+    )
+    replay.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last interrupted replay instead of starting over",
+    )
+    replay.set_defaults(handler=cmd_replay)
+
+    watch = commands.add_parser(
+        "watch", help="poll for new reference tables and crawl each new month"
+    )
+    watch.add_argument("--vehicle-type-id", type=int, default=1)
+    watch.add_argument(
+        "--poll-interval", type=float, default=600, help="seconds between polls"
+    )
+    watch.add_argument("--state-file", type=str, default=WATCH_STATE_FILE)
+    watch.add_argument("--prefetch-window", type=int, default=4)
+    watch.add_argument("--fetch-workers", type=int, default=4)
+    watch.add_argument("--persist-workers", type=int, default=1)
+    watch.add_argument("--storage", choices=("full", "changes"), default="full")
+    watch.add_argument("--hedge", action="store_true")
+    watch.add_argument(
+        "--matrix-dir", help="update the price matrix there after each new month"
+    )
+    watch.set_defaults(handler=cmd_watch)
+
+    status = commands.add_parser(
+        "status", help="show crawl checkpoints and watch freshness"
+    )
+    status.add_argument(
+        "--state-file",
+        type=str,
+        default=WATCH_STATE_FILE,
+        help="state file of `watch --state-file`",
+    )
+    status.set_defaults(handler=cmd_status)
+
+    gaps_options = argparse.ArgumentParser(add_help=False)
+    gaps_options.add_argument(
+        "--until-latest",
+        action="store_true",
+        help="expect prices up to the latest reference table, not the last seen one",
+    )
+    gaps_options.add_argument(
+        "--rebuild-coverage",
+        action="store_true",
+        help="read every price again instead of only the new ones",
+    )
+
+    gaps = commands.add_parser(
+        "gaps", parents=[gaps_options], help="list missing prices as JSON lines"
+    )
+    gaps.add_argument("--limit", type=int)
+    gaps.set_defaults(handler=cmd_gaps)
+
+    repair = commands.add_parser(
+        "repair",
+        parents=[gaps_options],
+        help="crawl only the missing prices and the ones that failed before",
+    )
+    repair.add_argument("--fetch-workers", type=int, default=4)
+    repair.add_argument("--persist-workers", type=int, default=1)
+    repair.set_defaults(handler=cmd_repair)
+
+    export = commands.add_parser("export", help="export the prices of a month as CSV")
+    export.add_argument("reference_table_id")
+    export.add_argument("-o", "--output", help="CSV file, defaults to stdout")
+    export.set_defaults(handler=cmd_export)
+
+    archive = commands.add_parser(
+        "archive", help="move the prices of closed months to Parquet files"
+    )
+    # Archiving deletes from `preco`, so the months are never implied
+    archive_target = archive.add_mutually_exclusive_group(required=True)
+    archive_target.add_argument("--year-lte", type=int, help="archive up to this year")
+    archive_target.add_argument(
+        "--list", action="store_true", help="show archived months"
+    )
+    archive.add_argument("--archive-dir", default="archive/preco")
+    archive.add_argument("--dry-run", action="store_true")
+    archive.set_defaults(handler=cmd_archive)
+
+    snapshot = commands.add_parser(
+        "snapshot", help="save a price snapshot of a month for analytics"
+    )
+    snapshot.add_argument(
+        "reference_table_id", nargs="?", help="defaults to the latest reference table"
+    )
+    snapshot.add_argument("--snapshot-dir", default="cache/snapshots")
+    snapshot.set_defaults(handler=cmd_snapshot)
+
+    diff = commands.add_parser(
+        "diff", help="compare the prices of a month with the previous one"
+    )
+    diff.add_argument(
+        "reference_table_id", nargs="?", help="defaults to the latest reference table"
+    )
+    diff.add_argument("--previous", help="defaults to the month before")
+    diff.add_argument("--save", action="store_true", help="write to preco_variacao")
+    diff.add_argument("--snapshot-dir", default="cache/snapshots")
+    diff.set_defaults(handler=cmd_diff, parser=diff)
+
+    matrix = commands.add_parser(
+        "matrix", help="update the memory-mapped model year x month price matrix"
+    )
+    matrix.add_argument("--matrix-dir", default="cache/matrix")
+    matrix.add_argument("--rebuild", action="store_true", help="rewrite every month")
+    matrix.set_defaults(handler=cmd_matrix)
+
+    cache = commands.add_parser("cache", help="share the response cache between nodes")
+    cache_commands = cache.add_subparsers(dest="cache_command", required=True)
+    cache_export = cache_commands.add_parser(
+        "export", help="pack cached responses into a bundle"
+    )
+    cache_export.add_argument(
+        "reference_table_ids",
+        nargs="*",
+        metavar="REFERENCE_TABLE_ID",
+        help="only these reference tables, every cached response by default",
+    )
+    cache_export.add_argument(
+        "--incremental",
+        action="store_true",
+        help="leave out responses already in earlier bundles",
+    )
+    cache_export.add_argument("--bundle-dir", type=str, default="cache/bundles")
+    cache_export.add_argument("--preset", type=int, default=6, help="xz preset, 0-9")
+    cache_export.set_defaults(handler=cmd_cache_export)
+    cache_import = cache_commands.add_parser(
+        "import", help="verify bundles and load them into the cache"
+    )
+    cache_import.add_argument("bundles", nargs="+", metavar="BUNDLE")
+    cache_import.set_defaults(handler=cmd_cache_import)
+
+    serve = commands.add_parser("serve", help="run the price lookup service")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.set_defaults(handler=cmd_serve)
+
+    db = commands.add_parser("db", help="database management")
+    db_commands = db.add_subparsers(dest="db_command", required=True)
+    db_init = db_commands.add_parser("init", help="create the database tables")
+    db_init.set_defaults(handler=cmd_db_init)
+    db_migrate = db_commands.add_parser(
+        "migrate", help="upgrade a database created by an older version"
+    )
+    db_migrate.set_defaults(handler=cmd_db_migrate)
+
+    return parser
+
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # Backwards compatible `python main.py [ASC|DESC]`, which resumed an ASC crawl by
+    # default
+    if not argv:
+        argv = ["resume", "--order", "ASC"]
+    elif len(argv) == 1 and argv[0].upper().strip() in ORDERS:
+        argv = ["resume", "--order", argv[0].strip()]
+
+    args = build_parser().parse_args(argv)
+    args.handler(args)
 
 
 if __name__ == "__main__":
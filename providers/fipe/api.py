@@ -1,33 +1,122 @@
 import json
 import logging
 import os
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from hashlib import sha256
 
 import requests
 
 from providers.fipe import exceptions
 from providers.fipe import schemas
+from providers.fipe.circuit_breaker import CircuitBreaker
+from providers.fipe.latency import HedgeBudget, LatencyTracker
+from providers.fipe.profiling import stage_timer
+from providers.fipe.singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
 ONE_MONTH = 3600 * 24 * 30
+ONE_WEEK = 3600 * 24 * 7
+
+
+def cache_index_path(cache_dir: str) -> str:
+    """Append-only log of the request behind every cached response of `cache_dir`,
+    one `{"key", "endpoint", "params"}` JSON object per line. Kept next to the
+    directory, which only holds responses."""
+    return f"{cache_dir.rstrip('/')}.index.jsonl"
 
 
 class FipeApi:
     BASE_URL = "https://veiculos.fipe.org.br/api/veiculos"
     REQUEST_CACHE_DIR = "cache/fipe_raw_responses"
+    # `erro` responses, kept apart so they can expire: data missing today may be
+    # published later
+    NEGATIVE_CACHE_DIR = "cache/fipe_negative_responses"
+
+    _index_lock = threading.Lock()
 
-    def __init__(self) -> None:
-        self._session = requests.Session()
+    def __init__(
+        self,
+        offline: bool = False,
+        hedge: bool = False,
+        latency: LatencyTracker | None = None,
+        hedge_budget: HedgeBudget | None = None,
+        hedge_workers: int = 8,
+        circuit_breaker: CircuitBreaker | None = None,
+        circuit_max_wait: float | None = 600.0,
+        negative_cache_ttl: int | None = ONE_WEEK,
+    ) -> None:
+        # Offline: only serve responses from the local cache, never hit the network
+        self.offline = offline
+
+        # Timeouts follow the observed latency of each endpoint and, with `hedge`, a
+        # request still pending after the endpoint p95 gets a duplicate; whichever
+        # answers first wins. Hedges are capped by `hedge_budget`, and requests only
+        # go through the executor while one of its `hedge_workers` is free, so time
+        # spent in its queue never counts towards the hedge delay.
+        self.hedge = hedge
+        self.latency = latency or LatencyTracker()
+        self.hedge_budget = hedge_budget or HedgeBudget()
+        self._hedge_workers = hedge_workers
+        self._hedge_executor: ThreadPoolExecutor | None = None
+        self._hedge_executor_lock = threading.Lock()
+        self._hedge_slots = threading.BoundedSemaphore(hedge_workers)
+
+        # During an outage requests wait for the circuit to close (up to
+        # `circuit_max_wait` seconds) instead of burning their retries
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.circuit_max_wait = circuit_max_wait
+
+        self.negative_cache_ttl = negative_cache_ttl
+
+        self._local = threading.local()
+        self._single_flight = SingleFlight()
+
+    @property
+    def _session(self) -> requests.Session:
+        # `requests.Session` is not thread-safe, each thread gets its own
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        return session
+
+    def _hash_request(self, endpoint: str, params: dict[str, str] | None) -> str:
+        # Sorted keys: the same request always maps to the same key, no matter the
+        # order in which its params were built
+        _canonical_params = json.dumps(
+            params or {}, sort_keys=True, separators=(",", ":")
+        )
+        return sha256(f"{endpoint}{_canonical_params}".encode()).hexdigest()
 
-    def _hash_request(self, endpoint: str, params: dict[str, str]) -> str:
+    def _legacy_hash_request(self, endpoint: str, params: dict[str, str] | None) -> str:
+        # Key used by caches written before `_hash_request` was canonicalized
         return sha256(f"{endpoint}{params}".encode()).hexdigest()
 
+    def _index_request(
+        self, endpoint: str, params: dict[str, str] | None, _hash: str
+    ) -> None:
+        # Lets cache bundles pick the responses of a single reference table
+        _line = json.dumps(
+            {"key": _hash, "endpoint": endpoint, "params": params or {}},
+            separators=(",", ":"),
+        )
+        _index_path = cache_index_path(self.REQUEST_CACHE_DIR)
+        with self._index_lock, open(_index_path, "a", encoding="utf-8") as f:
+            f.write(f"{_line}\n")
+
     def _cache_request(self, endpoint: str, params: dict[str, str], response: str):
         _hash = self._hash_request(endpoint, params)
-        with open(f"{self.REQUEST_CACHE_DIR}/{_hash}.json", "w", encoding="utf-8") as f:
+        _cached_file_path = f"{self.REQUEST_CACHE_DIR}/{_hash}.json"
+
+        # Write then rename, so concurrent readers never see a partial file
+        _tmp_file_path = f"{_cached_file_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(_tmp_file_path, "w", encoding="utf-8") as f:
             f.write(response)
+        os.replace(_tmp_file_path, _cached_file_path)
+        self._index_request(endpoint, params, _hash)
 
     def _get_cached_response(
         self,
@@ -38,6 +127,12 @@ class FipeApi:
         _hash = self._hash_request(endpoint, params)
         _cached_file_path = f"{self.REQUEST_CACHE_DIR}/{_hash}.json"
 
+        if not os.path.exists(_cached_file_path):
+            _legacy_hash = self._legacy_hash_request(endpoint, params)
+            _legacy_file_path = f"{self.REQUEST_CACHE_DIR}/{_legacy_hash}.json"
+            if os.path.exists(_legacy_file_path):
+                os.replace(_legacy_file_path, _cached_file_path)
+
         _cached_file_last_modified = os.path.getmtime(_cached_file_path)
         if cache_expire and time.time() - _cached_file_last_modified > cache_expire:
             os.remove(_cached_file_path)
@@ -53,17 +148,172 @@ class FipeApi:
         if os.path.exists(_cached_file_path):
             os.remove(_cached_file_path)
 
+    @staticmethod
+    def _is_error_response(response: str) -> bool:
+        # Cheap substring test first, almost every response is a regular payload
+        if '"erro"' not in response:
+            return False
+
+        try:
+            return "erro" in json.loads(response)
+        except (json.JSONDecodeError, TypeError):
+            return False
+
+    def _negative_cache_path(self, endpoint: str, params: dict[str, str]) -> str:
+        _hash = self._hash_request(endpoint, params)
+        return f"{self.NEGATIVE_CACHE_DIR}/{_hash}.json"
+
+    def _cache_negative_response(
+        self, endpoint: str, params: dict[str, str], response: str
+    ) -> None:
+        _cached_file_path = self._negative_cache_path(endpoint, params)
+        os.makedirs(self.NEGATIVE_CACHE_DIR, exist_ok=True)
+
+        _tmp_file_path = f"{_cached_file_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(_tmp_file_path, "w", encoding="utf-8") as f:
+            f.write(response)
+        os.replace(_tmp_file_path, _cached_file_path)
+        self._index_request(endpoint, params, self._hash_request(endpoint, params))
+
+    def _get_negative_cached_response(
+        self, endpoint: str, params: dict[str, str]
+    ) -> str | None:
+        _cached_file_path = self._negative_cache_path(endpoint, params)
+
+        try:
+            _cached_file_last_modified = os.path.getmtime(_cached_file_path)
+            if (
+                self.negative_cache_ttl is not None
+                and time.time() - _cached_file_last_modified > self.negative_cache_ttl
+            ):
+                os.remove(_cached_file_path)
+                return None
+
+            with open(_cached_file_path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _get_hedge_executor(self) -> ThreadPoolExecutor:
+        with self._hedge_executor_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=self._hedge_workers, thread_name_prefix="fipe-hedge"
+                )
+
+            return self._hedge_executor
+
+    def _timed_post(
+        self, endpoint: str, params: dict[str, str], timeout: float
+    ) -> requests.Response:
+        # Timed out and failed requests are observed too, leaving them out would pull
+        # the percentiles, and so the timeouts, below the real latency
+        _start = time.perf_counter()
+        try:
+            return self._session.post(
+                self.BASE_URL + endpoint, params=params, timeout=timeout
+            )
+        finally:
+            self.latency.observe(endpoint, time.perf_counter() - _start)
+
+    def _try_submit(
+        self,
+        endpoint: str,
+        params: dict[str, str],
+        timeout: float,
+        hedge: bool = False,
+    ) -> Future | None:
+        """Send the request from a free hedge executor worker, None when every worker
+        is busy (or, for a `hedge`, when the budget is spent)."""
+        if not self._hedge_slots.acquire(blocking=False):
+            return None
+
+        if hedge and not self.hedge_budget.try_acquire():
+            self._hedge_slots.release()
+            return None
+
+        try:
+            future = self._get_hedge_executor().submit(
+                self._timed_post, endpoint, params, timeout
+            )
+        except BaseException:
+            self._hedge_slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._hedge_slots.release())
+        return future
+
+    def _post(
+        self, endpoint: str, params: dict[str, str], timeout: float
+    ) -> requests.Response:
+        self.hedge_budget.record_request()
+
+        hedge_delay = self.latency.hedge_delay(endpoint) if self.hedge else None
+        if hedge_delay is None or hedge_delay >= timeout:
+            return self._timed_post(endpoint, params, timeout)
+
+        primary = self._try_submit(endpoint, params, timeout)
+        if primary is None:
+            return self._timed_post(endpoint, params, timeout)
+
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        hedged = self._try_submit(endpoint, params, timeout - hedge_delay, hedge=True)
+        if hedged is None:
+            return primary.result()
+
+        logger.debug("Hedging request to %s after %.2fs", endpoint, hedge_delay)
+
+        # First request to complete wins, the other one is left to finish unread
+        pending = {primary, hedged}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+        return primary.result()
+
     def _make_request_raw(
         self,
-        url: str,
+        endpoint: str,
         params: dict[str, str],
         _retry_count: int = 0,
     ) -> str:
+        # Each retry of a timed out request is given twice as long
+        _timeout = min(
+            self.latency.timeout(endpoint) * 2**_retry_count,
+            max(self.latency.max_timeout, self.latency.default_timeout),
+        )
+
+        _probe = self.circuit_breaker.acquire(timeout=self.circuit_max_wait)
         try:
-            response = self._session.post(url, params=params, timeout=10)
+            response = self._post(endpoint, params, _timeout)
+        except requests.exceptions.Timeout as exc:
+            self.circuit_breaker.record_failure(_probe)
+            if _retry_count < 6:
+                logger.warning(
+                    "Request to %s timed out after %.2fs, retrying", endpoint, _timeout
+                )
+                return self._make_request_raw(endpoint, params, _retry_count + 1)
+
+            logger.error("Error making request: %s", exc)
+            raise exceptions.FipeApiRequestException("Failed to make request") from exc
         except requests.exceptions.RequestException as exc:
+            self.circuit_breaker.record_failure(_probe)
             logger.error("Error making request: %s", exc)
             raise exceptions.FipeApiRequestException("Failed to make request") from exc
+        except BaseException:
+            self.circuit_breaker.release(_probe)
+            raise
+
+        # Server errors count against the backend, anything else means it is up
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure(_probe)
+        else:
+            self.circuit_breaker.record_success(_probe)
 
         if response.status_code == 200:
             return response.text
@@ -72,7 +322,7 @@ class FipeApi:
         _backoff = 2**_retry_count
 
         logger.error("Request to failed with status code %s", response.status_code)
-        logger.debug("URL: %s", url)
+        logger.debug("Endpoint: %s", endpoint)
         logger.debug("Params: %s", params)
         logger.debug("Response: %s", response.text)
 
@@ -83,29 +333,69 @@ class FipeApi:
 
             time.sleep(_wait)
 
-        if response.status_code == 520:
+        # With the circuit open the next attempt waits for it anyway
+        if (
+            response.status_code == 520
+            and self.circuit_breaker.state == CircuitBreaker.CLOSED
+        ):
             logger.error("Server response error. Waiting %s seconds.", _backoff)
             time.sleep(_backoff)
 
         if _retry_count < 6:
             logger.debug("Retrying request...(%s/5)", _retry_count)
-            return self._make_request_raw(url, params, _retry_count + 1)
+            return self._make_request_raw(endpoint, params, _retry_count + 1)
 
         raise exceptions.FipeApiRequestException("Failed to make request")
 
+    def _get_or_fetch_response(
+        self,
+        endpoint: str,
+        params: dict[str, str] | None,
+        cache_expire: int | None,
+    ) -> str:
+        try:
+            with stage_timer.time("fetch.cache"):
+                response = self._get_cached_response(endpoint, params, cache_expire)
+        except FileNotFoundError:
+            pass
+        else:
+            if not self._is_error_response(response):
+                return response
+
+            # Written before errors had their own cache, move it there so it expires
+            self._cache_negative_response(endpoint, params, response)
+            self._delete_cached_response(endpoint, params)
+            return response
+
+        response = self._get_negative_cached_response(endpoint, params)
+        if response is not None:
+            return response
+
+        if self.offline:
+            raise exceptions.FipeApiCacheMissException(
+                f"No cached response for {endpoint} {params}"
+            )
+
+        with stage_timer.time("fetch.network"):
+            response = self._make_request_raw(endpoint, params)
+        if self._is_error_response(response):
+            self._cache_negative_response(endpoint, params, response)
+        else:
+            self._cache_request(endpoint, params, response)
+
+        return response
+
     def _make_request(
         self,
         endpoint: str,
         params: dict[str, str] | None = None,
         cache_expire: int | None = None,
     ) -> dict:
-        url = self.BASE_URL + endpoint
-
-        try:
-            response = self._get_cached_response(endpoint, params, cache_expire)
-        except FileNotFoundError:
-            response = self._make_request_raw(url, params)
-            self._cache_request(endpoint, params, response)
+        # Identical requests issued concurrently share a single network call
+        response = self._single_flight.do(
+            self._hash_request(endpoint, params),
+            lambda: self._get_or_fetch_response(endpoint, params, cache_expire),
+        )
 
         try:
             response_json = json.loads(response)
@@ -115,14 +405,22 @@ class FipeApi:
             raise exc
 
         if "erro" in response_json:
-            logger.error("Error: %s", response_json.get("erro"))
-            raise exceptions.FipeApiRequestException(response_json.get("erro"))
+            logger.debug("Error: %s", response_json.get("erro"))
+            raise exceptions.FipeApiErrorResponseException(response_json.get("erro"))
 
         return response_json
 
-    def get_reference_tables(self) -> schemas.FipeApiReferenceTablesResponseSchema:
+    def close(self) -> None:
+        with self._hedge_executor_lock:
+            if self._hedge_executor is not None:
+                self._hedge_executor.shutdown(wait=False, cancel_futures=True)
+                self._hedge_executor = None
+
+    def get_reference_tables(
+        self, cache_expire: int | None = ONE_MONTH
+    ) -> schemas.FipeApiReferenceTablesResponseSchema:
         reference_tables_response = self._make_request(
-            "/ConsultarTabelaDeReferencia", cache_expire=ONE_MONTH
+            "/ConsultarTabelaDeReferencia", cache_expire=cache_expire
         )
 
         return schemas.FipeApiReferenceTablesResponseSchema(
@@ -163,12 +461,9 @@ class FipeApi:
             "codigoTipoVeiculo": str(vehicle_type_id),
         }
 
-        if _params["codigoTipoVeiculo"] == "3":
-            breakpoint()
-
         try:
             car_models_response = self._make_request("/ConsultarModelos", _params)
-        except exceptions.FipeApiRequestException as exc:
+        except exceptions.FipeApiErrorResponseException as exc:
             logger.error("Error fetching car models: %s", exc)
             raise exceptions.CarModelDoesNotExistException(
                 "No car model found with the given parameters %s" % (_params)
@@ -192,13 +487,21 @@ class FipeApi:
             "codigoTipoVeiculo": str(vehicle_type_id),
         }
 
-        car_model_years_response = self._make_request("/ConsultarAnoModelo", _params)
+        try:
+            car_model_years_response = self._make_request(
+                "/ConsultarAnoModelo", _params
+            )
+        except exceptions.FipeApiErrorResponseException as exc:
+            logger.error("Error fetching car model years: %s", exc)
+            raise exceptions.CarModelDoesNotExistException(
+                "No car model years found with the given parameters %s" % (_params)
+            ) from exc
 
         return schemas.FipeApiCarModelYearsResponseSchema(
             car_model_years=car_model_years_response
         )
 
-    def get_price(
+    def get_price_response(
         self,
         reference_table_id: int | str,
         manufacturer_id: int | str,
@@ -206,7 +509,8 @@ class FipeApi:
         car_model_year: int | str,
         vehicle_type_id: int | str = 1,
         fuel_type_id: int | str = 1,
-    ) -> schemas.FipeApiCarPriceResponseSchema:
+    ) -> dict:
+        """Fetch the raw price payload, without validating it into a schema."""
         _params = {
             "codigoTabelaReferencia": str(reference_table_id),
             "codigoMarca": str(manufacturer_id),
@@ -218,16 +522,38 @@ class FipeApi:
         }
 
         try:
-            car_price_response = self._make_request(
-                "/ConsultarValorComTodosParametros", _params
-            )
-        except exceptions.FipeApiRequestException as exc:
+            return self._make_request("/ConsultarValorComTodosParametros", _params)
+        except exceptions.FipeApiErrorResponseException as exc:
             logger.error("Error fetching price: %s", exc)
             raise exceptions.CarPriceDoesNotExistException(
                 "Price does not exist for the given parameters"
             ) from exc
 
+    @staticmethod
+    def parse_price_response(
+        car_price_response: dict,
+    ) -> schemas.FipeApiCarPriceResponseSchema:
         return schemas.FipeApiCarPriceResponseSchema(
             raw_data=car_price_response,
             **car_price_response,
         )
+
+    def get_price(
+        self,
+        reference_table_id: int | str,
+        manufacturer_id: int | str,
+        car_model_id: int | str,
+        car_model_year: int | str,
+        vehicle_type_id: int | str = 1,
+        fuel_type_id: int | str = 1,
+    ) -> schemas.FipeApiCarPriceResponseSchema:
+        car_price_response = self.get_price_response(
+            reference_table_id,
+            manufacturer_id,
+            car_model_id,
+            car_model_year,
+            vehicle_type_id,
+            fuel_type_id,
+        )
+
+        return self.parse_price_response(car_price_response)
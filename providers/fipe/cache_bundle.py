@@ -0,0 +1,436 @@
+"""Portable bundles of the FIPE response cache, to warm-start new crawl nodes.
+
+A bundle is a `.tar.xz` holding a `manifest.json` and the cached responses stored
+once per content hash under `objects/<sha256>`. The manifest maps every cache key
+(the file name in `cache/fipe_raw_responses` or `cache/fipe_negative_responses`) to
+its object, original mtime and, when known, the request behind it. The bundle is
+named after the sha256 of its manifest, so a name pins down its whole content:
+
+    export_bundle(reference_table_ids=["308"])  # cache/bundles/<digest>.tar.xz
+    export_bundle(incremental=True)  # only what earlier bundles do not have
+    import_bundle("cache/bundles/<digest>.tar.xz")
+
+Responses are picked per reference table through the request index written by
+`FipeApi` (`cache_index_path`); responses cached before the index existed only go
+into full bundles. Imports check every object against its hash and never overwrite
+a local response that is newer than the bundled one.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tarfile
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator, Literal
+
+from providers.fipe.api import FipeApi, cache_index_path
+from providers.fipe.exceptions import CacheBundleIntegrityException
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_DIR = "cache/bundles"
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+
+# Requests shared by every reference table, ex. the reference table list itself
+_SHARED_ENDPOINTS = ("/ConsultarTabelaDeReferencia",)
+
+_KEY = re.compile(r"^[0-9a-f]{64}$")
+_BUNDLE_NAME = re.compile(r"^([0-9a-f]{64})\.tar\.xz$")
+
+
+@dataclass
+class BundleEntry:
+    kind: Literal["response", "negative"]
+    key: str
+    sha256: str
+    size: int
+    mtime: float
+    endpoint: str | None = None
+    params: dict | None = None
+
+
+def read_cache_index(cache_dir: str = FipeApi.REQUEST_CACHE_DIR) -> dict[str, dict]:
+    """`{key: {"endpoint", "params"}}` of the indexed requests, last line wins."""
+    index = {}
+    try:
+        with open(cache_index_path(cache_dir), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line of an interrupted write
+                    continue
+                index[entry["key"]] = entry
+    except FileNotFoundError:
+        pass
+
+    return index
+
+
+def _sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _cached_keys(directory: str) -> Iterator[str]:
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+
+    for name in sorted(names):
+        key, extension = os.path.splitext(name)
+        if extension == ".json" and _KEY.match(key):
+            yield key
+
+
+def _scan_cache(
+    cache_dir: str,
+    negative_cache_dir: str,
+    reference_table_ids: Iterable[str] | None,
+) -> Iterator[tuple[BundleEntry, bytes]]:
+    index = read_cache_index(cache_dir)
+    wanted = set(reference_table_ids) if reference_table_ids is not None else None
+
+    unindexed = 0
+    for kind, directory in (("response", cache_dir), ("negative", negative_cache_dir)):
+        for key in _cached_keys(directory):
+            request = index.get(key)
+            if wanted is not None:
+                if request is None:
+                    unindexed += 1
+                    continue
+                params = request["params"] or {}
+                if (
+                    params.get("codigoTabelaReferencia") not in wanted
+                    and request["endpoint"] not in _SHARED_ENDPOINTS
+                ):
+                    continue
+
+            path = os.path.join(directory, f"{key}.json")
+            try:
+                mtime = os.path.getmtime(path)
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # Expired and removed by a running crawl
+                continue
+
+            yield (
+                BundleEntry(
+                    kind=kind,
+                    key=key,
+                    sha256=_sha256_bytes(data),
+                    size=len(data),
+                    mtime=mtime,
+                    endpoint=request["endpoint"] if request else None,
+                    params=request["params"] if request else None,
+                ),
+                data,
+            )
+
+    if unindexed:
+        logger.warning(
+            "Skipped %s cached responses without request metadata, only full bundles "
+            "include them",
+            unindexed,
+        )
+
+
+def read_manifest(path: str) -> dict:
+    """Manifest of a bundle, from its `.manifest.json` sidecar when there is one."""
+    sidecar = _sidecar_path(path)
+    if os.path.exists(sidecar):
+        with open(sidecar, encoding="utf-8") as f:
+            return json.load(f)
+
+    with tarfile.open(path, "r|xz") as tar:
+        member = tar.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise CacheBundleIntegrityException(
+                f"{path} does not start with a manifest"
+            )
+        return json.load(tar.extractfile(member))
+
+
+def _sidecar_path(path: str) -> str:
+    return re.sub(r"\.tar\.xz$", "", path) + ".manifest.json"
+
+
+def list_bundles(bundle_dir: str = BUNDLE_DIR) -> list[str]:
+    """Bundles of `bundle_dir`, oldest first."""
+    try:
+        names = os.listdir(bundle_dir)
+    except FileNotFoundError:
+        return []
+
+    paths = [
+        os.path.join(bundle_dir, name) for name in names if _BUNDLE_NAME.match(name)
+    ]
+    return sorted(paths, key=lambda path: read_manifest(path)["created_at"])
+
+
+def export_bundle(
+    reference_table_ids: Iterable[str] | None = None,
+    incremental: bool = False,
+    bundle_dir: str = BUNDLE_DIR,
+    cache_dir: str = FipeApi.REQUEST_CACHE_DIR,
+    negative_cache_dir: str = FipeApi.NEGATIVE_CACHE_DIR,
+    preset: int = 6,
+) -> str | None:
+    """Pack cached responses into a bundle in `bundle_dir`.
+
+    Args:
+        - reference_table_ids (Iterable[str] | None): Only bundle these reference
+            tables, every cached response if None.
+        - incremental (bool): Leave out the responses already in the bundles of
+            `bundle_dir`, unchanged.
+        - preset (int): xz compression preset, 0 (fast) to 9 (small).
+
+    Returns:
+        - str | None: Path of the bundle, None if there was nothing to bundle.
+    """
+    if reference_table_ids is not None:
+        reference_table_ids = sorted(reference_table_ids)
+
+    parents = []
+    bundled = set()
+    if incremental:
+        for path in list_bundles(bundle_dir):
+            manifest = read_manifest(path)
+            parents.append(manifest["bundle_id"])
+            bundled.update(
+                (entry["kind"], entry["key"], entry["sha256"])
+                for entry in manifest["entries"]
+            )
+
+    # The manifest goes first in the bundle but is only known once every response
+    # has been read: objects are spooled to an uncompressed temporary tar meanwhile,
+    # which keeps memory flat and the manifest consistent with the objects
+    entries = []
+    digests = set()
+    with tempfile.TemporaryFile() as spool:
+        with tarfile.open(fileobj=spool, mode="w") as spool_tar:
+            for entry, data in _scan_cache(
+                cache_dir, negative_cache_dir, reference_table_ids
+            ):
+                if (entry.kind, entry.key, entry.sha256) in bundled:
+                    continue
+                entries.append(entry)
+                if entry.sha256 not in digests:
+                    digests.add(entry.sha256)
+                    _add_file(spool_tar, f"objects/{entry.sha256}", data)
+
+        if not entries:
+            logger.info("Nothing to bundle")
+            return None
+
+        spool.seek(0)
+        path = _write_bundle(
+            bundle_dir, reference_table_ids, parents, entries, spool, preset
+        )
+
+    logger.info(
+        "Bundled %s responses (%s distinct) into %s (%s bytes)",
+        len(entries),
+        len(digests),
+        path,
+        os.path.getsize(path),
+    )
+    return path
+
+
+def _write_bundle(
+    bundle_dir: str,
+    reference_table_ids: list[str] | None,
+    parents: list[str],
+    entries: list[BundleEntry],
+    spool: IO[bytes],
+    preset: int,
+) -> str:
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "reference_table_ids": reference_table_ids,
+        "parents": parents,
+        "entries": [entry.__dict__ for entry in entries],
+    }
+    manifest_bytes = json.dumps(manifest, sort_keys=True).encode()
+    bundle_id = _sha256_bytes(manifest_bytes)
+    # `created_at` and `bundle_id` stay out of the digest: the same responses always
+    # make the same bundle
+    manifest_bytes = json.dumps(
+        dict(manifest, bundle_id=bundle_id, created_at=time.time()), sort_keys=True
+    ).encode()
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    path = os.path.join(bundle_dir, f"{bundle_id}.tar.xz")
+    _tmp_path = f"{path}.{os.getpid()}.tmp"
+    with (
+        tarfile.open(_tmp_path, "w:xz", preset=preset) as tar,
+        tarfile.open(fileobj=spool, mode="r:") as spool_tar,
+    ):
+        _add_file(tar, MANIFEST_NAME, manifest_bytes)
+        for member in spool_tar:
+            tar.addfile(member, spool_tar.extractfile(member))
+    os.replace(_tmp_path, path)
+
+    with open(_sidecar_path(path), "wb") as f:
+        f.write(manifest_bytes)
+
+    return path
+
+
+def _add_file(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _verify_manifest(path: str, manifest_bytes: bytes) -> dict:
+    manifest = json.loads(manifest_bytes)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise CacheBundleIntegrityException(
+            f"Unsupported bundle format {manifest.get('format_version')}"
+        )
+
+    digest = _sha256_bytes(
+        json.dumps(
+            {
+                name: value
+                for name, value in manifest.items()
+                if name not in ("bundle_id", "created_at")
+            },
+            sort_keys=True,
+        ).encode()
+    )
+    if digest != manifest.get("bundle_id"):
+        raise CacheBundleIntegrityException(f"Manifest of {path} was modified")
+
+    name = _BUNDLE_NAME.match(os.path.basename(path))
+    if name is not None and name.group(1) != digest:
+        raise CacheBundleIntegrityException(f"{path} does not match its name")
+
+    for entry in manifest["entries"]:
+        if not _KEY.match(entry["key"]) or entry["kind"] not in (
+            "response",
+            "negative",
+        ):
+            raise CacheBundleIntegrityException(f"Invalid entry in {path}: {entry}")
+
+    return manifest
+
+
+def _write_cached(path: str, data: bytes, mtime: float) -> bool:
+    try:
+        if os.path.getmtime(path) >= mtime:
+            # The local response is as recent or newer
+            return False
+    except FileNotFoundError:
+        pass
+
+    _tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(_tmp_path, "wb") as f:
+        f.write(data)
+    # Keep the original age, so cache expiry works as on the exporting node
+    os.utime(_tmp_path, (mtime, mtime))
+    os.replace(_tmp_path, path)
+    return True
+
+
+def import_bundle(
+    path: str,
+    cache_dir: str = FipeApi.REQUEST_CACHE_DIR,
+    negative_cache_dir: str = FipeApi.NEGATIVE_CACHE_DIR,
+) -> dict:
+    """Verify a bundle and write its responses into the local cache.
+
+    The bundle is read in a single streaming pass. Every object is checked against
+    its hash before being written, so a corrupted bundle raises
+    `CacheBundleIntegrityException` without writing anything bad.
+
+    Returns:
+        - dict: Counts of `written` and `skipped` (local copy as recent) responses.
+    """
+    directories = {"response": cache_dir, "negative": negative_cache_dir}
+    for directory in directories.values():
+        os.makedirs(directory, exist_ok=True)
+
+    written = skipped = 0
+    with tarfile.open(path, "r|xz") as tar:
+        member = tar.next()
+        if member is None or member.name != MANIFEST_NAME:
+            raise CacheBundleIntegrityException(
+                f"{path} does not start with a manifest"
+            )
+        manifest = _verify_manifest(path, tar.extractfile(member).read())
+
+        entries_by_object: dict[str, list[dict]] = {}
+        for entry in manifest["entries"]:
+            entries_by_object.setdefault(entry["sha256"], []).append(entry)
+
+        # `tar.next()`, iterating the stream would start over at the manifest
+        while (member := tar.next()) is not None:
+            digest = member.name.removeprefix("objects/")
+            if digest not in entries_by_object:
+                raise CacheBundleIntegrityException(
+                    f"Unexpected member {member.name} in {path}"
+                )
+
+            data = tar.extractfile(member).read()
+            if _sha256_bytes(data) != digest:
+                raise CacheBundleIntegrityException(
+                    f"{member.name} of {path} is corrupt"
+                )
+
+            for entry in entries_by_object.pop(digest):
+                _path = os.path.join(directories[entry["kind"]], f"{entry['key']}.json")
+                if _write_cached(_path, data, entry["mtime"]):
+                    written += 1
+                else:
+                    skipped += 1
+
+    if entries_by_object:
+        raise CacheBundleIntegrityException(
+            f"{path} is missing {len(entries_by_object)} objects"
+        )
+
+    # Index the imported requests, so this node can bundle them per reference table
+    indexed = [entry for entry in manifest["entries"] if entry["endpoint"]]
+    if indexed:
+        with open(cache_index_path(cache_dir), "a", encoding="utf-8") as f:
+            f.writelines(
+                json.dumps(
+                    {
+                        "key": entry["key"],
+                        "endpoint": entry["endpoint"],
+                        "params": entry["params"],
+                    },
+                    separators=(",", ":"),
+                )
+                + "\n"
+                for entry in indexed
+            )
+
+    logger.info(
+        "Imported %s: %s responses written, %s already up to date",
+        path,
+        written,
+        skipped,
+    )
+    return {"bundle_id": manifest["bundle_id"], "written": written, "skipped": skipped}
+
+
+__all__ = [
+    "BUNDLE_DIR",
+    "BundleEntry",
+    "export_bundle",
+    "import_bundle",
+    "list_bundles",
+    "read_cache_index",
+    "read_manifest",
+]
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+from providers.fipe import exceptions
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Stops every worker from hammering the FIPE API while it is down.
+
+    closed:    requests flow; `failure_threshold` consecutive failures open the circuit.
+    open:      callers of `acquire` wait until `recovery_timeout` has elapsed.
+    half open: at most `half_open_max_calls` probe requests go through at a time.
+               `success_threshold` successful probes close the circuit again, a
+               single failed probe reopens it.
+
+    `acquire` returns whether the caller is a probe, which must be handed back to
+    `record_success` / `record_failure` (or `release`) once the request is done.
+
+    Args:
+        - failure_threshold (int): Consecutive failures that open the circuit.
+        - recovery_timeout (float): Seconds the circuit stays open before probing.
+        - half_open_max_calls (int): Concurrent probe requests while half open.
+        - success_threshold (int): Successful probes needed to close the circuit.
+        - clock (Callable[[], float]): Monotonic clock, in seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 10,
+        recovery_timeout: float = 30.0,
+        half_open_max_calls: int = 1,
+        success_threshold: int = 2,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.success_threshold = success_threshold
+        self._clock = clock
+
+        self._condition = threading.Condition()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._successes = 0
+        self._probes = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        with self._condition:
+            self._refresh_state()
+            return self._state
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        """Wait until a request may be sent. Returns whether it is a probe.
+
+        Raises `CircuitOpenException` if no request was allowed within `timeout`
+        seconds (`None` waits for as long as it takes).
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+
+        with self._condition:
+            while True:
+                self._refresh_state()
+                if self._state == self.CLOSED:
+                    return False
+
+                if (
+                    self._state == self.HALF_OPEN
+                    and self._probes < self.half_open_max_calls
+                ):
+                    self._probes += 1
+                    return True
+
+                _wait = None
+                if self._state == self.OPEN:
+                    _wait = self._opened_at + self.recovery_timeout - self._clock()
+
+                if deadline is not None:
+                    _remaining = deadline - self._clock()
+                    if _remaining <= 0:
+                        raise exceptions.CircuitOpenException(
+                            f"FIPE API circuit is {self._state}"
+                        )
+                    _wait = _remaining if _wait is None else min(_wait, _remaining)
+
+                self._condition.wait(None if _wait is None else max(_wait, 0))
+
+    def record_success(self, probe: bool = False) -> None:
+        with self._condition:
+            if not probe:
+                if self._state == self.CLOSED:
+                    self._failures = 0
+                return
+
+            self._probes -= 1
+            if self._state != self.HALF_OPEN:
+                return
+
+            self._successes += 1
+            if self._successes >= self.success_threshold:
+                logger.warning("FIPE API recovered, closing circuit")
+                self._state = self.CLOSED
+                self._failures = 0
+
+            # Either everyone may go, or another probe slot is free
+            self._condition.notify_all()
+
+    def record_failure(self, probe: bool = False) -> None:
+        with self._condition:
+            if probe:
+                self._probes -= 1
+                if self._state == self.HALF_OPEN:
+                    logger.warning("FIPE API probe failed, reopening circuit")
+                    self._open()
+                return
+
+            if self._state != self.CLOSED:
+                return
+
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                logger.warning(
+                    "%s consecutive FIPE API failures, opening circuit for %ss",
+                    self._failures,
+                    self.recovery_timeout,
+                )
+                self._open()
+
+    def release(self, probe: bool = False) -> None:
+        """Give back a probe slot for a request that was never sent or judged."""
+        if not probe:
+            return
+
+        with self._condition:
+            self._probes -= 1
+            self._condition.notify_all()
+
+    def _open(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._successes = 0
+        self._condition.notify_all()
+
+    def _refresh_state(self) -> None:
+        if (
+            self._state == self.OPEN
+            and self._clock() - self._opened_at >= self.recovery_timeout
+        ):
+            self._state = self.HALF_OPEN
+            self._successes = 0
+
+
+__all__ = ["CircuitBreaker"]
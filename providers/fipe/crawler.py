@@ -1,12 +1,19 @@
 import logging
-from typing import Literal
+from typing import Iterable, Literal
 
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
-from db import services as db_services
+from db import readers as db_readers
+from db.coverage import CoverageGap
 from db.engine import create_db_engine
+from db.models.all_models import ArchivedReferenceTable
 from providers.fipe.api import FipeApi
+from providers.fipe.exceptions import CarModelDoesNotExistException
+from providers.fipe.pipeline import FAILED_JOBS_FILE, PriceJob, PricePipeline
+from providers.fipe.prefetch import ListingPrefetcher
+from providers.fipe.profiling import stage_timer
 from providers.fipe.services import FipeDatabaseRepository
 
 logger = logging.getLogger(__name__)
@@ -14,15 +21,48 @@ logger = logging.getLogger(__name__)
 
 class FipeCrawler:
     def __init__(
-        self, order: Literal["ASC", "DESC"] = "ASC", checkpoint: dict | None = None
+        self,
+        order: Literal["ASC", "DESC"] = "ASC",
+        checkpoint: dict | None = None,
+        prefetch_window: int = 4,
+        fetch_workers: int = 4,
+        parse_workers: int = 1,
+        persist_workers: int = 1,
+        queue_size: int = 64,
+        offline: bool = False,
+        storage_mode: Literal["full", "changes"] = "full",
+        hedge: bool = False,
+        failed_jobs_file: str | None = FAILED_JOBS_FILE,
     ) -> None:
-        self.fipe_api = FipeApi()
-        self.fipe_db_repo = FipeDatabaseRepository()
-        self.db_session = Session(bind=create_db_engine())
+        _engine = create_db_engine()
+
+        self.fipe_api = FipeApi(offline=offline, hedge=hedge)
+        self.fipe_db_repo = FipeDatabaseRepository(_engine)
+        self.db_session = Session(bind=_engine)
+        self.prefetcher = ListingPrefetcher(window=prefetch_window)
+        self.price_pipeline = PricePipeline(
+            self.fipe_api,
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            persist_workers=persist_workers,
+            queue_size=queue_size,
+            repository_factory=lambda: FipeDatabaseRepository(_engine),
+            storage_mode=storage_mode,
+            failed_jobs_file=failed_jobs_file,
+        )
 
         self._order = order
         self._checkpoint = checkpoint or {}
 
+        # Listings FIPE answered do not exist, skipped instead of stopping the crawl
+        self.missing_listings = 0
+
+        # Prices of archived months live in Parquet files, writing them to `preco`
+        # again would duplicate them
+        self._archived_reference_table_ids = set(
+            self.db_session.scalars(select(ArchivedReferenceTable.reference_table_id))
+        )
+
     def populate_reference_tables(self, vehicle_type_id: int = 1):
         if self._order == "ASC":
             if "year" not in self._checkpoint:
@@ -42,8 +82,8 @@ class FipeCrawler:
     def populate_reference_tables_in_descending_order(
         self, year_gte: int = 2002, vehicle_type_id: int = 1
     ):
-        _reference_tables = db_services.list_reference_tables(
-            self.db_session, year_gte=year_gte
+        _reference_tables = db_readers.read_reference_tables(
+            self.db_session, year_gte=year_gte, descending=True
         )
         _checkpoint_year = self._checkpoint["year"]
         _checkpoint_month = self._checkpoint["month"]
@@ -73,7 +113,7 @@ class FipeCrawler:
     def populate_reference_tables_in_ascending_order(
         self, year_lte: int = 2002, vehicle_type_id: int = 1
     ):
-        _reference_tables = db_services.list_reference_tables(
+        _reference_tables = db_readers.read_reference_tables(
             self.db_session, year_lte=year_lte
         )
         _checkpoint_year = self._checkpoint.get("year", 0)
@@ -102,18 +142,37 @@ class FipeCrawler:
     def populate_prices_for_reference_table(
         self, reference_table_id: str, vehicle_type_id: int = 1
     ):
+        if reference_table_id in self._archived_reference_table_ids:
+            logger.info("Skipping archived reference table %s", reference_table_id)
+            return
+
         manufacturers_response = self.fipe_api.get_manufacturers(
             reference_table_id, vehicle_type_id
         )
-        self.fipe_db_repo.persist_manufacturers(manufacturers_response, vehicle_type_id)
+        with stage_timer.time("persist.listings"):
+            self.fipe_db_repo.persist_manufacturers(
+                manufacturers_response, vehicle_type_id
+            )
 
         manufacturers = sorted(
             manufacturers_response.manufacturers, key=lambda x: int(x.code)
         )
         _checkpoint_manufacturer = self._checkpoint.get("manufacturer", 0)
-        for manufacturer in tqdm(manufacturers, desc="Marcas"):
-            if int(manufacturer.code) < _checkpoint_manufacturer:
-                continue
+        manufacturers = [
+            manufacturer
+            for manufacturer in manufacturers
+            if int(manufacturer.code) >= _checkpoint_manufacturer
+        ]
+        for index, manufacturer in enumerate(tqdm(manufacturers, desc="Marcas")):
+            # Keep the car models of the next manufacturers in flight while this one
+            # is being crawled
+            self.prefetcher.schedule_many(
+                self.fipe_api.get_car_models,
+                [
+                    (reference_table_id, upcoming.code, vehicle_type_id)
+                    for upcoming in manufacturers[index:]
+                ],
+            )
 
             logger.info("Marca: %s", manufacturer.display_name)
 
@@ -129,18 +188,46 @@ class FipeCrawler:
     def populate_prices_for_manufacturer(
         self, reference_table_id: str, manufacturer_id: str, vehicle_type_id: int = 1
     ):
-        car_models_response = self.fipe_api.get_car_models(
-            reference_table_id=reference_table_id,
-            manufacturer_id=manufacturer_id,
-            vehicle_type_id=vehicle_type_id,
-        )
-        self.fipe_db_repo.persist_car_models(car_models_response, manufacturer_id)
+        try:
+            car_models_response = self.prefetcher.get(
+                self.fipe_api.get_car_models,
+                reference_table_id,
+                manufacturer_id,
+                vehicle_type_id,
+            )
+        except CarModelDoesNotExistException as exc:
+            logger.info("Skipping manufacturer %s: %s", manufacturer_id, exc)
+            self.missing_listings += 1
+            return
+
+        with stage_timer.time("persist.listings"):
+            self.fipe_db_repo.persist_car_models(
+                car_models_response, manufacturer_id, vehicle_type_id
+            )
 
         car_models = sorted(car_models_response.car_models, key=lambda x: int(x.code))
         _checkpoint_model = self._checkpoint.get("model", 0)
-        for car_model in tqdm(car_models, desc="Modelos", leave=False):
-            if int(car_model.code) < _checkpoint_model:
-                continue
+        car_models = [
+            car_model
+            for car_model in car_models
+            if int(car_model.code) >= _checkpoint_model
+        ]
+        for index, car_model in enumerate(
+            tqdm(car_models, desc="Modelos", leave=False)
+        ):
+            # Model years of the next models are fetched while prices of this one are
+            self.prefetcher.schedule_many(
+                self.fipe_api.get_car_model_years,
+                [
+                    (
+                        reference_table_id,
+                        manufacturer_id,
+                        upcoming.code,
+                        vehicle_type_id,
+                    )
+                    for upcoming in car_models[index:]
+                ],
+            )
 
             logger.info("\tModelo: %s", car_model.display_name)
 
@@ -159,37 +246,96 @@ class FipeCrawler:
         model_id: str,
         vehicle_type_id: int = 1,
     ):
-        car_model_years_response = self.fipe_api.get_car_model_years(
-            reference_table_id, manufacturer_id, model_id, vehicle_type_id
-        )
-        self.fipe_db_repo.persist_car_model_years(car_model_years_response, model_id)
+        try:
+            car_model_years_response = self.prefetcher.get(
+                self.fipe_api.get_car_model_years,
+                reference_table_id,
+                manufacturer_id,
+                model_id,
+                vehicle_type_id,
+            )
+        except CarModelDoesNotExistException as exc:
+            logger.info("Skipping car model %s: %s", model_id, exc)
+            self.missing_listings += 1
+            return
+
+        with stage_timer.time("persist.listings"):
+            self.fipe_db_repo.persist_car_model_years(
+                car_model_years_response, manufacturer_id, model_id, vehicle_type_id
+            )
 
         car_model_years = sorted(
             car_model_years_response.car_model_years,
             key=lambda x: int(x.code.split("-")[0]),
         )
-        for car_model_year in tqdm(car_model_years, desc="AnoModelo", leave=False):
-            year_str, fuel_type_str = car_model_year.code.split("-")
-
+        for car_model_year in car_model_years:
             logger.debug("\t\tAno-modelo: %s", car_model_year.display_name)
 
-            car_price = self.fipe_api.get_price(
-                reference_table_id,
-                manufacturer_id,
-                model_id,
-                year_str,
-                vehicle_type_id,
-                fuel_type_str,
+            # Blocks only when the pipeline is saturated
+            self.price_pipeline.submit(
+                PriceJob(
+                    reference_table_id=reference_table_id,
+                    manufacturer_id=manufacturer_id,
+                    model_id=model_id,
+                    model_year_id=car_model_year.code,
+                    vehicle_type_id=vehicle_type_id,
+                    checkpoint=dict(self._checkpoint),
+                )
             )
 
-            self.fipe_db_repo.persist_car_price(
-                car_price,
-                manufacturer_id,
-                model_id,
-                car_model_year.code,
-                vehicle_type_id,
-                reference_table_id,
+    def populate_prices_for_gaps(self, gaps: Iterable[CoverageGap]) -> int:
+        """Crawl only the given missing prices, ex. from `PriceCoverage.gaps()` or
+        `load_failed_jobs()`.
+
+        Returns:
+            - int: Number of prices submitted.
+        """
+        submitted = 0
+        for gap in tqdm(gaps, desc="Lacunas"):
+            if gap.reference_table_id in self._archived_reference_table_ids:
+                continue
+
+            self.price_pipeline.submit(
+                PriceJob(
+                    reference_table_id=gap.reference_table_id,
+                    manufacturer_id=gap.manufacturer_id,
+                    model_id=gap.model_id,
+                    model_year_id=gap.model_year_id,
+                    vehicle_type_id=gap.vehicle_type_id,
+                )
             )
+            submitted += 1
+
+        return submitted
+
+    @property
+    def failed_prices(self) -> int:
+        return self.price_pipeline.failed_jobs
+
+    @property
+    def cancelled_prices(self) -> int:
+        return len(self.price_pipeline.cancelled_jobs)
 
     def get_checkpoint(self):
+        """Where to resume: before the first price cancelled by an open circuit, if
+        any, so call it after `close`."""
+        _resume = self.price_pipeline.resume_checkpoint()
+        if _resume is not None:
+            return dict(_resume)
+
         return self._checkpoint
+
+    def close(self):
+        """Stop prefetching and wait until every submitted price is persisted."""
+        self.prefetcher.close()
+        self.price_pipeline.close()
+        self.fipe_api.close()
+
+        logger.info(
+            "Skipped %s missing listings and %s missing prices, %s prices failed, "
+            "%s cancelled",
+            self.missing_listings,
+            self.price_pipeline.missing_prices,
+            self.price_pipeline.failed_jobs,
+            len(self.price_pipeline.cancelled_jobs),
+        )
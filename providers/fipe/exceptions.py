@@ -2,9 +2,26 @@ class FipeApiRequestException(Exception):
     pass
 
 
+class FipeApiCacheMissException(FipeApiRequestException):
+    """Raised in offline mode when a response is not in the local cache."""
+
+
 class CarPriceDoesNotExistException(Exception):
     pass
 
 
 class CarModelDoesNotExistException(Exception):
     pass
+
+
+class CircuitOpenException(FipeApiRequestException):
+    """Raised when the FIPE API circuit stays open longer than a caller will wait."""
+
+
+class FipeApiErrorResponseException(FipeApiRequestException):
+    """Raised when the FIPE API answers with an `erro` payload, ex. a model year that
+    has no price in the requested reference table."""
+
+
+class CacheBundleIntegrityException(Exception):
+    """Raised when a cache bundle does not match its name, manifest or hashes."""
@@ -0,0 +1,111 @@
+import math
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """Rolling latency percentiles per endpoint, used to size request timeouts.
+
+    Until an endpoint has `min_samples` observations its timeout is
+    `default_timeout`. After that it is `timeout_multiplier` times the p99 of the
+    last `window` requests, clamped to `[min_timeout, max_timeout]`, so a request
+    stuck on a slow backend is abandoned (and retried) after a few typical
+    round trips instead of the full default.
+
+    Args:
+        - window (int): Number of recent latencies kept per endpoint.
+        - min_samples (int): Observations needed before percentiles are trusted.
+        - default_timeout (float): Timeout, in seconds, while warming up.
+        - min_timeout (float): Lower bound of the adaptive timeout.
+        - max_timeout (float): Upper bound of the adaptive timeout.
+        - timeout_multiplier (float): Timeout as a multiple of the p99 latency.
+    """
+
+    def __init__(
+        self,
+        window: int = 500,
+        min_samples: int = 20,
+        default_timeout: float = 10.0,
+        min_timeout: float = 1.0,
+        max_timeout: float = 10.0,
+        timeout_multiplier: float = 3.0,
+    ) -> None:
+        self.window = window
+        self.min_samples = min_samples
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+
+        self._lock = threading.Lock()
+        self._samples: dict[str, deque[float]] = {}
+
+    def observe(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, endpoint: str, q: float) -> float | None:
+        """The `q` (0-100) percentile of the endpoint latency, `None` while warming
+        up."""
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            _sorted = sorted(samples)
+
+        # Nearest-rank percentile
+        rank = max(math.ceil(q / 100 * len(_sorted)), 1)
+        return _sorted[rank - 1]
+
+    def timeout(self, endpoint: str) -> float:
+        p99 = self.percentile(endpoint, 99)
+        if p99 is None:
+            return self.default_timeout
+
+        return min(
+            max(p99 * self.timeout_multiplier, self.min_timeout), self.max_timeout
+        )
+
+    def hedge_delay(self, endpoint: str) -> float | None:
+        """How long to wait for a request before hedging it: the p95 latency."""
+        return self.percentile(endpoint, 95)
+
+
+class HedgeBudget:
+    """Caps hedged requests to a fraction of all requests.
+
+    Every request earns `ratio` of a hedge, and `burst` hedges may be spent before
+    any was earned. With the default ratio hedging can add at most 5% to the
+    requests sent to FIPE, so it never becomes a load amplifier when the backend
+    is slow across the board.
+
+    Args:
+        - ratio (float): Hedges allowed per request sent.
+        - burst (int): Hedges allowed upfront.
+    """
+
+    def __init__(self, ratio: float = 0.05, burst: int = 10) -> None:
+        self.ratio = ratio
+        self.burst = burst
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.requests * self.ratio + self.burst:
+                return False
+
+            self.hedges += 1
+            return True
+
+
+__all__ = ["HedgeBudget", "LatencyTracker"]
@@ -0,0 +1,460 @@
+"""Staged price crawl: fetch -> parse -> persist.
+
+Each stage runs its own pool of worker threads and the stages are joined by bounded
+queues, so a slow commit only blocks the fetchers once the queues in between are full
+(backpressure), instead of stalling every request.
+
+    crawler --submit()--> [fetch] --queue--> [parse] --queue--> [persist] --> Postgres
+
+A job that fails in any stage is appended to `failed_jobs_file` as a JSON line, and
+`python main.py repair` crawls those again. When a statement fails, the rest of the
+uncommitted batch is written again one price per commit, so only the failing prices
+are lost.
+
+When the FIPE API circuit stays open longer than a request waits, the queued jobs are
+cancelled without calling the API and `submit` raises `CircuitOpenException`. A crawl
+then resumes from the checkpoint of the first cancelled job, see `resume_checkpoint`.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Literal
+
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+
+from db.coverage import CoverageGap
+from providers.fipe import exceptions, schemas
+from providers.fipe.api import FipeApi
+from providers.fipe.profiling import stage_timer
+from providers.fipe.services import FipeDatabaseRepository
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+FAILED_JOBS_FILE = "failed_jobs.jsonl"
+
+# What a single job can fail with, anything else is a bug
+_JOB_ERRORS = (
+    exceptions.FipeApiRequestException,
+    ValidationError,
+    SQLAlchemyError,
+    LookupError,
+    ValueError,
+    OSError,
+)
+
+
+@dataclass
+class PriceJob:
+    """A single (reference table, model year) price to crawl."""
+
+    reference_table_id: str
+    manufacturer_id: str
+    model_id: str
+    model_year_id: str
+    vehicle_type_id: int = 1
+
+    # Crawler checkpoint when the job was submitted, to resume from if it is cancelled
+    checkpoint: dict | None = field(default=None, repr=False)
+    sequence: int = field(default=0, repr=False)
+
+    response: dict | None = field(default=None, repr=False)
+    car_price: schemas.FipeApiCarPriceResponseSchema | None = field(
+        default=None, repr=False
+    )
+
+
+class _Stage:
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any, PriceJob], PriceJob | None],
+        workers: int,
+        inbox: queue.Queue,
+        outbox: queue.Queue | None,
+        on_error: Callable[..., None],
+        make_context: Callable[[], Any] | None = None,
+        flush: Callable[[Any], None] | None = None,
+        route: Callable[[PriceJob], Any] | None = None,
+    ) -> None:
+        self.name = name
+        self.inbox = inbox
+        self._handler = handler
+        self._outbox = outbox
+        self._on_error = on_error
+        self._make_context = make_context
+        self._flush = flush
+        self._route = route
+
+        workers = max(workers, 1)
+        # With `route`, every job with the same route key goes to the same worker,
+        # through a queue of its own
+        self._inboxes = (
+            [queue.Queue(maxsize=inbox.maxsize) for _ in range(workers)]
+            if route is not None
+            else [inbox] * workers
+        )
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(self._inboxes[i],),
+                name=f"fipe-{name}-{i}",
+                daemon=True,
+            )
+            for i in range(workers)
+        ]
+        if route is not None:
+            self._threads.append(
+                threading.Thread(
+                    target=self._dispatch, name=f"fipe-{name}-router", daemon=True
+                )
+            )
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """Let the workers finish everything already queued and wait for them."""
+        if self._route is not None:
+            # The router hands a stop to every worker
+            self.inbox.put(_STOP)
+        else:
+            for _ in self._threads:
+                self.inbox.put(_STOP)
+
+        for thread in self._threads:
+            thread.join()
+
+    def _dispatch(self) -> None:
+        while True:
+            job = self.inbox.get()
+            if job is _STOP:
+                break
+
+            _worker = hash(self._route(job)) % len(self._inboxes)
+            self._inboxes[_worker].put(job)
+
+        for inbox in self._inboxes:
+            inbox.put(_STOP)
+
+    def _run(self, inbox: queue.Queue) -> None:
+        context = self._make_context() if self._make_context else None
+
+        while True:
+            job = inbox.get()
+            if job is _STOP:
+                break
+
+            try:
+                result = self._handler(context, job)
+            except _JOB_ERRORS as exc:
+                self._on_error(self.name, job, exc)
+                continue
+
+            if result is not None and self._outbox is not None:
+                self._outbox.put(result)
+
+            # Nothing else waiting: good moment to flush what we have
+            if self._flush and inbox.empty():
+                self._flush_safely(context)
+
+        if self._flush:
+            self._flush_safely(context)
+
+    def _flush_safely(self, context: Any) -> None:
+        try:
+            self._flush(context)
+        except _JOB_ERRORS:
+            logger.exception("Failed to flush stage %s", self.name)
+
+
+class _PersistContext:
+    def __init__(self, repository: FipeDatabaseRepository) -> None:
+        self.repository = repository
+        # Written but not committed yet
+        self.pending: list[PriceJob] = []
+
+
+def _model_year_of(job: PriceJob) -> tuple:
+    return (job.vehicle_type_id, job.manufacturer_id, job.model_id, job.model_year_id)
+
+
+def load_failed_jobs(path: str = FAILED_JOBS_FILE) -> list[CoverageGap]:
+    """Prices recorded in a failed jobs file, once each, in the order they failed."""
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+
+    failed = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        _job = json.loads(line)
+        gap = CoverageGap(*(_job[name] for name in CoverageGap._fields))
+        failed[gap] = None
+
+    return list(failed)
+
+
+class PricePipeline:
+    """Bounded fetch -> parse -> persist pipeline for car prices.
+
+    Args:
+        - fipe_api: API client shared by the fetch workers.
+        - fetch_workers: Concurrent requests to the FIPE API.
+        - parse_workers: Threads validating responses into schemas.
+        - persist_workers: Threads writing to the database, each with its own session.
+        - queue_size: Capacity of each queue between stages. `submit` blocks once the
+            fetch queue is full.
+        - commit_every: Maximum number of prices written per database commit.
+        - repository_factory: Builds the repository of each persist worker.
+        - storage_mode: "full" writes every price to `preco`, "changes" only records
+            price changes in `preco_intervalo`.
+        - failed_jobs_file: JSON lines file the failed jobs are appended to, None to
+            only count them.
+    """
+
+    def __init__(
+        self,
+        fipe_api: FipeApi,
+        fetch_workers: int = 4,
+        parse_workers: int = 1,
+        persist_workers: int = 1,
+        queue_size: int = 64,
+        commit_every: int = 50,
+        repository_factory: Callable[[], FipeDatabaseRepository] | None = None,
+        storage_mode: Literal["full", "changes"] = "full",
+        failed_jobs_file: str | None = None,
+    ) -> None:
+        if storage_mode not in ("full", "changes"):
+            raise ValueError(f"Invalid storage mode: {storage_mode}")
+
+        self.fipe_api = fipe_api
+        self.commit_every = commit_every
+        self.storage_mode = storage_mode
+        self.failed_jobs_file = failed_jobs_file
+        self._repository_factory = repository_factory or FipeDatabaseRepository
+
+        self._errors_lock = threading.Lock()
+        self.failed_jobs = 0
+        # Prices FIPE answered do not exist, not failures
+        self.missing_prices = 0
+        # Jobs not fetched because the circuit opened
+        self.cancelled_jobs: list[PriceJob] = []
+        self._circuit_open = threading.Event()
+        self._submitted = 0
+        self._closed = False
+
+        fetch_queue = queue.Queue(maxsize=queue_size)
+        parse_queue = queue.Queue(maxsize=queue_size)
+        persist_queue = queue.Queue(maxsize=queue_size)
+
+        self._stages = [
+            _Stage(
+                "fetch",
+                self._fetch,
+                fetch_workers,
+                fetch_queue,
+                parse_queue,
+                self._on_error,
+            ),
+            _Stage(
+                "parse",
+                self._parse,
+                parse_workers,
+                parse_queue,
+                persist_queue,
+                self._on_error,
+            ),
+            _Stage(
+                "persist",
+                self._persist,
+                persist_workers,
+                persist_queue,
+                None,
+                self._on_error,
+                make_context=self._make_persist_context,
+                flush=self._commit,
+                # Intervals of a model year are read then rewritten, never by two
+                # workers at once
+                route=_model_year_of if storage_mode == "changes" else None,
+            ),
+        ]
+
+        for stage in self._stages:
+            stage.start()
+
+    def submit(self, job: PriceJob) -> None:
+        """Queue a job for fetching. Blocks while the pipeline is saturated.
+
+        Raises:
+            - CircuitOpenException: The FIPE API circuit opened, jobs are cancelled.
+        """
+        if self._closed:
+            raise RuntimeError("Pipeline is closed")
+
+        if self._circuit_open.is_set():
+            raise exceptions.CircuitOpenException("Price jobs cancelled, circuit open")
+
+        job.sequence = self._submitted
+        self._submitted += 1
+        self._stages[0].inbox.put(job)
+
+    def resume_checkpoint(self) -> dict | None:
+        """Checkpoint of the first cancelled job, None if no job was cancelled."""
+        with self._errors_lock:
+            cancelled = [
+                job for job in self.cancelled_jobs if job.checkpoint is not None
+            ]
+
+        if not cancelled:
+            return None
+
+        return min(cancelled, key=lambda job: job.sequence).checkpoint
+
+    def close(self) -> None:
+        """Drain every stage in order and flush pending writes.
+
+        Safe to call more than once.
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        for stage in self._stages:
+            stage.stop()
+
+    def _fetch(self, _context: None, job: PriceJob) -> PriceJob | None:
+        if self._circuit_open.is_set():
+            self._cancel(job)
+            return None
+
+        year_str, fuel_type_str = job.model_year_id.split("-")
+
+        try:
+            job.response = self.fipe_api.get_price_response(
+                job.reference_table_id,
+                job.manufacturer_id,
+                job.model_id,
+                year_str,
+                job.vehicle_type_id,
+                fuel_type_str,
+            )
+        except exceptions.CarPriceDoesNotExistException:
+            logger.debug("No price for %s", job)
+            with self._errors_lock:
+                self.missing_prices += 1
+            return None
+        except exceptions.CircuitOpenException as exc:
+            if not self._circuit_open.is_set():
+                logger.error("FIPE API unavailable (%s), cancelling queued prices", exc)
+                self._circuit_open.set()
+            self._cancel(job)
+            return None
+
+        return job
+
+    def _cancel(self, job: PriceJob) -> None:
+        with self._errors_lock:
+            self.cancelled_jobs.append(job)
+            # Without a checkpoint to resume from, `repair` crawls it again
+            if job.checkpoint is None and self.failed_jobs_file is not None:
+                self._record_failed_job(
+                    "fetch", job, exceptions.CircuitOpenException("cancelled")
+                )
+
+    def _parse(self, _context: None, job: PriceJob) -> PriceJob:
+        with stage_timer.time("parse"):
+            job.car_price = self.fipe_api.parse_price_response(job.response)
+        job.response = None
+        return job
+
+    def _make_persist_context(self) -> _PersistContext:
+        return _PersistContext(self._repository_factory())
+
+    def _write(self, repository: FipeDatabaseRepository, job: PriceJob) -> None:
+        if self.storage_mode == "changes":
+            _persist = repository.persist_car_price_change
+        else:
+            _persist = repository.persist_car_price
+
+        with stage_timer.time("persist"):
+            _persist(
+                job.car_price,
+                job.manufacturer_id,
+                job.model_id,
+                job.model_year_id,
+                job.vehicle_type_id,
+                job.reference_table_id,
+                commit=False,
+            )
+
+    def _persist(self, context: _PersistContext, job: PriceJob) -> None:
+        try:
+            self._write(context.repository, job)
+        except _JOB_ERRORS:
+            # The uncommitted batch goes down with the failed statement
+            self._retry_batch(context)
+            raise
+
+        context.pending.append(job)
+        if len(context.pending) >= self.commit_every:
+            self._commit(context)
+
+    def _commit(self, context: _PersistContext) -> None:
+        if not context.pending:
+            return
+
+        try:
+            with stage_timer.time("commit"):
+                context.repository.commit()
+        except SQLAlchemyError as exc:
+            logger.warning(
+                "Failed to commit %s prices, retrying one by one: %s",
+                len(context.pending),
+                exc,
+            )
+            self._retry_batch(context)
+            return
+
+        context.pending = []
+
+    def _retry_batch(self, context: _PersistContext) -> None:
+        """Roll back, then write the prices of the batch again, one per commit."""
+        context.repository.rollback()
+
+        jobs, context.pending = context.pending, []
+        for job in jobs:
+            try:
+                self._write(context.repository, job)
+                context.repository.commit()
+            except _JOB_ERRORS as exc:
+                context.repository.rollback()
+                self._on_error("persist", job, exc)
+
+    def _on_error(self, stage: str, job: PriceJob, exc: Exception) -> None:
+        logger.error("Stage %s failed for %s: %s", stage, job, exc)
+        with self._errors_lock:
+            self.failed_jobs += 1
+            if self.failed_jobs_file is not None:
+                self._record_failed_job(stage, job, exc)
+
+    def _record_failed_job(self, stage: str, job: PriceJob, exc: Exception) -> None:
+        _line = {name: getattr(job, name) for name in CoverageGap._fields}
+        _line.update(stage=stage, error=str(exc))
+        with open(self.failed_jobs_file, "a") as f:
+            f.write(json.dumps(_line) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+__all__ = ["FAILED_JOBS_FILE", "PriceJob", "PricePipeline", "load_failed_jobs"]
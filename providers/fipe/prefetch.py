@@ -0,0 +1,69 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class ListingPrefetcher:
+    """Issues listing requests ahead of the crawl cursor.
+
+    Calls are submitted to a small thread pool and kept by `(callable, args)`, so when
+    the crawler reaches a branch it picks up the already running (or finished) request
+    instead of waiting a full round trip. With `window=0` every call runs inline.
+    """
+
+    def __init__(self, window: int = 4, max_workers: int | None = None) -> None:
+        self.window = max(window, 0)
+        self._futures: dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if self.window:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers or self.window,
+                thread_name_prefix="fipe-prefetch",
+            )
+
+    def schedule(self, fn: Callable, *args: Any) -> None:
+        """Start `fn(*args)` in the background, unless it is already scheduled."""
+        if self._executor is None:
+            return
+
+        _key = (fn, args)
+        with self._lock:
+            if _key not in self._futures:
+                self._futures[_key] = self._executor.submit(fn, *args)
+
+    def schedule_many(self, fn: Callable, args_list: list[tuple]) -> None:
+        """Schedule `fn` for the first `window` argument tuples of `args_list`."""
+        for args in args_list[: self.window]:
+            self.schedule(fn, *args)
+
+    def get(self, fn: Callable, *args: Any) -> Any:
+        """Return the result of `fn(*args)`, reusing a prefetched call if there is one.
+
+        Exceptions raised by a prefetched call are re-raised here, exactly as if the
+        call had been made inline.
+        """
+        with self._lock:
+            future = self._futures.pop((fn, args), None)
+
+        if future is None:
+            return fn(*args)
+
+        return future.result()
+
+    def close(self) -> None:
+        """Drop every pending prefetch and stop the worker threads."""
+        with self._lock:
+            futures, self._futures = self._futures, {}
+
+        for future in futures.values():
+            future.cancel()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+__all__ = ["ListingPrefetcher"]
@@ -0,0 +1,309 @@
+"""On-demand profiling of a running crawl.
+
+- `stage_timer` accumulates wall time per crawl stage (network requests, cache reads,
+  Pydantic parsing, month parsing, database writes and commits). While disabled each
+  timed block costs a single attribute check.
+- `SamplingProfiler` snapshots the stacks of every thread every few milliseconds and
+  writes them in the collapsed format read by `flamegraph.pl`, speedscope and
+  friends.
+- `ProfilingController` runs sampling windows of a fixed length and writes the stage
+  breakdown next to the stacks, or cProfiles the crawl thread.
+  `install_signal_handler` lets `kill -USR1 <pid>` start such a window on a crawl
+  that is already running.
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = "profiles"
+
+
+class StageTimer:
+    """Thread-safe wall time accumulator, keyed by stage name."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+
+        self._lock = threading.Lock()
+        # stage -> [calls, total seconds, max seconds]
+        self._stages: dict[str, list] = {}
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - _start)
+
+    def timed(self, stage: str) -> Callable:
+        """Decorator version of `time`."""
+
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+
+                _start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - _start)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages = {}
+
+    def report(self) -> dict[str, dict]:
+        """`{stage: {calls, total_s, mean_ms, max_ms}}`, slowest stage first."""
+        with self._lock:
+            stages = {stage: list(stats) for stage, stats in self._stages.items()}
+
+        return {
+            stage: {
+                "calls": calls,
+                "total_s": round(total, 6),
+                "mean_ms": round(total / calls * 1000, 3),
+                "max_ms": round(maximum * 1000, 3),
+            }
+            for stage, (calls, total, maximum) in sorted(
+                stages.items(), key=lambda item: item[1][1], reverse=True
+            )
+        }
+
+    def format_report(self) -> str:
+        lines = [
+            f"{'stage':<24} {'calls':>8} {'total s':>10} {'mean ms':>9} {'max ms':>9}"
+        ]
+        for stage, stats in self.report().items():
+            lines.append(
+                f"{stage:<24} {stats['calls']:>8} {stats['total_s']:>10.3f}"
+                f" {stats['mean_ms']:>9.3f} {stats['max_ms']:>9.3f}"
+            )
+
+        return "\n".join(lines)
+
+
+stage_timer = StageTimer()
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread every `interval` seconds.
+
+    Sampling only reads `sys._current_frames()` from its own thread, so the
+    profiled code runs untouched; the overhead is proportional to the sampling rate,
+    not to the number of calls.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="fipe-sampling-profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    module = frame.f_globals.get("__name__", "?")
+                    stack.append(f"{module}:{code.co_name}")
+                    frame = frame.f_back
+
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_collapsed(self, path: str) -> None:
+        """One `frame;frame;frame count` line per distinct stack."""
+        with open(path, "w") as f:
+            f.writelines(
+                f"{stack} {count}\n" for stack, count in self.samples.most_common()
+            )
+
+
+class ProfilingController:
+    """Runs profiling windows and writes their results to `output_dir`.
+
+    A sampling window writes `<timestamp>.collapsed` and `<timestamp>-stages.json`.
+    `profile_calls` runs cProfile on the calling thread instead (cProfile cannot
+    follow other threads) and writes `<timestamp>.pstats`.
+
+    Args:
+        - output_dir (str): Where the profiles are written.
+        - seconds (float): Length of a sampling window.
+        - timer (StageTimer): Stage timer enabled during windows.
+    """
+
+    def __init__(
+        self,
+        output_dir: str = PROFILE_DIR,
+        seconds: float = 60.0,
+        timer: StageTimer = stage_timer,
+    ) -> None:
+        self.output_dir = output_dir
+        self.seconds = seconds
+        self.timer = timer
+
+        # Reentrant: the signal handler may interrupt the main thread in `start_window`
+        self._lock = threading.RLock()
+        self._window: threading.Thread | None = None
+        self._window_done = threading.Event()
+        self._keep_timer = False
+
+    def enable_stage_timing(self) -> None:
+        """Time stages for the whole run, not only during windows."""
+        self._keep_timer = True
+        self.timer.enabled = True
+
+    def start_window(self) -> bool:
+        """Sample every thread for `seconds` in the background. Returns False if a
+        window is already running."""
+        with self._lock:
+            if self._window is not None and self._window.is_alive():
+                return False
+
+            if not self._keep_timer:
+                self.timer.reset()
+            self.timer.enabled = True
+
+            self._window_done.clear()
+            profiler = SamplingProfiler()
+            profiler.start()
+            self._window = threading.Thread(
+                target=self._finish_window,
+                args=(profiler,),
+                name="fipe-profiling-window",
+                daemon=True,
+            )
+            self._window.start()
+
+        logger.warning("Profiling for %ss", self.seconds)
+        return True
+
+    def _finish_window(self, profiler: SamplingProfiler) -> None:
+        self._window_done.wait(self.seconds)
+
+        profiler.stop()
+        if not self._keep_timer:
+            self.timer.enabled = False
+
+        prefix = self._prefix()
+        profiler.write_collapsed(f"{prefix}.collapsed")
+        self.write_stage_report(prefix)
+
+    @contextmanager
+    def profile_calls(self) -> Iterator[cProfile.Profile]:
+        """cProfile the calling thread for the duration of the block."""
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            path = f"{self._prefix()}.pstats"
+            profiler.dump_stats(path)
+            logger.warning("cProfile stats written to %s", path)
+
+    def write_stage_report(self, prefix: str | None = None) -> str:
+        prefix = prefix or self._prefix()
+        path = f"{prefix}-stages.json"
+        with open(path, "w") as f:
+            json.dump(self.timer.report(), f, indent=2)
+
+        logger.warning(
+            "Stage timings written to %s\n%s", path, self.timer.format_report()
+        )
+        return path
+
+    def wait(self) -> None:
+        window = self._window
+        if window is not None:
+            window.join()
+
+    def stop_window(self) -> None:
+        """End the running window early, still writing its results."""
+        self._window_done.set()
+        self.wait()
+
+    def _prefix(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(
+            self.output_dir, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+        )
+
+
+def install_signal_handler(
+    controller: ProfilingController, signum: int | None = None
+) -> bool:
+    """Start a sampling window whenever the process receives `signum` (SIGUSR1 by
+    default). Returns False where the signal does not exist, ex. on Windows."""
+    signum = signum or getattr(signal, "SIGUSR1", None)
+    if signum is None:
+        return False
+
+    def handler(_signum, _frame):
+        if not controller.start_window():
+            logger.warning("A profiling window is already running")
+
+    signal.signal(signum, handler)
+    return True
+
+
+__all__ = [
+    "PROFILE_DIR",
+    "ProfilingController",
+    "SamplingProfiler",
+    "StageTimer",
+    "install_signal_handler",
+    "stage_timer",
+]
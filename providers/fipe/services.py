@@ -1,17 +1,39 @@
+import bisect
 import json
+
+from sqlalchemy import Engine, bindparam, delete, insert, select, update
 from sqlalchemy.orm import Session
-from sqlalchemy.dialects.postgresql import insert
 
-from db.engine import create_db_engine
+from db import readers as db_readers
+from db.engine import create_db_engine, upsert_insert
+from db.intervals import PriceInterval, apply_observation, month_ordinal
 from db.models import all_models as db_models
 from providers.fipe import schemas as fipe_schemas
 from providers.fipe.utils import convert_month_str_to_int, convert_brl_str_to_float
 
 
 class FipeDatabaseRepository:
-    def __init__(self) -> None:
-        self._engine = create_db_engine()
+    def __init__(self, engine: Engine | None = None) -> None:
+        self._engine = engine or create_db_engine()
         self._session = Session(bind=self._engine)
+        # `INSERT ... ON CONFLICT` of the engine's dialect
+        self._upsert = upsert_insert(self._engine)
+
+        # Month ordinal <-> reference table id, for change-only prices
+        self._ordinal_by_reference_table: dict[str, int] = {}
+        self._reference_table_by_ordinal: dict[int, str] = {}
+        self._ordinals: list[int] = []
+
+        # FIPE codes -> surrogate keys of the catalog rows, which never change
+        self._manufacturer_keys: dict[tuple, int] = {}
+        self._model_keys: dict[tuple, int] = {}
+        self._model_year_keys: dict[tuple, int] = {}
+
+    def commit(self) -> None:
+        self._session.commit()
+
+    def rollback(self) -> None:
+        self._session.rollback()
 
     def persist_reference_table(
         self, reference_table: fipe_schemas.FipeApiReferenceTableSchema
@@ -22,7 +44,7 @@ class FipeDatabaseRepository:
         month = convert_month_str_to_int(month_str)
 
         stmt = (
-            insert(db_models.ReferenceTable)
+            self._upsert(db_models.ReferenceTable)
             .values(
                 fipe_id=reference_table.code,
                 display_name=reference_table.display_name,
@@ -41,23 +63,49 @@ class FipeDatabaseRepository:
         for reference_table in reference_tables.reference_tables:
             self.persist_reference_table(reference_table)
 
+    def _insert_catalog_row(
+        self, entity: type, natural_key: tuple[str, ...], values: dict
+    ) -> int:
+        """Insert a catalog row unless its natural key exists, and commit.
+
+        Returns:
+            - int: Surrogate key of the row.
+        """
+        _columns = [getattr(entity, attr) for attr in natural_key]
+        stmt = (
+            self._upsert(entity)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=_columns)
+            .returning(entity.id)
+        )
+        key = self._session.execute(stmt).scalar()
+        if key is None:
+            stmt = select(entity.id).where(
+                *[column == values[column.key] for column in _columns]
+            )
+            key = self._session.execute(stmt).scalar()
+
+        self._session.commit()
+        return key
+
     def persist_manufacturer(
         self,
         manufacturer: fipe_schemas.FipeApiManufacturerSchema,
         vehicle_type_id: int,
     ) -> None:
-        stmt = (
-            insert(db_models.Manufacturer)
-            .values(
-                fipe_id=manufacturer.code,
-                display_name=manufacturer.display_name,
-                vehicle_type_id=vehicle_type_id,
-            )
-            .on_conflict_do_nothing(index_elements=["fipe_id"])
-        )
+        _cache_key = (vehicle_type_id, manufacturer.code)
+        if _cache_key in self._manufacturer_keys:
+            return
 
-        self._session.execute(stmt)
-        self._session.commit()
+        self._manufacturer_keys[_cache_key] = self._insert_catalog_row(
+            db_models.Manufacturer,
+            ("vehicle_type_id", "fipe_id"),
+            {
+                "fipe_id": manufacturer.code,
+                "display_name": manufacturer.display_name,
+                "vehicle_type_id": vehicle_type_id,
+            },
+        )
 
     def persist_manufacturers(
         self,
@@ -71,57 +119,128 @@ class FipeDatabaseRepository:
         self,
         model: fipe_schemas.FipeApiCarModelSchema,
         manufacturer_id: str,
+        vehicle_type_id: int = 1,
     ) -> None:
-        stmt = (
-            insert(db_models.CarModel)
-            .values(
-                fipe_id=model.code,
-                display_name=model.display_name,
-                manufacturer_id=manufacturer_id,
-            )
-            .on_conflict_do_nothing(index_elements=["fipe_id"])
-        )
+        manufacturer_key = self.get_manufacturer_key(vehicle_type_id, manufacturer_id)
+        # Model codes come as numbers from the API
+        _cache_key = (manufacturer_key, str(model.code))
+        if _cache_key in self._model_keys:
+            return
 
-        self._session.execute(stmt)
-        self._session.commit()
+        self._model_keys[_cache_key] = self._insert_catalog_row(
+            db_models.CarModel,
+            ("manufacturer_key", "fipe_id"),
+            {
+                "fipe_id": str(model.code),
+                "display_name": model.display_name,
+                "manufacturer_key": manufacturer_key,
+                "manufacturer_id": manufacturer_id,
+            },
+        )
 
     def persist_car_models(
         self,
         models: fipe_schemas.FipeApiCarModelsResponseSchema,
         manufacturer_id: str,
+        vehicle_type_id: int = 1,
     ) -> None:
         for model in models.car_models:
-            self.persist_car_model(model, manufacturer_id)
+            self.persist_car_model(model, manufacturer_id, vehicle_type_id)
 
     def persist_car_model_year(
         self,
         model_year: fipe_schemas.FipeApiCarModelYearSchema,
+        manufacturer_id: str,
         model_id: str,
+        vehicle_type_id: int = 1,
     ) -> None:
-        year_str, fuel_type_str = model_year.code.split("-")
+        model_key = self.get_model_key(vehicle_type_id, manufacturer_id, model_id)
+        _cache_key = (model_key, model_year.code)
+        if _cache_key in self._model_year_keys:
+            return
 
-        stmt = (
-            insert(db_models.CarModelYear)
-            .values(
-                fipe_id=model_year.code,
-                display_name=model_year.display_name,
-                model_id=model_id,
-                year=int(year_str.strip()),
-                fuel_type=int(fuel_type_str.strip()),
-            )
-            .on_conflict_do_nothing(index_elements=["fipe_id", "modelo_id"])
+        year_str, fuel_type_str = model_year.code.split("-")
+        self._model_year_keys[_cache_key] = self._insert_catalog_row(
+            db_models.CarModelYear,
+            ("model_key", "fipe_id"),
+            {
+                "fipe_id": model_year.code,
+                "display_name": model_year.display_name,
+                "model_key": model_key,
+                "model_id": model_id,
+                "year": int(year_str.strip()),
+                "fuel_type": int(fuel_type_str.strip()),
+            },
         )
 
-        self._session.execute(stmt)
-        self._session.commit()
-
     def persist_car_model_years(
         self,
         model_years: fipe_schemas.FipeApiCarModelYearsResponseSchema,
+        manufacturer_id: str,
         model_id: str,
+        vehicle_type_id: int = 1,
     ) -> None:
         for model_year in model_years.car_model_years:
-            self.persist_car_model_year(model_year, model_id)
+            self.persist_car_model_year(
+                model_year, manufacturer_id, model_id, vehicle_type_id
+            )
+
+    def get_manufacturer_key(self, vehicle_type_id: int, manufacturer_id: str) -> int:
+        """Surrogate key of a manufacturer, by FIPE code. Raises KeyError if it was
+        never persisted."""
+        _cache_key = (vehicle_type_id, manufacturer_id)
+        key = self._manufacturer_keys.get(_cache_key)
+        if key is None:
+            key = self._session.execute(
+                _MANUFACTURER_KEY_STMT,
+                {
+                    "vehicle_type_id": vehicle_type_id,
+                    "manufacturer_id": manufacturer_id,
+                },
+            ).scalar()
+            if key is None:
+                raise KeyError(f"Unknown manufacturer {manufacturer_id}")
+            self._manufacturer_keys[_cache_key] = key
+
+        return key
+
+    def get_model_key(
+        self, vehicle_type_id: int, manufacturer_id: str, model_id: str
+    ) -> int:
+        manufacturer_key = self.get_manufacturer_key(vehicle_type_id, manufacturer_id)
+        _cache_key = (manufacturer_key, model_id)
+        key = self._model_keys.get(_cache_key)
+        if key is None:
+            key = self._session.execute(
+                _MODEL_KEY_STMT,
+                {"manufacturer_key": manufacturer_key, "model_id": model_id},
+            ).scalar()
+            if key is None:
+                raise KeyError(f"Unknown car model {manufacturer_id}/{model_id}")
+            self._model_keys[_cache_key] = key
+
+        return key
+
+    def get_model_year_key(
+        self,
+        vehicle_type_id: int,
+        manufacturer_id: str,
+        model_id: str,
+        model_year_id: str,
+    ) -> int:
+        model_key = self.get_model_key(vehicle_type_id, manufacturer_id, model_id)
+        _cache_key = (model_key, model_year_id)
+        key = self._model_year_keys.get(_cache_key)
+        if key is None:
+            key = self._session.execute(
+                _MODEL_YEAR_KEY_STMT,
+                {"model_key": model_key, "model_year_id": model_year_id},
+            ).scalar()
+            if key is None:
+                raise KeyError(f"Unknown model year {model_id}/{model_year_id}")
+            self._model_year_keys[_cache_key] = key
+
+        return key
 
     def persist_car_price(
         self,
@@ -131,14 +250,19 @@ class FipeDatabaseRepository:
         model_year_id: str,
         vehicle_type_id: int,
         reference_table_id: str,
+        commit: bool = True,
     ) -> None:
         _reference_month = car_price.reference_month_name.strip()
         _value = convert_brl_str_to_float(car_price.value)
+        _model_year_key = self.get_model_year_key(
+            vehicle_type_id, manufacturer_id, model_id, model_year_id
+        )
 
         stmt = (
-            insert(db_models.CarPrice)
+            self._upsert(db_models.CarPrice)
             .values(
                 # from args
+                model_year_key=_model_year_key,
                 manufacturer_id=manufacturer_id,
                 model_id=model_id,
                 model_year_id=model_year_id,
@@ -155,9 +279,11 @@ class FipeDatabaseRepository:
             )
             .on_conflict_do_update(
                 index_elements=[
-                    db_models.CarPrice.authentication,
+                    db_models.CarPrice.model_year_key,
+                    db_models.CarPrice.reference_table_id,
                 ],
                 set_={
+                    db_models.CarPrice.authentication: car_price.authentication,
                     db_models.CarPrice.value: _value,
                     db_models.CarPrice.query_date: car_price.query_date,
                     db_models.CarPrice.reference_month: car_price.reference_month_name,
@@ -167,10 +293,147 @@ class FipeDatabaseRepository:
         )
 
         self._session.execute(stmt)
-        self._session.commit()
+        if commit:
+            self._session.commit()
+
+    def persist_car_price_change(
+        self,
+        car_price: fipe_schemas.FipeApiCarPriceResponseSchema,
+        manufacturer_id: str,
+        model_id: str,
+        model_year_id: str,
+        vehicle_type_id: int,
+        reference_table_id: str,
+        commit: bool = True,
+    ) -> bool:
+        """Change-only alternative to `persist_car_price`.
+
+        The price is merged into the validity ranges of `preco_intervalo`: a price
+        equal to the one of the neighbouring month only extends that range, and a
+        price already recorded writes nothing at all.
+
+        Intervals of a model year must not be written concurrently, `PricePipeline`
+        sends every price of a model year to the same persist worker.
+
+        Returns:
+            - bool: Whether any row was written.
+        """
+        _value = convert_brl_str_to_float(car_price.value)
+        _ordinal = self._get_reference_table_ordinal(reference_table_id)
+        _interval = db_models.CarPriceInterval
+        _model_year_key = self.get_model_year_key(
+            vehicle_type_id, manufacturer_id, model_id, model_year_id
+        )
+
+        rows = self._session.execute(
+            select(
+                _interval.id, _interval.valid_from, _interval.valid_to, _interval.value
+            ).where(
+                _interval.model_year_key == _model_year_key,
+                _interval.valid_to >= _ordinal - 1,
+                _interval.valid_from <= _ordinal + 1,
+            )
+        ).all()
+
+        current = sorted(PriceInterval(*row[1:]) for row in rows)
+        intervals = [
+            self._snap_interval(interval)
+            for interval in apply_observation(current, _ordinal, _value)
+        ]
+        if intervals == current:
+            return False
+
+        _ids_by_start = {row.valid_from: row.id for row in rows}
+        for interval in intervals:
+            _values = {
+                "valid_from": interval.start,
+                "valid_to": interval.end,
+                "valid_from_id": self._reference_table_by_ordinal[interval.start],
+                "valid_to_id": self._reference_table_by_ordinal[interval.end],
+                "value": interval.value,
+            }
+
+            _id = _ids_by_start.pop(interval.start, None)
+            if _id is None:
+                stmt = insert(_interval).values(
+                    model_year_key=_model_year_key,
+                    manufacturer_id=manufacturer_id,
+                    model_id=model_id,
+                    model_year_id=model_year_id,
+                    vehicle_type_id=vehicle_type_id,
+                    fipe_vehicle_code=car_price.fipe_vehicle_code,
+                    **_values,
+                )
+                self._session.execute(stmt)
+            elif interval not in current:
+                stmt = update(_interval).where(_interval.id == _id).values(**_values)
+                self._session.execute(stmt)
+
+        # Ranges absorbed by a merge
+        if _ids_by_start:
+            stmt = delete(_interval).where(_interval.id.in_(_ids_by_start.values()))
+            self._session.execute(stmt)
+
+        if commit:
+            self._session.commit()
+
+        return True
+
+    def _load_reference_tables(self) -> None:
+        for reference_table in db_readers.read_reference_tables(self._session):
+            _ordinal = month_ordinal(reference_table.year, reference_table.month)
+            self._ordinal_by_reference_table[reference_table.fipe_id] = _ordinal
+            self._reference_table_by_ordinal[_ordinal] = reference_table.fipe_id
+
+        self._ordinals = sorted(self._reference_table_by_ordinal)
+
+    def _get_reference_table_ordinal(self, reference_table_id: str) -> int:
+        if reference_table_id not in self._ordinal_by_reference_table:
+            self._load_reference_tables()
+
+        return self._ordinal_by_reference_table[reference_table_id]
+
+    def _snap_interval(self, interval: PriceInterval) -> PriceInterval:
+        """Shrink an interval to the months that have a reference table.
+
+        Splitting a range around an observation ends the pieces on the months right
+        before and after it, which FIPE may not have published.
+        """
+        _by_ordinal = self._reference_table_by_ordinal
+        if interval.start in _by_ordinal and interval.end in _by_ordinal:
+            return interval
+
+        # Maybe published since the reference tables were read
+        self._load_reference_tables()
+        _first = bisect.bisect_left(self._ordinals, interval.start)
+        _last = bisect.bisect_right(self._ordinals, interval.end) - 1
+        if _first > _last:
+            raise KeyError(
+                f"No reference table between months {interval.start} and {interval.end}"
+            )
+
+        return interval._replace(
+            start=self._ordinals[_first], end=self._ordinals[_last]
+        )
 
     def get_latest_reference_table_id(self) -> str:
         ref_table_db = db_models.ReferenceTable()
         latest_ref_table = ref_table_db.get_latest_reference_table(self._session)
 
         return latest_ref_table.fipe_id
+
+
+_MANUFACTURER_KEY_STMT = select(db_models.Manufacturer.id).where(
+    db_models.Manufacturer.vehicle_type_id == bindparam("vehicle_type_id"),
+    db_models.Manufacturer.fipe_id == bindparam("manufacturer_id"),
+)
+
+_MODEL_KEY_STMT = select(db_models.CarModel.id).where(
+    db_models.CarModel.manufacturer_key == bindparam("manufacturer_key"),
+    db_models.CarModel.fipe_id == bindparam("model_id"),
+)
+
+_MODEL_YEAR_KEY_STMT = select(db_models.CarModelYear.id).where(
+    db_models.CarModelYear.model_key == bindparam("model_key"),
+    db_models.CarModelYear.fipe_id == bindparam("model_year_id"),
+)
@@ -1,7 +1,10 @@
 import locale
 from datetime import datetime
 
+from providers.fipe.profiling import stage_timer
 
+
+@stage_timer.timed("parse.month")
 def convert_month_str_to_int(month_str: str, _locale: str = "pt_BR.UTF-8") -> int:
     # ex. "junho" -> "06"
     locale.setlocale(locale.LC_TIME, _locale)
@@ -0,0 +1,68 @@
+"""Watch state file of `ReferenceTableWatcher`, readable without its dependencies.
+
+`python main.py status` only imports this module, so it stays fast and works without
+the database and HTTP libraries.
+"""
+
+import json
+import time
+
+WATCH_STATE_FILE = "watch_state.json"
+
+
+def load_watch_state(path: str = WATCH_STATE_FILE) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def freshness(state: dict, now: float | None = None) -> dict:
+    """Summary of the freshness metrics of a watch state.
+
+    - `seconds_since_poll`: how stale the view of FIPE's reference tables is.
+    - `detection_window_s`: the month was published at most this long before it was
+      detected, the time between the two polls around it.
+    - `publication_to_stored_s`: upper bound of the time from publication to every
+      price of the month being stored, None when some of them failed.
+    - `failed_prices`: prices of the month that could not be stored.
+    """
+    now = time.time() if now is None else now
+    metrics = state.get("metrics", {})
+    summary = {
+        "seconds_since_poll": None,
+        "consecutive_poll_failures": metrics.get("consecutive_poll_failures", 0),
+        "latest_reference_table_id": metrics.get("latest_reference_table_id"),
+        "pending": list(state.get("pending", [])),
+    }
+    if metrics.get("last_successful_poll_at") is not None:
+        summary["seconds_since_poll"] = round(
+            now - metrics["last_successful_poll_at"], 3
+        )
+
+    crawled = [
+        (reference_table_id, month)
+        for reference_table_id, month in metrics.get("reference_tables", {}).items()
+        if month.get("crawl_finished_at") is not None
+    ]
+    if crawled:
+        reference_table_id, month = max(
+            crawled, key=lambda item: item[1]["crawl_finished_at"]
+        )
+        summary["latest_crawled_reference_table_id"] = reference_table_id
+        summary["detection_window_s"] = month.get("detection_window_s")
+        summary["failed_prices"] = month.get("failed_prices", 0)
+        summary["publication_to_stored_s"] = None
+        if not summary["failed_prices"]:
+            summary["publication_to_stored_s"] = round(
+                month["crawl_finished_at"]
+                - month["detected_at"]
+                + (month.get("detection_window_s") or 0),
+                3,
+            )
+
+    return summary
+
+
+__all__ = ["WATCH_STATE_FILE", "freshness", "load_watch_state"]
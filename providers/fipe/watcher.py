@@ -0,0 +1,291 @@
+"""New reference table detection and single-month crawls.
+
+`ReferenceTableWatcher` polls `/ConsultarTabelaDeReferencia`, a single small request,
+every `poll_interval` seconds. When FIPE publishes a new month, the watcher persists the
+reference tables and crawls only that month, right away.
+
+Its state is written to a JSON file after every poll and crawl:
+- the months waiting to be crawled
+- the checkpoint of an interrupted crawl, which resumes on the next start
+- freshness metrics: when the last poll happened, when each month was detected,
+  and how long it took until its prices were stored
+
+A month whose crawl had failed prices stays pending and is crawled again, up to
+`MAX_CRAWL_ATTEMPTS` times; the prices still failing after that are left to
+`python main.py repair`, and the month reports them in `failed_prices`.
+
+`python main.py status` prints the metrics (see `providers.fipe.watch_state`), and
+monitoring can read the file.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+from sqlalchemy import Engine
+
+from db import readers as db_readers
+from db.intervals import month_ordinal
+from providers.fipe import schemas as fipe_schemas
+from providers.fipe.api import FipeApi
+from providers.fipe.crawler import FipeCrawler
+from providers.fipe.exceptions import CircuitOpenException
+from providers.fipe.services import FipeDatabaseRepository
+from providers.fipe.watch_state import WATCH_STATE_FILE, freshness, load_watch_state
+
+logger = logging.getLogger(__name__)
+
+# Crawls of a month with failed prices before they are left to `repair`
+MAX_CRAWL_ATTEMPTS = 3
+
+# Months kept in the `reference_tables` metrics
+_METRICS_HISTORY = 12
+
+
+class ReferenceTableWatcher:
+    """Polls FIPE for new reference tables and crawls each new month once.
+
+    Args:
+        - engine (Engine): Database the reference tables are read from and stored in.
+        - crawler_factory (Callable[[dict], FipeCrawler]): Builds a crawler from a
+            checkpoint, ex. `lambda checkpoint: FipeCrawler(checkpoint=checkpoint)`.
+        - fipe_api (FipeApi | None): Client used to poll.
+        - vehicle_type_id (int): Vehicle type crawled.
+        - poll_interval (float): Seconds between polls.
+        - state_file (str): Where the pending months, checkpoint and metrics are kept.
+        - on_crawled (Callable[[str], None] | None): Called with each reference table
+            once its crawl finished, ex. to update derived data.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        crawler_factory: Callable[[dict], FipeCrawler],
+        fipe_api: FipeApi | None = None,
+        vehicle_type_id: int = 1,
+        poll_interval: float = 600.0,
+        state_file: str = WATCH_STATE_FILE,
+        on_crawled: Callable[[str], None] | None = None,
+    ) -> None:
+        self._engine = engine
+        self.crawler_factory = crawler_factory
+        self.fipe_api = fipe_api or FipeApi()
+        self.fipe_db_repo = FipeDatabaseRepository(engine)
+        self.vehicle_type_id = vehicle_type_id
+        self.poll_interval = poll_interval
+        self.state_file = state_file
+        self.on_crawled = on_crawled
+
+        self.state = load_watch_state(state_file)
+        self.state.setdefault("pending", [])
+        self.state.setdefault("checkpoint", {})
+        self._metrics = self.state.setdefault("metrics", {})
+        self._metrics.setdefault("polls", 0)
+        self._metrics.setdefault("poll_failures", 0)
+        self._metrics.setdefault("consecutive_poll_failures", 0)
+        self._metrics.setdefault("reference_tables", {})
+
+    def _save_state(self) -> None:
+        # Write then rename, so readers never see a partial file
+        _tmp_path = f"{self.state_file}.tmp"
+        with open(_tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(_tmp_path, self.state_file)
+
+    def poll(self) -> list[str]:
+        """Ask FIPE for its reference tables and persist the new ones.
+
+        Only months after the latest one already stored are queued for crawling; on
+        an empty database that is only the latest month, `crawl` backfills the rest.
+
+        Returns:
+            - list[str]: Reference tables queued for crawling.
+        """
+        _polled_at = time.time()
+        self._metrics["polls"] += 1
+        self._metrics["last_poll_at"] = _polled_at
+        try:
+            # Always ask FIPE, the listing is otherwise cached for a month
+            response = self.fipe_api.get_reference_tables(cache_expire=1)
+        except Exception as exc:
+            self._metrics["poll_failures"] += 1
+            self._metrics["consecutive_poll_failures"] += 1
+            self._save_state()
+            logger.warning("Polling reference tables failed: %s", exc)
+            return []
+
+        with self._engine.connect() as conn:
+            known = db_readers.read_reference_tables(conn)
+        _known_ids = {row.fipe_id for row in known}
+        _latest_known = max(
+            (month_ordinal(row.year, row.month) for row in known), default=None
+        )
+
+        new_reference_tables = [
+            reference_table
+            for reference_table in response.reference_tables
+            if reference_table.code not in _known_ids
+        ]
+        queued = []
+        if new_reference_tables:
+            self.fipe_db_repo.persist_reference_tables(
+                fipe_schemas.FipeApiReferenceTablesResponseSchema(
+                    reference_tables=new_reference_tables
+                )
+            )
+
+            _new_ids = {
+                reference_table.code for reference_table in new_reference_tables
+            }
+            with self._engine.connect() as conn:
+                stored = [
+                    row
+                    for row in db_readers.read_reference_tables(conn)
+                    if row.fipe_id in _new_ids
+                ]
+            if _latest_known is None:
+                queued = [row.fipe_id for row in stored[-1:]]
+            else:
+                queued = [
+                    row.fipe_id
+                    for row in stored
+                    if month_ordinal(row.year, row.month) > _latest_known
+                ]
+
+        _previous_poll_at = self._metrics.get("last_successful_poll_at")
+        for reference_table_id in queued:
+            logger.info("New reference table %s", reference_table_id)
+            self._metrics["reference_tables"][reference_table_id] = {
+                "detected_at": _polled_at,
+                "detection_window_s": (
+                    round(_polled_at - _previous_poll_at, 3)
+                    if _previous_poll_at is not None
+                    else None
+                ),
+                "crawl_started_at": None,
+                "crawl_finished_at": None,
+            }
+            if reference_table_id not in self.state["pending"]:
+                self.state["pending"].append(reference_table_id)
+
+        # Only the latest months are kept
+        _history = self._metrics["reference_tables"]
+        for reference_table_id in list(_history)[:-_METRICS_HISTORY]:
+            del _history[reference_table_id]
+
+        if response.reference_tables:
+            self._metrics["latest_reference_table_id"] = max(
+                response.reference_tables, key=lambda rt: int(rt.code)
+            ).code
+        self._metrics["last_successful_poll_at"] = _polled_at
+        self._metrics["consecutive_poll_failures"] = 0
+        self._save_state()
+
+        return queued
+
+    def crawl_pending(self) -> list[str]:
+        """Crawl the queued months, oldest first, resuming an interrupted one.
+
+        A crawl stopped by Ctrl+C or SIGTERM saves its checkpoint before the
+        interruption propagates; one stopped by an open circuit breaker is retried
+        after the next poll.
+
+        Returns:
+            - list[str]: Reference tables crawled.
+        """
+        crawled = []
+        while self.state["pending"]:
+            reference_table_id = self.state["pending"][0]
+            _month = self._metrics["reference_tables"].setdefault(
+                reference_table_id,
+                {"detected_at": time.time(), "detection_window_s": None},
+            )
+            if not _month.get("crawl_started_at"):
+                _month["crawl_started_at"] = time.time()
+            self._save_state()
+
+            logger.info("Crawling reference table %s", reference_table_id)
+            crawler = self.crawler_factory(dict(self.state["checkpoint"]))
+            try:
+                crawler.populate_prices_for_reference_table(
+                    reference_table_id, self.vehicle_type_id
+                )
+            except CircuitOpenException as exc:
+                logger.warning(
+                    "FIPE API unavailable (%s), crawl of %s resumes later",
+                    exc,
+                    reference_table_id,
+                )
+                crawler.close()
+                self.state["checkpoint"] = crawler.get_checkpoint()
+                self._save_state()
+                break
+            except BaseException:
+                crawler.close()
+                self.state["checkpoint"] = crawler.get_checkpoint()
+                self._save_state()
+                raise
+
+            # Waits until every submitted price is stored
+            crawler.close()
+
+            if crawler.cancelled_prices:
+                # The circuit opened after the last price was submitted
+                logger.warning(
+                    "FIPE API unavailable, crawl of %s resumes later",
+                    reference_table_id,
+                )
+                self.state["checkpoint"] = crawler.get_checkpoint()
+                self._save_state()
+                break
+
+            _month["failed_prices"] = crawler.failed_prices
+            _month["attempts"] = _month.get("attempts", 0) + 1
+            self.state["checkpoint"] = {}
+            if _month["failed_prices"] and _month["attempts"] < MAX_CRAWL_ATTEMPTS:
+                logger.warning(
+                    "%s prices of %s failed, crawling it again after the next poll",
+                    _month["failed_prices"],
+                    reference_table_id,
+                )
+                self._save_state()
+                break
+
+            _month["crawl_finished_at"] = time.time()
+            self.state["pending"].pop(0)
+            self._save_state()
+            crawled.append(reference_table_id)
+            logger.info(
+                "Reference table %s crawled in %.0fs, %s prices failed",
+                reference_table_id,
+                _month["crawl_finished_at"] - _month["crawl_started_at"],
+                _month["failed_prices"],
+            )
+
+            if self.on_crawled is not None:
+                try:
+                    self.on_crawled(reference_table_id)
+                except Exception:
+                    logger.exception("After crawling %s", reference_table_id)
+
+        return crawled
+
+    def run(self, stop: threading.Event | None = None) -> None:
+        """Poll and crawl until `stop` is set."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self.poll()
+            self.crawl_pending()
+            stop.wait(self.poll_interval)
+
+
+__all__ = [
+    "MAX_CRAWL_ATTEMPTS",
+    "ReferenceTableWatcher",
+    "WATCH_STATE_FILE",
+    "freshness",
+    "load_watch_state",
+]
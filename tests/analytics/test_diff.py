@@ -0,0 +1,161 @@
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from analytics.diff import (
+    ADDED,
+    CHANGED,
+    REMOVED,
+    diff_snapshots,
+    previous_reference_table_id,
+    save_diff,
+)
+from analytics.snapshot import SnapshotIndex
+from db.create_db import create_db
+from db.models import all_models as db_models
+
+
+def _snapshot(reference_table_id, prices):
+    """`prices` as {(model_id, model_year_id): value}."""
+    return SnapshotIndex.from_columns(
+        reference_table_id,
+        {
+            "id": list(range(len(prices))),
+            "value": list(prices.values()),
+            "manufacturer_id": ["22"] * len(prices),
+            "model_id": [model_id for model_id, _ in prices],
+            "model_year_id": [model_year_id for _, model_year_id in prices],
+            "fipe_vehicle_code": ["003376-6"] * len(prices),
+            "vehicle_type_id": [1] * len(prices),
+        },
+    )
+
+
+@pytest.fixture
+def diff():
+    previous = _snapshot(
+        "308",
+        {
+            ("5940", "2019-1"): 100_000.0,
+            ("5940", "2020-1"): 120_000.0,
+            ("5941", "2019-1"): 50_000.0,
+            ("7000", "32000-1"): 80_000.0,
+        },
+    )
+    current = _snapshot(
+        "309",
+        {
+            ("5940", "2019-1"): 95_000.0,
+            ("5940", "2020-1"): 120_000.0,
+            ("5941", "2019-3"): 51_000.0,
+            ("7000", "32000-1"): 88_000.0,
+        },
+    )
+    return diff_snapshots(previous, current)
+
+
+def test_summary(diff):
+    assert diff.summary() == {
+        "previous_reference_table_id": "308",
+        "reference_table_id": "309",
+        "added": 1,
+        "removed": 1,
+        "changed": 2,
+        "unchanged": 1,
+        "mean_change_percent": 2.5,
+        "median_change_percent": 2.5,
+    }
+
+
+def test_records(diff):
+    records = {
+        (record["model_id"], record["model_year_id"]): record
+        for record in diff.records()
+    }
+
+    assert set(records) == {
+        ("5941", "2019-3"),
+        ("5941", "2019-1"),
+        ("5940", "2019-1"),
+        ("7000", "32000-1"),
+    }
+    assert records[("5941", "2019-3")]["change_type"] == ADDED
+    assert records[("5941", "2019-1")]["change_type"] == REMOVED
+    assert records[("5941", "2019-1")]["previous_value"] == 50_000.0
+    assert records[("5940", "2019-1")]["change_type"] == CHANGED
+    assert records[("5940", "2019-1")]["change_percent"] == pytest.approx(-5.0)
+    assert records[("7000", "32000-1")]["change_percent"] == pytest.approx(10.0)
+
+
+def test_tolerance_ignores_small_changes():
+    previous = _snapshot("308", {("1", "2019-1"): 100.0, ("2", "2019-1"): 100.0})
+    current = _snapshot("309", {("1", "2019-1"): 100.5, ("2", "2019-1"): 110.0})
+
+    diff = diff_snapshots(previous, current, tolerance=1.0)
+
+    assert diff.summary()["changed"] == 1
+    assert diff.summary()["unchanged"] == 1
+
+
+def test_duplicated_model_years_are_rejected():
+    previous = _snapshot("308", {("1", "2019-1"): 100.0})
+    current = SnapshotIndex.from_columns(
+        "309",
+        {
+            "id": [1, 2],
+            "value": [100.0, 110.0],
+            "manufacturer_id": ["22", "22"],
+            "model_id": ["1", "1"],
+            "model_year_id": ["2019-1", "2019-1"],
+            "fipe_vehicle_code": ["003376-6", "003376-6"],
+            "vehicle_type_id": [1, 1],
+        },
+    )
+
+    with pytest.raises(ValueError, match="309 has 1 model years"):
+        diff_snapshots(previous, current)
+
+
+def test_save_diff_replaces_previous_rows(diff):
+    engine = create_engine("sqlite://")
+    create_db(engine)
+
+    with Session(engine) as db_session:
+        for fipe_id in ("308", "309"):
+            db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id=fipe_id, display_name=fipe_id, month=1, year=2024
+                )
+            )
+        db_session.commit()
+
+        assert save_diff(db_session, diff) == 4
+        assert save_diff(db_session, diff) == 4
+        db_session.commit()
+
+        change_types = db_session.scalars(
+            select(db_models.CarPriceChange.change_type).order_by(
+                db_models.CarPriceChange.change_type
+            )
+        ).all()
+
+    assert change_types == [ADDED, REMOVED, CHANGED, CHANGED]
+
+
+def test_previous_reference_table_id():
+    engine = create_engine("sqlite://")
+    create_db(engine)
+
+    with Session(engine) as db_session:
+        for month, fipe_id in enumerate(("308", "309"), start=1):
+            db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id=fipe_id, display_name=fipe_id, month=month, year=2024
+                )
+            )
+        db_session.commit()
+
+        assert previous_reference_table_id(db_session, "309") == "308"
+        assert previous_reference_table_id(db_session, "308") is None
+        with pytest.raises(KeyError):
+            previous_reference_table_id(db_session, "999")
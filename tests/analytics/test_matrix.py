@@ -0,0 +1,195 @@
+import numpy as np
+import pytest
+from sqlalchemy import create_engine, delete
+from sqlalchemy.orm import Session
+
+from analytics.matrix import PriceMatrix, update_matrix
+from db.create_db import create_db
+from db.models import all_models as db_models
+
+MONTHS = {"306": 4, "307": 5, "308": 6, "309": 7}
+
+
+def _price(model_year, reference_table_id, value):
+    return db_models.CarPrice(
+        model_year_key=model_year.id,
+        manufacturer_id="22",
+        model_id="5940",
+        model_year_id=model_year.fipe_id,
+        vehicle_type_id=1,
+        reference_table_id=reference_table_id,
+        authentication="abc",
+        query_date="x",
+        reference_month="x",
+        fipe_vehicle_code="003376-6",
+        value=value,
+        raw_data={},
+    )
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://")
+    create_db(engine)
+
+    with Session(engine) as db_session:
+        model = db_models.CarModel(
+            fipe_id="5940",
+            display_name="Fusion",
+            manufacturer_id="22",
+            manufacturer=db_models.Manufacturer(
+                fipe_id="22", display_name="Ford", vehicle_type_id=1
+            ),
+        )
+        db_session.add_all(
+            [
+                db_models.ReferenceTable(
+                    fipe_id=reference_table_id,
+                    display_name=f"{month}/2024",
+                    month=month,
+                    year=2024,
+                )
+                for reference_table_id, month in MONTHS.items()
+            ]
+            + [
+                db_models.CarModelYear(
+                    fipe_id=f"{year}-1",
+                    model_id="5940",
+                    car_model=model,
+                    display_name=f"{year} Gasolina",
+                    year=year,
+                    fuel_type=1,
+                )
+                for year in (2019, 2020, 2021)
+            ]
+        )
+        db_session.flush()
+
+        first, second, _ = db_session.query(db_models.CarModelYear).order_by("id")
+        db_session.add_all(
+            [
+                _price(first, "307", 100_000.0),
+                _price(second, "307", 120_000.0),
+                _price(first, "308", 99_000.0),
+            ]
+        )
+        db_session.commit()
+
+        yield db_session
+
+
+def test_history_is_a_view_of_the_file(db_session, tmp_path):
+    assert update_matrix(db_session, str(tmp_path)) == ["307", "308"]
+
+    matrix = PriceMatrix.load(str(tmp_path))
+    history = matrix.history(1)
+
+    assert isinstance(history.base, np.memmap)
+    assert history.tolist() == [100_000.0, 99_000.0]
+    assert np.isnan(matrix.history(2)[1])
+    assert matrix.reference_table_ids.tolist() == ["307", "308"]
+    assert matrix.months[1] - matrix.months[0] == 1
+    with pytest.raises(KeyError):
+        matrix.history(3)
+
+    histories = matrix.histories([2, 3])
+    assert histories[0, 0] == 120_000.0
+    assert np.isnan(histories[1]).all()
+
+
+def test_new_months_are_written_in_place(db_session, tmp_path):
+    update_matrix(db_session, str(tmp_path))
+    _inode = (tmp_path / "values.npy").stat().st_ino
+
+    db_session.add_all(
+        [
+            _price(db_session.get(db_models.CarModelYear, 2), "308", 118_000.0),
+            _price(db_session.get(db_models.CarModelYear, 3), "309", 150_000.0),
+        ]
+    )
+    db_session.commit()
+
+    # The last month is written again, it may have been incomplete
+    assert update_matrix(db_session, str(tmp_path)) == ["308", "309"]
+    assert (tmp_path / "values.npy").stat().st_ino == _inode
+
+    np.testing.assert_array_equal(
+        PriceMatrix.load(str(tmp_path)).histories([1, 2, 3]),
+        [
+            [100_000.0, 99_000.0, np.nan],
+            [120_000.0, 118_000.0, np.nan],
+            [np.nan, np.nan, 150_000.0],
+        ],
+    )
+
+
+def test_older_month_rebuilds_the_matrix(db_session, tmp_path):
+    update_matrix(db_session, str(tmp_path))
+
+    db_session.add(_price(db_session.get(db_models.CarModelYear, 1), "306", 101_000.0))
+    db_session.execute(
+        delete(db_models.CarPrice).where(db_models.CarPrice.reference_table_id == "308")
+    )
+    db_session.commit()
+
+    assert update_matrix(db_session, str(tmp_path)) == ["306", "307"]
+    assert PriceMatrix.load(str(tmp_path)).history(1).tolist() == [
+        101_000.0,
+        100_000.0,
+    ]
+
+
+def test_matrix_grows_past_its_capacity(tmp_path):
+    matrix = PriceMatrix.create(str(tmp_path), row_capacity=1, column_capacity=1)
+
+    matrix.write_month("307", 100, [5], [1.0])
+    matrix.write_month("308", 101, [7, 5], [2.0, 3.0])
+
+    np.testing.assert_array_equal(matrix.values, [[1.0, 3.0], [np.nan, 2.0]])
+    assert matrix.rows_of([7, 6, 5]).tolist() == [1, -1, 0]
+    with pytest.raises(ValueError):
+        matrix.write_month("306", 99, [5], [0.0])
+
+    np.testing.assert_array_equal(PriceMatrix.load(str(tmp_path)).values, matrix.values)
+
+
+def test_validity_ranges_are_read(db_session, tmp_path):
+    def _interval(model_year_key, valid_from_id, valid_to_id, value):
+        return db_models.CarPriceInterval(
+            model_year_key=model_year_key,
+            manufacturer_id="22",
+            model_id="5940",
+            model_year_id="x",
+            vehicle_type_id=1,
+            fipe_vehicle_code="003376-6",
+            value=value,
+            valid_from_id=valid_from_id,
+            valid_to_id=valid_to_id,
+            valid_from=2024 * 12 + MONTHS[valid_from_id] - 1,
+            valid_to=2024 * 12 + MONTHS[valid_to_id] - 1,
+        )
+
+    db_session.add_all(
+        [
+            # `preco` has a price of this model year in 308
+            _interval(1, "308", "308", 1.0),
+            _interval(3, "308", "309", 150_000.0),
+        ]
+    )
+    db_session.commit()
+
+    assert update_matrix(db_session, str(tmp_path)) == ["307", "308", "309"]
+    np.testing.assert_array_equal(
+        PriceMatrix.load(str(tmp_path)).histories([1, 3]),
+        [[100_000.0, 99_000.0, np.nan], [np.nan, 150_000.0, 150_000.0]],
+    )
+
+
+def test_archived_months_are_read(db_session, tmp_path):
+    pytest.importorskip("pyarrow")
+    from db.archive import archive_reference_table
+
+    archive_reference_table(db_session, "307", str(tmp_path / "archive"))
+
+    assert update_matrix(db_session, str(tmp_path / "matrix")) == ["307", "308"]
+    assert PriceMatrix.load(str(tmp_path / "matrix")).history(2)[0] == 120_000.0
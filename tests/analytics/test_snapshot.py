@@ -0,0 +1,78 @@
+import pytest
+
+from analytics.snapshot import SnapshotIndex
+
+PRICES = [
+    # (id, value, model_year_id)
+    (1, 50_000.0, "2019-1"),
+    (2, 20_000.0, "2010-1"),
+    (3, 80_000.0, "2019-3"),
+    (4, 55_000.0, "2020-1"),
+    (5, 52_000.0, "2019-3"),
+    (6, 90_000.0, "32000-1"),
+]
+
+
+@pytest.fixture
+def snapshot():
+    return SnapshotIndex.from_columns(
+        "308",
+        {
+            "id": [row[0] for row in PRICES],
+            "value": [row[1] for row in PRICES],
+            "manufacturer_id": ["22"] * len(PRICES),
+            "model_id": [str(row[0]) for row in PRICES],
+            "model_year_id": [row[2] for row in PRICES],
+            "fipe_vehicle_code": ["003376-6"] * len(PRICES),
+            "vehicle_type_id": [1] * len(PRICES),
+        },
+    )
+
+
+def _ids(snapshot, positions):
+    return [snapshot.columns["id"][position].item() for position in positions]
+
+
+class TestSnapshotIndex:
+    def test_price_range(self, snapshot):
+        assert _ids(snapshot, snapshot.price_range(50_000, 55_000)) == [1, 5, 4]
+        assert _ids(snapshot, snapshot.price_range(50_000, 55_000, fuel_type=3)) == [5]
+        assert _ids(snapshot, snapshot.price_range(50_000, 55_000, year=2019)) == [1, 5]
+        assert _ids(snapshot, snapshot.price_range(high=50_000)) == [2, 1]
+        assert _ids(snapshot, snapshot.price_range(60_000, limit=1)) == [3]
+
+    def test_top(self, snapshot):
+        assert _ids(snapshot, snapshot.top(2)) == [6, 3]
+        assert _ids(snapshot, snapshot.top(2, cheapest=True)) == [2, 1]
+        assert _ids(snapshot, snapshot.top(2, fuel_type=3)) == [3, 5]
+
+    def test_nearest(self, snapshot):
+        assert _ids(snapshot, snapshot.nearest(53_000, 3)) == [5, 4, 1]
+        assert _ids(snapshot, snapshot.nearest(100_000, 2)) == [6, 3]
+        assert _ids(snapshot, snapshot.nearest(53_000, 1, year=2010)) == [2]
+
+    def test_records(self, snapshot):
+        (record,) = snapshot.records(snapshot.top(1, cheapest=True))
+
+        assert record == {
+            "id": 2,
+            "value": 20_000.0,
+            "manufacturer_id": "22",
+            "model_id": "2",
+            "model_year_id": "2010-1",
+            "fipe_vehicle_code": "003376-6",
+            "vehicle_type_id": 1,
+            "year": 2010,
+            "fuel_type": 1,
+        }
+
+    def test_save_and_load_memory_mapped(self, snapshot, tmp_path):
+        snapshot.save(str(tmp_path / "308"))
+
+        loaded = SnapshotIndex.load(str(tmp_path / "308"))
+
+        assert loaded.reference_table_id == "308"
+        assert len(loaded) == len(snapshot)
+        assert loaded.records(loaded.price_range(50_000, 55_000)) == snapshot.records(
+            snapshot.price_range(50_000, 55_000)
+        )
@@ -0,0 +1,191 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+
+from db import archive as db_archive
+from db import services as db_services
+from db.create_db import create_db
+from db.models import all_models as db_models
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://")
+    create_db(engine)
+
+    with Session(engine) as db_session:
+        db_session.add_all(
+            [
+                db_models.ReferenceTable(
+                    fipe_id="100", display_name="março/2005", month=3, year=2005
+                ),
+                db_models.ReferenceTable(
+                    fipe_id="308", display_name="junho/2024", month=6, year=2024
+                ),
+            ]
+        )
+        fusion = db_models.CarModel(
+            fipe_id="5940",
+            display_name="Fusion",
+            manufacturer_id="22",
+            manufacturer=db_models.Manufacturer(
+                fipe_id="22", display_name="Ford", vehicle_type_id=1
+            ),
+        )
+        model_years = {
+            model_year_id: db_models.CarModelYear(
+                fipe_id=model_year_id,
+                model_id="5940",
+                car_model=fusion,
+                display_name=model_year_id,
+                year=int(model_year_id[:4]),
+                fuel_type=1,
+            )
+            for model_year_id in ("2004-1", "2005-1")
+        }
+        for reference_table_id in ("100", "308"):
+            for model_year_id, model_year in model_years.items():
+                db_session.add(
+                    db_models.CarPrice(
+                        model_year=model_year,
+                        manufacturer_id="22",
+                        model_id="5940",
+                        model_year_id=model_year_id,
+                        vehicle_type_id=1,
+                        reference_table_id=reference_table_id,
+                        authentication=f"{reference_table_id}-{model_year_id}",
+                        query_date="",
+                        reference_month="",
+                        fipe_vehicle_code="003376-6",
+                        value=1000.0,
+                        raw_data={"CodigoFipe": "003376-6"},
+                    )
+                )
+        db_session.commit()
+
+        yield db_session
+
+
+def _count_prices(db_session):
+    return db_session.scalar(select(func.count()).select_from(db_models.CarPrice))
+
+
+def test_archive_moves_prices_to_parquet(db_session, tmp_path):
+    archived = db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+
+    assert archived.rows == 2
+    assert archived.path == str(tmp_path / "ano=2005" / "mes=03" / "100.parquet")
+    assert os.path.getsize(archived.path) == archived.size_bytes
+    assert _count_prices(db_session) == 2
+    assert [
+        a.reference_table_id
+        for a in db_archive.list_archived_reference_tables(db_session)
+    ] == ["100"]
+
+    # Archiving again is a no-op
+    assert db_archive.archive_reference_table(db_session, "100", str(tmp_path)) is None
+
+
+def test_hot_and_archived_prices_are_read_together(db_session, tmp_path):
+    db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+    columns = ["reference_table_id", "model_year_id", "authentication", "raw_data"]
+
+    rows = [tuple(row) for row in db_services.iter_all_car_prices(db_session, columns)]
+    assert sorted(row[2] for row in rows) == [
+        "100-2004-1",
+        "100-2005-1",
+        "308-2004-1",
+        "308-2005-1",
+    ]
+    assert all(row[3] == {"CodigoFipe": "003376-6"} for row in rows)
+
+    archived_rows = list(
+        db_services.iter_all_car_prices(
+            db_session, columns, reference_table_id="100", model_year_id="2005-1"
+        )
+    )
+    assert [row[2] for row in archived_rows] == ["100-2005-1"]
+
+
+def test_modified_archive_is_not_read(db_session, tmp_path):
+    archived = db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+    with open(archived.path, "ab") as f:
+        f.write(b"\0")
+
+    with pytest.raises(RuntimeError, match="sha256"):
+        list(db_archive.iter_archived_car_prices(db_session, ["value"]))
+
+
+def test_model_year_key_is_resolved_for_older_archives(db_session, tmp_path):
+    import pyarrow.parquet as pq
+
+    archived = db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+    # Archived before `preco` had `model_year_key`
+    table = pq.read_table(archived.path)
+    pq.write_table(table.drop_columns(["model_year_key"]), archived.path)
+    archived.sha256 = db_archive._sha256(archived.path)
+    db_session.commit()
+
+    rows = list(
+        db_archive.iter_archived_car_prices(
+            db_session, ["model_year_id", "model_year_key", "value"]
+        )
+    )
+
+    keys = {
+        model_year.fipe_id: model_year.id
+        for model_year in db_session.scalars(select(db_models.CarModelYear))
+    }
+    assert sorted(rows) == [
+        ("2004-1", keys["2004-1"], 1000.0),
+        ("2005-1", keys["2005-1"], 1000.0),
+    ]
+
+
+def test_lookups_read_archived_prices(db_session, tmp_path):
+    db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+
+    history = db_services.list_car_price_history(db_session, "003376-6", 2005)
+    assert [price["reference_table_id"] for price in history] == ["308", "100"]
+    assert history[1]["model_year"] == 2005
+    assert history[1]["reference_year"] == 2005
+
+    db_archive.archive_reference_table(db_session, "308", str(tmp_path))
+
+    price = db_services.get_car_price_by_fipe_code(db_session, "003376-6", 2004)
+    assert price["reference_table_id"] == "308"
+    prices = db_services.list_latest_car_prices_by_fipe_codes(
+        db_session, [("003376-6", 2004), ("003376-6", 2005), ("000000-0", 2005)]
+    )
+    assert sorted((p["model_year"], p["reference_table_id"]) for p in prices) == [
+        (2004, "308"),
+        (2005, "308"),
+    ]
+
+
+def test_snapshot_of_an_archived_month(db_session, tmp_path):
+    from analytics.snapshot import SnapshotIndex
+
+    db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+
+    snapshot = SnapshotIndex.from_database(db_session, "100")
+    assert sorted(snapshot.columns["model_year_id"].tolist()) == ["2004-1", "2005-1"]
+
+
+def test_archives_are_hashed_once(db_session, tmp_path, monkeypatch):
+    db_archive.archive_reference_table(db_session, "100", str(tmp_path))
+    _hashed = []
+    monkeypatch.setattr(
+        db_archive, "_sha256", lambda path: _hashed.append(path) or "unexpected"
+    )
+
+    for _ in range(3):
+        assert (
+            len(list(db_archive.iter_archived_car_prices(db_session, ["value"]))) == 2
+        )
+
+    assert _hashed == []
@@ -0,0 +1,205 @@
+import pytest
+from sqlalchemy import create_engine, delete
+from sqlalchemy.orm import Session
+
+from db.coverage import CoverageGap, PriceCoverage, iter_set_bits, update_coverage
+from db.models import all_models as db_models
+from db.models.base import mapper_registry
+
+REFERENCE_TABLES = ["301", "302", "303", "304", "305"]
+
+
+def test_iter_set_bits():
+    assert list(iter_set_bits(0b101001)) == [0, 3, 5]
+    assert list(iter_set_bits(0)) == []
+
+
+class TestPriceCoverage:
+    def test_lists_holes_between_first_and_last_price(self):
+        coverage = PriceCoverage.from_rows(
+            REFERENCE_TABLES,
+            [
+                ("302", "22", "5940", "2019-1", 1),
+                ("305", "22", "5940", "2019-1", 1),
+                ("301", "22", "5941", "2020-1", 1),
+                ("302", "22", "5941", "2020-1", 1),
+            ],
+        )
+
+        assert list(coverage.gaps()) == [
+            CoverageGap("303", "22", "5940", "2019-1", 1),
+            CoverageGap("304", "22", "5940", "2019-1", 1),
+        ]
+        assert coverage.count_gaps() == 2
+
+    def test_until_latest_does_not_apply_to_zero_km(self):
+        coverage = PriceCoverage.from_rows(
+            REFERENCE_TABLES,
+            [
+                ("301", "22", "5940", "32000-1", 1),
+                ("302", "22", "5940", "32000-1", 1),
+                ("303", "22", "5940", "2024-1", 1),
+            ],
+        )
+
+        assert [gap.reference_table_id for gap in coverage.gaps()] == []
+        assert [
+            (gap.model_year_id, gap.reference_table_id)
+            for gap in coverage.gaps(until_latest=True)
+        ] == [("2024-1", "304"), ("2024-1", "305")]
+
+    def test_archived_reference_tables_are_not_gaps(self):
+        coverage = PriceCoverage.from_rows(
+            REFERENCE_TABLES,
+            [
+                ("301", "22", "5940", "2019-1", 1),
+                ("305", "22", "5940", "2019-1", 1),
+            ],
+            archived_reference_table_ids=["302", "303"],
+        )
+
+        assert list(coverage.gaps()) == [CoverageGap("304", "22", "5940", "2019-1", 1)]
+        assert coverage.count_gaps() == 1
+
+    def test_ranges_and_catalog_model_years(self):
+        coverage = PriceCoverage(REFERENCE_TABLES, months=[0, 1, 2, 3, 5])
+        coverage.add_range(1, 2, "22", "5940", "2019-1")
+        coverage.add_range(4, 5, "22", "5940", "2019-1")
+        coverage.add_model_year("22", "5941", "2020-1")
+
+        assert coverage.bitmap("5940", "2019-1") == 0b10110
+        assert list(coverage.gaps()) == [
+            CoverageGap("304", "22", "5940", "2019-1", 1),
+            # No price at all
+            CoverageGap("305", "22", "5941", "2020-1", 1),
+        ]
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://")
+    mapper_registry.metadata.create_all(engine)
+
+    with Session(engine) as db_session:
+        for index, reference_table_id in enumerate(REFERENCE_TABLES):
+            db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id=reference_table_id,
+                    display_name=reference_table_id,
+                    month=index + 1,
+                    year=2024,
+                )
+            )
+        fusion = db_models.CarModel(
+            fipe_id="5940",
+            display_name="Fusion",
+            manufacturer_id="22",
+            manufacturer=db_models.Manufacturer(
+                fipe_id="22", display_name="Ford", vehicle_type_id=1
+            ),
+        )
+        for model_year_id in ("2019-1", "2020-1"):
+            db_session.add(
+                db_models.CarModelYear(
+                    fipe_id=model_year_id,
+                    model_id="5940",
+                    car_model=fusion,
+                    display_name=model_year_id,
+                    year=int(model_year_id[:4]),
+                    fuel_type=1,
+                )
+            )
+        for reference_table_id in ("301", "303"):
+            db_session.add(_car_price(reference_table_id))
+        db_session.commit()
+
+        yield db_session
+
+
+def _car_price(reference_table_id):
+    return db_models.CarPrice(
+        # The 2019 model year of the fixture
+        model_year_key=1,
+        manufacturer_id="22",
+        model_id="5940",
+        model_year_id="2019-1",
+        vehicle_type_id=1,
+        reference_table_id=reference_table_id,
+        authentication=reference_table_id,
+        query_date="",
+        reference_month="",
+        fipe_vehicle_code="003376-6",
+        value=1.0,
+        raw_data={},
+    )
+
+
+def test_from_database(db_session):
+    coverage = PriceCoverage.from_database(db_session)
+
+    assert coverage.bitmap("5940", "2019-1") == 0b101
+    assert list(coverage.gaps()) == [
+        CoverageGap("302", "22", "5940", "2019-1", 1),
+        CoverageGap("305", "22", "5940", "2020-1", 1),
+    ]
+
+
+def test_validity_ranges_are_prices(db_session):
+    db_session.add(
+        db_models.CarPriceInterval(
+            model_year_key=2,
+            manufacturer_id="22",
+            model_id="5940",
+            model_year_id="2020-1",
+            vehicle_type_id=1,
+            fipe_vehicle_code="003376-6",
+            value=1.0,
+            valid_from_id="302",
+            valid_to_id="305",
+            valid_from=2024 * 12 + 1,
+            valid_to=2024 * 12 + 4,
+        )
+    )
+    db_session.commit()
+
+    coverage = PriceCoverage.from_database(db_session)
+
+    assert coverage.bitmap("5940", "2020-1") == 0b11110
+    assert coverage.count_gaps() == 1
+
+
+def test_update_coverage_only_reads_new_prices(db_session, tmp_path):
+    path = str(tmp_path / "coverage.json")
+    assert update_coverage(db_session, path).count_gaps() == 2
+
+    db_session.add(_car_price("302"))
+    # Already in the saved bitmaps, only a rebuild sees it is gone
+    db_session.execute(
+        delete(db_models.CarPrice).where(db_models.CarPrice.reference_table_id == "303")
+    )
+    db_session.commit()
+
+    coverage = update_coverage(db_session, path)
+    assert coverage.bitmap("5940", "2019-1") == 0b111
+    assert coverage.last_car_price_id == 3
+    assert PriceCoverage.load(path).bitmap("5940", "2019-1") == 0b111
+    # The catalog model year without prices is not saved
+    assert PriceCoverage.load(path).bitmap("5940", "2020-1") == 0
+
+    assert (
+        update_coverage(db_session, path, rebuild=True).bitmap("5940", "2019-1") == 0b11
+    )
+
+
+def test_update_coverage_rebuilds_when_older_months_land(db_session, tmp_path):
+    path = str(tmp_path / "coverage.json")
+    update_coverage(db_session, path)
+
+    db_session.add(
+        db_models.ReferenceTable(fipe_id="300", display_name="300", month=12, year=2023)
+    )
+    db_session.commit()
+
+    coverage = update_coverage(db_session, path)
+    assert coverage.reference_table_ids[0] == "300"
+    assert coverage.bitmap("5940", "2019-1") == 0b1010
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.dialects import sqlite
+
+from db.columnar import attach_statement, connect_duckdb
+from db.create_db import create_db
+from db.engine import create_db_engine, upsert_insert
+
+
+def test_sqlite_file_engine(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'fipe.db'}")
+
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA foreign_keys")).scalar() == 1
+
+    assert upsert_insert(engine) is sqlite.insert
+
+
+def test_in_memory_engine_is_shared_between_threads():
+    engine = create_db_engine("sqlite://")
+    create_db(engine)
+
+    def count_reference_tables(result):
+        with engine.connect() as conn:
+            result.append(
+                conn.execute(text("SELECT count(*) FROM tabela_referencia")).scalar()
+            )
+
+    result = []
+    thread = threading.Thread(target=count_reference_tables, args=(result,))
+    thread.start()
+    thread.join()
+
+    assert result == [0]
+
+
+def test_attach_statement():
+    assert attach_statement("sqlite:///data/fipe.db") == (
+        "ATTACH 'data/fipe.db' AS fipe (TYPE sqlite, READ_ONLY)"
+    )
+    assert attach_statement("postgresql+psycopg://me:pw@localhost:5432/mydb") == (
+        "ATTACH 'host=localhost port=5432 dbname=mydb user=me password=pw' AS fipe"
+        " (TYPE postgres, READ_ONLY)"
+    )
+    with pytest.raises(ValueError):
+        attach_statement("sqlite://")
+
+
+def test_duckdb_reads_the_sqlite_database(tmp_path):
+    pytest.importorskip("duckdb")
+    database_uri = f"sqlite:///{tmp_path / 'fipe.db'}"
+    engine = create_db_engine(database_uri)
+    create_db(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO tabela_referencia VALUES ('308', 'junho/2024', 6, 2024)")
+        )
+
+    con = connect_duckdb(database_uri)
+
+    assert con.sql("SELECT fipe_id FROM tabela_referencia").fetchall() == [("308",)]
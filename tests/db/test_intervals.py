@@ -0,0 +1,54 @@
+from db.intervals import (
+    PriceInterval,
+    apply_observation,
+    expand_intervals,
+    month_ordinal,
+)
+
+
+def test_month_ordinal_is_consecutive_across_years():
+    assert month_ordinal(2024, 1) - month_ordinal(2023, 12) == 1
+
+
+class TestApplyObservation:
+    def test_first_observation(self):
+        assert apply_observation([], 10, 100.0) == [PriceInterval(10, 10, 100.0)]
+
+    def test_same_value_extends_neighbour(self):
+        intervals = [PriceInterval(5, 9, 100.0)]
+
+        assert apply_observation(intervals, 10, 100.0) == [PriceInterval(5, 10, 100.0)]
+        assert apply_observation(intervals, 4, 100.0) == [PriceInterval(4, 9, 100.0)]
+
+    def test_new_value_starts_a_new_interval(self):
+        intervals = [PriceInterval(5, 9, 100.0)]
+
+        assert apply_observation(intervals, 10, 90.0) == [
+            PriceInterval(5, 9, 100.0),
+            PriceInterval(10, 10, 90.0),
+        ]
+
+    def test_filling_a_hole_merges_both_sides(self):
+        intervals = [PriceInterval(5, 9, 100.0), PriceInterval(11, 12, 100.0)]
+
+        assert apply_observation(intervals, 10, 100.0) == [PriceInterval(5, 12, 100.0)]
+
+    def test_correction_splits_an_interval(self):
+        intervals = [PriceInterval(5, 9, 100.0)]
+
+        assert apply_observation(intervals, 7, 80.0) == [
+            PriceInterval(5, 6, 100.0),
+            PriceInterval(7, 7, 80.0),
+            PriceInterval(8, 9, 100.0),
+        ]
+
+    def test_known_price_is_a_no_op(self):
+        intervals = [PriceInterval(5, 9, 100.0)]
+
+        assert apply_observation(intervals, 7, 100.0) == intervals
+
+
+def test_expand_intervals():
+    intervals = [PriceInterval(7, 7, 80.0), PriceInterval(5, 6, 100.0)]
+
+    assert list(expand_intervals(intervals)) == [(5, 100.0), (6, 100.0), (7, 80.0)]
@@ -0,0 +1,135 @@
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from db import migrations as db_migrations
+from db import services as db_services
+from db.models import all_models as db_models
+
+# The catalog as created by the first release, before `preco_intervalo` and the
+# integer surrogate keys
+OLD_SCHEMA = [
+    """
+    CREATE TABLE tabela_referencia (
+        fipe_id VARCHAR(10) PRIMARY KEY, display_name VARCHAR(255), mes INTEGER,
+        ano INTEGER
+    )
+    """,
+    """
+    CREATE TABLE marca (
+        fipe_id VARCHAR(10) PRIMARY KEY, display_name VARCHAR(255),
+        tipo_veiculo SMALLINT
+    )
+    """,
+    """
+    CREATE TABLE modelo (
+        fipe_id VARCHAR(10) PRIMARY KEY, display_name VARCHAR(255),
+        marca_id VARCHAR(10) REFERENCES marca (fipe_id)
+    )
+    """,
+    """
+    CREATE TABLE ano_modelo (
+        fipe_id VARCHAR(10) PRIMARY KEY,
+        modelo_id VARCHAR(10) REFERENCES modelo (fipe_id),
+        display_name VARCHAR(255), ano INTEGER, tipo_combustivel INTEGER
+    )
+    """,
+    """
+    CREATE TABLE preco (
+        id INTEGER PRIMARY KEY, marca_id VARCHAR(10), modelo_id VARCHAR(10),
+        ano_modelo_id VARCHAR(10), codigo_tipo_veiculo INTEGER,
+        codigo_tabela_referencia VARCHAR(10), autenticacao VARCHAR(255),
+        data_consulta VARCHAR(255), mes_referencia VARCHAR(255),
+        codigo_fipe_veiculo VARCHAR(10), valor FLOAT, raw_data JSON
+    )
+    """,
+    "INSERT INTO tabela_referencia VALUES ('308', 'junho/2024', 6, 2024)",
+    "INSERT INTO marca VALUES ('22', 'Ford', 1)",
+    "INSERT INTO modelo VALUES ('5940', 'Fusion', '22'), ('5941', 'Focus', '22')",
+    # The Focus 2019 row was lost to the Fusion one, which has the same code
+    "INSERT INTO ano_modelo VALUES ('2019-1', '5940', '2019 Gasolina', 2019, 1)",
+    """
+    INSERT INTO preco VALUES
+        (1, '22', '5940', '2019-1', 1, '308', 'a', '', '', '003376-6', 100.0, '{}'),
+        (2, '22', '5941', '2019-1', 1, '308', 'b', '', '', '003377-4', 80.0, '{}'),
+        (3, '22', '5941', '2019-1', 1, '308', 'c', '', '', '003377-4', 81.0, '{}')
+    """,
+]
+
+# Added by the change-only storage, still without surrogate keys
+INTERVAL_SCHEMA = [
+    """
+    CREATE TABLE preco_intervalo (
+        id INTEGER PRIMARY KEY, marca_id VARCHAR(10), modelo_id VARCHAR(10),
+        ano_modelo_id VARCHAR(10), codigo_tipo_veiculo INTEGER,
+        codigo_fipe_veiculo VARCHAR(10), valor FLOAT, tabela_inicio_id VARCHAR(10),
+        tabela_fim_id VARCHAR(10), inicio INTEGER, fim INTEGER
+    )
+    """,
+    """
+    INSERT INTO preco_intervalo VALUES
+        (1, '22', '5941', '2019-1', 1, '003377-4', 81.0, '308', '308', 24293, 24293)
+    """,
+]
+
+
+def _old_engine(schema):
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        for statement in schema:
+            conn.exec_driver_sql(statement)
+
+    return engine
+
+
+def test_migrates_the_first_release_schema():
+    engine = _old_engine(OLD_SCHEMA)
+
+    assert db_migrations.migrate(engine) == ["catalog_keys"]
+    assert db_migrations.migrate(engine) == []
+
+    with Session(engine) as db_session:
+        prices = db_session.scalars(
+            select(db_models.CarPrice).order_by(db_models.CarPrice.id)
+        ).all()
+        intervals = db_session.scalars(select(db_models.CarPriceInterval)).all()
+
+    assert [(price.model_id, price.authentication) for price in prices] == [
+        ("5940", "a"),
+        ("5941", "c"),
+    ]
+    assert intervals == []
+
+
+def test_migrates_catalog_to_surrogate_keys():
+    engine = _old_engine(OLD_SCHEMA + INTERVAL_SCHEMA)
+
+    assert db_migrations.migrate(engine) == ["catalog_keys"]
+    assert db_migrations.migrate(engine) == []
+
+    with Session(engine) as db_session:
+        model_years = db_session.execute(
+            select(
+                db_models.CarModelYear.model_id,
+                db_models.CarModelYear.fipe_id,
+                db_models.CarModelYear.display_name,
+            ).order_by(db_models.CarModelYear.id)
+        ).all()
+        prices = db_session.scalars(
+            select(db_models.CarPrice).order_by(db_models.CarPrice.id)
+        ).all()
+        model_names = [price.model_year.car_model.display_name for price in prices]
+        series = db_services.list_car_price_series(db_session, "5941", "2019-1")
+
+    assert model_years == [
+        ("5940", "2019-1", "2019 Gasolina"),
+        ("5941", "2019-1", "2019 Gasolina"),
+    ]
+    # Duplicated prices are merged into the latest one
+    assert [(price.model_id, price.authentication) for price in prices] == [
+        ("5940", "a"),
+        ("5941", "c"),
+    ]
+    assert model_names == ["Fusion", "Focus"]
+    assert [(row["reference_table_id"], row["value"]) for row in series] == [
+        ("308", 81.0)
+    ]
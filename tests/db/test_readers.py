@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from db import readers as db_readers
+from db.models import all_models as db_models
+from db.models.base import mapper_registry
+
+
+@pytest.fixture
+def engine():
+    _engine = create_engine("sqlite://")
+    mapper_registry.metadata.create_all(_engine)
+
+    with Session(_engine) as db_session:
+        db_session.add_all(
+            [
+                db_models.ReferenceTable(
+                    fipe_id="308", display_name="junho/2024", month=6, year=2024
+                ),
+                db_models.ReferenceTable(
+                    fipe_id="307", display_name="maio/2024", month=5, year=2024
+                ),
+                db_models.CarModelYear(
+                    fipe_id="2019-1",
+                    model_id="5940",
+                    car_model=db_models.CarModel(
+                        fipe_id="5940",
+                        display_name="Fusion",
+                        manufacturer_id="22",
+                        manufacturer=db_models.Manufacturer(
+                            fipe_id="22", display_name="Ford", vehicle_type_id=1
+                        ),
+                    ),
+                    display_name="2019 Gasolina",
+                    year=2019,
+                    fuel_type=1,
+                ),
+            ]
+        )
+        db_session.commit()
+
+    return _engine
+
+
+def test_rows_use_attribute_names(engine):
+    with engine.connect() as conn:
+        reference_tables = db_readers.read_reference_tables(conn, descending=True)
+        model_years = db_readers.read_car_models_years(conn, with_manufacturer=True)
+
+    assert [row.fipe_id for row in reference_tables] == ["308", "307"]
+    assert reference_tables[0].year == 2024 and reference_tables[0].month == 6
+    assert model_years[0]._asdict() == {
+        "id": 1,
+        "fipe_id": "2019-1",
+        "model_key": 1,
+        "model_id": "5940",
+        "display_name": "2019 Gasolina",
+        "year": 2019,
+        "fuel_type": 1,
+        "manufacturer_id": "22",
+    }
+
+
+def test_as_columns(engine):
+    with Session(engine) as db_session:
+        columns = db_readers.read_reference_tables(db_session, as_columns=True)
+        empty = db_readers.read_car_prices(db_session, as_columns=True)
+
+    assert columns["fipe_id"] == ["307", "308"]
+    assert columns["month"] == [5, 6]
+    assert empty == {key: [] for key in db_readers.CAR_PRICE_COLUMNS}
@@ -0,0 +1,85 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from db import services as db_services
+from db.models import all_models as db_models
+from db.models.base import mapper_registry
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://")
+    mapper_registry.metadata.create_all(engine)
+
+    with Session(engine) as _db_session:
+        ford = db_models.Manufacturer(
+            fipe_id="22", display_name="Ford", vehicle_type_id=1
+        )
+        fusion = db_models.CarModel(
+            fipe_id="5940",
+            display_name="Fusion",
+            manufacturer_id="22",
+            manufacturer=ford,
+        )
+        for year in range(1990, 2025):
+            _db_session.add(
+                db_models.CarModelYear(
+                    fipe_id=f"{year}-1",
+                    model_id="5940",
+                    car_model=fusion,
+                    display_name=f"{year} Gasolina",
+                    year=year,
+                    fuel_type=1,
+                )
+            )
+        for index, (year, month) in enumerate([(2024, 5), (2024, 6), (2023, 12)]):
+            _db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id=str(300 + index),
+                    display_name=f"{month}/{year}",
+                    month=month,
+                    year=year,
+                )
+            )
+        _db_session.commit()
+
+        yield _db_session
+
+
+class TestIterCarModelsYears:
+    def test_streams_every_page(self, db_session):
+        model_years = list(
+            db_services.iter_car_models_years(
+                db_session, page_size=4, batch_size=2, year_gte=2000
+            )
+        )
+
+        assert [model_year.year for model_year in model_years] == list(
+            range(2000, 2025)
+        )
+        assert model_years == db_services.list_car_models_years(
+            db_session, year_gte=2000
+        )
+
+    def test_as_tuples_selects_only_requested_columns(self, db_session):
+        rows = list(
+            db_services.iter_car_models_years(
+                db_session, page_size=7, as_tuples=True, columns=["year"]
+            )
+        )
+
+        assert len(rows) == 35
+        assert rows[0].year == 1990
+        assert rows[0]._fields == ("year", "id")
+
+
+class TestIterReferenceTables:
+    def test_orders_by_year_and_month(self, db_session):
+        rows = db_services.iter_reference_tables(db_session, page_size=1)
+        assert [row.fipe_id for row in rows] == ["302", "300", "301"]
+
+        rows = db_services.iter_reference_tables(
+            db_session, page_size=2, as_tuples=True, descending=True, year=2024
+        )
+        assert [row.fipe_id for row in rows] == ["301", "300"]
@@ -0,0 +1,257 @@
+import json
+import threading
+from http.client import HTTPConnection
+from urllib.request import Request, urlopen
+
+import pytest
+from sqlalchemy import create_engine, delete
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from db.models import all_models as db_models
+from db.models.base import mapper_registry
+from lookup.cache import ResponseCache
+from lookup.server import LookupHTTPServer, LookupService
+
+
+@pytest.fixture
+def engine():
+    _engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    mapper_registry.metadata.create_all(_engine)
+
+    with Session(_engine) as db_session:
+        db_session.add_all(
+            [
+                db_models.ReferenceTable(
+                    fipe_id="1", display_name="maio/2024", month=5, year=2024
+                ),
+                db_models.ReferenceTable(
+                    fipe_id="2", display_name="junho/2024", month=6, year=2024
+                ),
+                db_models.CarModelYear(
+                    fipe_id="2019-1",
+                    model_id="5940",
+                    car_model=db_models.CarModel(
+                        fipe_id="5940",
+                        display_name="Fusion",
+                        manufacturer_id="22",
+                        manufacturer=db_models.Manufacturer(
+                            fipe_id="22", display_name="Ford", vehicle_type_id=1
+                        ),
+                    ),
+                    display_name="2019 Gasolina",
+                    year=2019,
+                    fuel_type=1,
+                ),
+            ]
+        )
+        for reference_table_id, value in (("1", 120_000.0), ("2", 125_383.0)):
+            db_session.add(_car_price(reference_table_id, value))
+        db_session.commit()
+
+    return _engine
+
+
+def _car_price(reference_table_id, value):
+    return db_models.CarPrice(
+        # The only model year of the fixture
+        model_year_key=1,
+        manufacturer_id="22",
+        model_id="5940",
+        model_year_id="2019-1",
+        vehicle_type_id=1,
+        reference_table_id=reference_table_id,
+        authentication=f"auth-{reference_table_id}",
+        query_date="",
+        reference_month="",
+        fipe_vehicle_code="003376-6",
+        value=value,
+        raw_data={},
+    )
+
+
+class TestResponseCache:
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    def test_new_version_clears_entries(self):
+        cache = ResponseCache()
+        assert cache.set_version("308")
+        cache.set("a", 1)
+
+        assert not cache.set_version("308")
+        assert cache.get("a") == 1
+        assert cache.set_version("309")
+        assert cache.get("a") is None
+
+
+class TestLookupService:
+    def test_latest_price_and_history(self, engine):
+        service = LookupService(engine)
+
+        assert service.get_price("003376-6", 2019)["value"] == 125_383.0
+        assert service.get_price("003376-6", 2020) is None
+        assert [
+            p["reference_table_id"] for p in service.get_price_history("003376-6", 2019)
+        ] == ["2", "1"]
+
+    def test_batch_preserves_order_and_fills_cache(self, engine):
+        service = LookupService(engine)
+
+        prices = service.get_prices([("000000-0", 2019), ("003376-6", 2019)])
+
+        assert prices[0] is None
+        assert prices[1]["reference_table_id"] == "2"
+        assert service.cache.get(("price", "003376-6", 2019)) == prices[1]
+
+    def test_cache_is_invalidated_when_a_reference_table_lands(self, engine):
+        service = LookupService(engine)
+        service.refresh_version(force=True)
+        assert service.get_price("003376-6", 2019)["value"] == 125_383.0
+
+        with Session(engine) as db_session:
+            db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id="3", display_name="julho/2024", month=7, year=2024
+                )
+            )
+            db_session.add(_car_price("3", 126_000.0))
+            db_session.commit()
+
+        service.refresh_version(force=True)
+
+        assert service.reference_table_id == "3"
+        assert service.get_price("003376-6", 2019)["value"] == 126_000.0
+
+    def test_cache_is_invalidated_while_a_reference_table_is_crawled(self, engine):
+        service = LookupService(engine)
+
+        # The watcher stores the reference table before crawling it
+        with Session(engine) as db_session:
+            db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id="3", display_name="julho/2024", month=7, year=2024
+                )
+            )
+            db_session.commit()
+
+        service.refresh_version(force=True)
+        assert service.get_price("003376-6", 2019)["value"] == 125_383.0
+        assert len(service.get_price_history("003376-6", 2019)) == 2
+
+        with Session(engine) as db_session:
+            db_session.add(_car_price("3", 126_000.0))
+            db_session.commit()
+
+        service.refresh_version(force=True)
+
+        assert service.get_price("003376-6", 2019)["value"] == 126_000.0
+        assert len(service.get_price_history("003376-6", 2019)) == 3
+
+    def test_snapshot_ids_are_checked(self, engine, tmp_path):
+        service = LookupService(engine, snapshot_dir=str(tmp_path), max_snapshots=1)
+        service.refresh_version(force=True)
+
+        with pytest.raises(ValueError):
+            service.get_snapshot("../2")
+        with pytest.raises(KeyError):
+            service.get_snapshot("99")
+
+        assert len(service.get_snapshot("1")) == 1
+        assert len(service.get_snapshot()) == 1
+        assert len(service._snapshots) == 1
+
+    def test_snapshot_of_the_latest_month_follows_its_crawl(self, engine, tmp_path):
+        service = LookupService(
+            engine, snapshot_dir=str(tmp_path), snapshot_check_interval=0
+        )
+        service.refresh_version(force=True)
+        assert len(service.get_snapshot()) == 1
+        assert len(service.get_snapshot("1")) == 1
+
+        with Session(engine) as db_session:
+            db_session.execute(delete(db_models.CarPrice))
+            db_session.commit()
+
+        assert len(service.get_snapshot()) == 0
+        # Older months are complete, their snapshots are kept
+        assert len(service.get_snapshot("1")) == 1
+
+
+class TestLookupHTTPServer:
+    def test_serves_json(self, engine, tmp_path):
+        service = LookupService(engine, snapshot_dir=str(tmp_path))
+        service.refresh_version(force=True)
+        server = LookupHTTPServer(("127.0.0.1", 0), service)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        try:
+            with urlopen(f"{base_url}/prices/003376-6/2019") as response:
+                assert json.load(response)["value"] == 125_383.0
+
+            request = Request(
+                f"{base_url}/prices/batch",
+                data=json.dumps(
+                    {"lookups": [{"fipe_vehicle_code": "003376-6", "model_year": 2019}]}
+                ).encode(),
+                method="POST",
+            )
+            with urlopen(request) as response:
+                assert json.load(response)["prices"][0]["model_id"] == "5940"
+
+            with urlopen(f"{base_url}/prices/range?min=100000&year=2019") as response:
+                assert [price["value"] for price in json.load(response)] == [125_383.0]
+
+            with urlopen(f"{base_url}/prices/nearest?value=1") as response:
+                assert json.load(response)[0]["model_year_id"] == "2019-1"
+
+            with urlopen(f"{base_url}/search?q=fusao&kind=model") as response:
+                assert [model["fipe_id"] for model in json.load(response)] == ["5940"]
+
+            with urlopen(f"{base_url}/manufacturers/22/models") as response:
+                assert json.load(response) == [
+                    {
+                        "fipe_id": "5940",
+                        "display_name": "Fusion",
+                        "manufacturer_id": "22",
+                    }
+                ]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_unread_bodies_do_not_break_keep_alive(self, engine, tmp_path):
+        service = LookupService(engine, snapshot_dir=str(tmp_path))
+        server = LookupHTTPServer(("127.0.0.1", 0), service)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        connection = HTTPConnection("127.0.0.1", server.server_address[1])
+
+        try:
+            connection.request("POST", "/prices/unknown", body=b'{"lookups": []}')
+            response = connection.getresponse()
+            assert response.status == 404
+            response.read()
+
+            # Same connection, the previous body must not be read as a request
+            connection.request("GET", "/prices/003376-6/2019")
+            response = connection.getresponse()
+            assert json.load(response)["value"] == 125_383.0
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
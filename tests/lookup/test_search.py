@@ -0,0 +1,57 @@
+from lookup.search import SearchIndex, normalize, trigrams
+
+
+def test_normalize_strips_accents_and_punctuation():
+    assert normalize("Citroën C4 (Picasso)") == "citroen c4 picasso"
+    assert normalize("  GOL 1.0 Mi/ Total Flex 8V 4p ") == "gol 1 0 mi total flex 8v 4p"
+
+
+def test_trigrams_are_padded_per_word():
+    assert trigrams("ab c") == {"  a", " ab", "ab ", "  c", " c "}
+
+
+def _index():
+    index = SearchIndex()
+    for fipe_id, name in (("22", "Ford"), ("56", "Citroën"), ("59", "VW - VolksWagen")):
+        index.add("manufacturer", fipe_id, name, fipe_id, name)
+
+    for fipe_id, name, manufacturer_id, manufacturer_name in (
+        ("5940", "Fusion Titanium 2.0 GTDI Eco. Awd Aut.", "22", "Ford"),
+        ("5941", "Fusion SE 2.5 16V Flex Aut.", "22", "Ford"),
+        ("3012", "Fiesta 1.6 16V Flex Mec. 5p", "22", "Ford"),
+        ("4200", "C4 Picasso Intensive 1.6 Turbo", "56", "Citroën"),
+        ("7000", "Gol 1.0 Mi Total Flex 8V 4p", "59", "VW - VolksWagen"),
+    ):
+        index.add("model", fipe_id, name, manufacturer_id, manufacturer_name)
+
+    return index
+
+
+class TestSearchIndex:
+    def test_ranks_closest_names_first(self):
+        index = _index()
+
+        assert [result["fipe_id"] for result in index.search("fusion")] == [
+            "5941",
+            "5940",
+        ]
+        assert [result["fipe_id"] for result in index.search("fusion titanium")] == [
+            "5940"
+        ]
+
+    def test_is_accent_insensitive(self):
+        assert _index().search("citroen", kind="manufacturer")[0]["fipe_id"] == "56"
+        assert _index().search("CITROËN picasso")[0]["fipe_id"] == "4200"
+
+    def test_tolerates_typos(self):
+        assert _index().search("fusoin titaniun")[0]["fipe_id"] == "5940"
+
+    def test_matches_manufacturer_and_model(self):
+        results = _index().search("ford fiesta", kind="model")
+
+        assert results[0]["fipe_id"] == "3012"
+        assert results[0]["manufacturer_name"] == "Ford"
+
+    def test_unrelated_query_has_no_results(self):
+        assert _index().search("zzzz") == []
+        assert _index().search("  ") == []
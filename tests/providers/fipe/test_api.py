@@ -0,0 +1,132 @@
+import os
+
+import pytest
+import requests
+
+from providers.fipe import exceptions
+from providers.fipe.api import FipeApi
+
+
+class TestFipeApiRequestCache:
+    def test_hash_does_not_depend_on_params_order(self):
+        api = FipeApi()
+
+        assert api._hash_request(
+            "/ConsultarMarcas",
+            {"codigoTabelaReferencia": "308", "codigoTipoVeiculo": "1"},
+        ) == api._hash_request(
+            "/ConsultarMarcas",
+            {"codigoTipoVeiculo": "1", "codigoTabelaReferencia": "308"},
+        )
+
+    def test_cached_response_is_read_from_legacy_key(self, tmp_path):
+        api = FipeApi()
+        api.REQUEST_CACHE_DIR = str(tmp_path)
+        params = {"codigoTabelaReferencia": "308", "codigoTipoVeiculo": "1"}
+
+        legacy_path = tmp_path / f"{api._legacy_hash_request('/x', params)}.json"
+        legacy_path.write_text("[]", encoding="utf-8")
+
+        assert api._get_cached_response("/x", params) == "[]"
+        assert not legacy_path.exists()
+        assert os.path.exists(tmp_path / f"{api._hash_request('/x', params)}.json")
+
+    def test_cache_roundtrip(self, tmp_path):
+        api = FipeApi()
+        api.REQUEST_CACHE_DIR = str(tmp_path)
+
+        api._cache_request("/ConsultarTabelaDeReferencia", None, '[{"Codigo": 1}]')
+
+        assert os.listdir(tmp_path) == [
+            f"{api._hash_request('/ConsultarTabelaDeReferencia', None)}.json"
+        ]
+        assert (
+            api._get_cached_response("/ConsultarTabelaDeReferencia", None)
+            == '[{"Codigo": 1}]'
+        )
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+
+class TestFipeApiNegativeCache:
+    PARAMS = {"codigoTabelaReferencia": "308", "codigoMarca": "1"}
+
+    def _api(self, tmp_path, responses, **kwargs):
+        api = FipeApi(**kwargs)
+        api.REQUEST_CACHE_DIR = str(tmp_path / "positive")
+        api.NEGATIVE_CACHE_DIR = str(tmp_path / "negative")
+        os.makedirs(api.REQUEST_CACHE_DIR)
+
+        calls = []
+
+        def post(endpoint, params, timeout):
+            calls.append(endpoint)
+            return FakeResponse(responses[endpoint])
+
+        api._post = post
+        return api, calls
+
+    def test_error_responses_are_cached_apart(self, tmp_path):
+        api, calls = self._api(
+            tmp_path, {"/ConsultarModelos": '{"codigo": "0", "erro": "nadaencontrado"}'}
+        )
+
+        for _ in range(2):
+            with pytest.raises(exceptions.CarModelDoesNotExistException):
+                api.get_car_models("308", "1")
+
+        assert calls == ["/ConsultarModelos"]
+        assert os.listdir(tmp_path / "positive") == []
+        assert len(os.listdir(tmp_path / "negative")) == 1
+
+    def test_error_responses_expire(self, tmp_path):
+        api, calls = self._api(
+            tmp_path,
+            {"/ConsultarModelos": '{"erro": "nadaencontrado"}'},
+            negative_cache_ttl=60,
+        )
+
+        with pytest.raises(exceptions.CarModelDoesNotExistException):
+            api.get_car_models("308", "1")
+
+        (cached,) = (tmp_path / "negative").iterdir()
+        os.utime(cached, (0, 0))
+
+        with pytest.raises(exceptions.CarModelDoesNotExistException):
+            api.get_car_models("308", "1")
+
+        assert len(calls) == 2
+
+    def test_error_in_positive_cache_is_moved(self, tmp_path):
+        api, calls = self._api(tmp_path, {})
+        params = {
+            "codigoTabelaReferencia": "308",
+            "codigoMarca": "1",
+            "codigoTipoVeiculo": "1",
+        }
+        api._cache_request("/ConsultarModelos", params, '{"erro": "nadaencontrado"}')
+
+        with pytest.raises(exceptions.CarModelDoesNotExistException):
+            api.get_car_models("308", "1")
+
+        assert calls == []
+        assert os.listdir(tmp_path / "positive") == []
+        assert len(os.listdir(tmp_path / "negative")) == 1
+
+    def test_network_errors_are_not_missing_data(self, tmp_path):
+        api, _ = self._api(tmp_path, {})
+
+        def post(endpoint, params, timeout):
+            raise requests.exceptions.ConnectionError
+
+        api._post = post
+
+        with pytest.raises(exceptions.FipeApiRequestException) as exc_info:
+            api.get_car_models("308", "1")
+
+        assert not isinstance(exc_info.value, exceptions.CarModelDoesNotExistException)
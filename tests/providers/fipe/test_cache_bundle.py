@@ -0,0 +1,138 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from providers.fipe.api import FipeApi
+from providers.fipe.cache_bundle import (
+    export_bundle,
+    import_bundle,
+    list_bundles,
+    read_manifest,
+)
+from providers.fipe.exceptions import CacheBundleIntegrityException
+
+
+def _api(root) -> FipeApi:
+    api = FipeApi()
+    api.REQUEST_CACHE_DIR = str(root / "positive")
+    api.NEGATIVE_CACHE_DIR = str(root / "negative")
+    os.makedirs(api.REQUEST_CACHE_DIR)
+    return api
+
+
+def _dirs(api: FipeApi) -> dict:
+    return {
+        "cache_dir": api.REQUEST_CACHE_DIR,
+        "negative_cache_dir": api.NEGATIVE_CACHE_DIR,
+    }
+
+
+def _brands(reference_table_id: str) -> dict:
+    return {"codigoTabelaReferencia": reference_table_id, "codigoTipoVeiculo": "1"}
+
+
+@pytest.fixture
+def source(tmp_path):
+    api = _api(tmp_path / "source")
+    api._cache_request("/ConsultarTabelaDeReferencia", None, '[{"Codigo": 308}]')
+    api._cache_request("/ConsultarMarcas", _brands("308"), '[{"Value": "21"}]')
+    api._cache_request("/ConsultarMarcas", _brands("307"), '[{"Value": "21"}]')
+    api._cache_negative_response(
+        "/ConsultarModelos", {"codigoTabelaReferencia": "308"}, '{"erro": "x"}'
+    )
+    return api
+
+
+def test_roundtrip_to_an_empty_node(tmp_path, source):
+    path = export_bundle(bundle_dir=str(tmp_path / "bundles"), **_dirs(source))
+
+    target = _api(tmp_path / "target")
+    result = import_bundle(path, **_dirs(target))
+
+    assert result == {
+        "bundle_id": read_manifest(path)["bundle_id"],
+        "written": 4,
+        "skipped": 0,
+    }
+    assert target._get_cached_response("/ConsultarMarcas", _brands("307")) == (
+        '[{"Value": "21"}]'
+    )
+    assert target._get_negative_cached_response(
+        "/ConsultarModelos", {"codigoTabelaReferencia": "308"}
+    ) == ('{"erro": "x"}')
+    # Identical responses are stored once
+    with tarfile.open(path) as tar:
+        assert len(tar.getnames()) == 1 + 3
+
+    # The imported node can bundle per reference table in turn
+    again = export_bundle(
+        ["308"], bundle_dir=str(tmp_path / "target-bundles"), **_dirs(target)
+    )
+    assert len(read_manifest(again)["entries"]) == 3
+
+
+def test_reimport_skips_up_to_date_responses(tmp_path, source):
+    path = export_bundle(bundle_dir=str(tmp_path / "bundles"), **_dirs(source))
+
+    assert import_bundle(path, **_dirs(source))["skipped"] == 4
+
+
+def test_bundle_of_a_reference_table(tmp_path, source):
+    path = export_bundle(["307"], bundle_dir=str(tmp_path / "bundles"), **_dirs(source))
+
+    entries = read_manifest(path)["entries"]
+    assert sorted(entry["endpoint"] for entry in entries) == [
+        "/ConsultarMarcas",
+        "/ConsultarTabelaDeReferencia",
+    ]
+    assert {entry["params"].get("codigoTabelaReferencia") for entry in entries} == {
+        "307",
+        None,
+    }
+
+
+def test_bundles_are_content_addressed(tmp_path, source):
+    first = export_bundle(bundle_dir=str(tmp_path / "a"), **_dirs(source))
+    second = export_bundle(bundle_dir=str(tmp_path / "b"), **_dirs(source))
+
+    assert os.path.basename(first) == os.path.basename(second)
+
+
+def test_incremental_bundle_only_has_new_responses(tmp_path, source):
+    bundle_dir = str(tmp_path / "bundles")
+    first = export_bundle(bundle_dir=bundle_dir, **_dirs(source))
+    assert (
+        export_bundle(incremental=True, bundle_dir=bundle_dir, **_dirs(source)) is None
+    )
+
+    source._cache_request("/ConsultarMarcas", _brands("309"), '[{"Value": "22"}]')
+    delta = export_bundle(incremental=True, bundle_dir=bundle_dir, **_dirs(source))
+
+    manifest = read_manifest(delta)
+    assert [entry["params"] for entry in manifest["entries"]] == [_brands("309")]
+    assert manifest["parents"] == [read_manifest(first)["bundle_id"]]
+    assert list_bundles(bundle_dir) == [first, delta]
+
+
+def _rewrite_object(path: str, new_path: str, data: bytes) -> None:
+    with tarfile.open(path) as tar, tarfile.open(new_path, "w:xz") as new_tar:
+        for member in tar:
+            content = tar.extractfile(member).read()
+            if member.name.startswith("objects/"):
+                content = data
+            member.size = len(content)
+            new_tar.addfile(member, io.BytesIO(content))
+
+
+def test_corrupt_object_is_rejected(tmp_path, source):
+    path = export_bundle(["307"], bundle_dir=str(tmp_path / "bundles"), **_dirs(source))
+    corrupt = str(tmp_path / "corrupt.tar.xz")
+    _rewrite_object(path, corrupt, b"[]")
+
+    target = _api(tmp_path / "target")
+    with pytest.raises(CacheBundleIntegrityException):
+        import_bundle(corrupt, **_dirs(target))
+
+    assert os.listdir(target.REQUEST_CACHE_DIR) == []
@@ -0,0 +1,104 @@
+import pytest
+
+from providers.fipe.circuit_breaker import CircuitBreaker
+from providers.fipe.exceptions import CircuitOpenException
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def _breaker(clock, **kwargs):
+    return CircuitBreaker(
+        failure_threshold=3,
+        recovery_timeout=30,
+        success_threshold=2,
+        clock=clock,
+        **kwargs,
+    )
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = _breaker(clock)
+
+    for _ in range(2):
+        breaker.record_failure(breaker.acquire())
+    breaker.record_success(breaker.acquire())
+    for _ in range(2):
+        breaker.record_failure(breaker.acquire())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure(breaker.acquire())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenException):
+        breaker.acquire(timeout=0)
+
+
+def test_half_open_probes_close_the_circuit(clock):
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.record_failure(breaker.acquire())
+
+    clock.now = 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    probe = breaker.acquire(timeout=0)
+    assert probe
+    # A single probe at a time
+    with pytest.raises(CircuitOpenException):
+        breaker.acquire(timeout=0)
+
+    breaker.record_success(probe)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    breaker.record_success(breaker.acquire(timeout=0))
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert not breaker.acquire(timeout=0)
+
+
+def test_failed_probe_reopens_the_circuit(clock):
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.record_failure(breaker.acquire())
+
+    clock.now = 30
+    breaker.record_failure(breaker.acquire(timeout=0))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now = 59
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 60
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_released_probe_frees_its_slot(clock):
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.record_failure(breaker.acquire())
+
+    clock.now = 30
+    breaker.release(breaker.acquire(timeout=0))
+
+    assert breaker.acquire(timeout=0)
+
+
+def test_stale_results_do_not_affect_an_open_circuit(clock):
+    breaker = _breaker(clock)
+    in_flight = [breaker.acquire() for _ in range(4)]
+    for probe in in_flight[:3]:
+        breaker.record_failure(probe)
+
+    # Sent before the circuit opened, not a probe
+    breaker.record_success(in_flight[3])
+
+    assert breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,159 @@
+import threading
+
+import requests
+
+from providers.fipe.api import FipeApi
+from providers.fipe.latency import HedgeBudget, LatencyTracker
+
+
+class TestLatencyTracker:
+    def test_default_timeout_while_warming_up(self):
+        tracker = LatencyTracker(min_samples=5, default_timeout=10.0)
+        tracker.observe("/x", 0.1)
+
+        assert tracker.timeout("/x") == 10.0
+        assert tracker.hedge_delay("/x") is None
+
+    def test_timeout_follows_p99_per_endpoint(self):
+        tracker = LatencyTracker(min_samples=5, min_timeout=0.1, timeout_multiplier=3)
+        for index in range(100):
+            tracker.observe("/fast", 0.2 if index else 2.0)
+            tracker.observe("/slow", 1.5)
+
+        assert tracker.hedge_delay("/fast") == 0.2
+        assert tracker.timeout("/fast") == 0.2 * 3
+        assert tracker.timeout("/slow") == 1.5 * 3
+
+    def test_timeout_is_clamped(self):
+        tracker = LatencyTracker(min_samples=1, min_timeout=1.0, max_timeout=5.0)
+        tracker.observe("/fast", 0.01)
+        tracker.observe("/slow", 10.0)
+
+        assert tracker.timeout("/fast") == 1.0
+        assert tracker.timeout("/slow") == 5.0
+
+
+def test_hedge_budget_is_a_fraction_of_requests():
+    budget = HedgeBudget(ratio=0.1, burst=1)
+
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+
+    for _ in range(10):
+        budget.record_request()
+
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+
+class TestHedgedRequests:
+    def _api(self, hedge_budget=None, hedge_workers=8):
+        latency = LatencyTracker(min_samples=1)
+        latency.observe("/x", 0.01)
+        return FipeApi(
+            hedge=True,
+            latency=latency,
+            hedge_budget=hedge_budget,
+            hedge_workers=hedge_workers,
+        )
+
+    def test_slow_request_is_hedged(self):
+        api = self._api()
+        release = threading.Event()
+        calls = []
+
+        def timed_post(endpoint, params, timeout):
+            calls.append(endpoint)
+            if len(calls) == 1:
+                release.wait(5)
+                return FakeResponse("slow")
+            return FakeResponse("hedged")
+
+        api._timed_post = timed_post
+        try:
+            assert api._post("/x", {}, timeout=5).text == "hedged"
+        finally:
+            release.set()
+            api.close()
+
+        assert len(calls) == 2
+
+    def test_no_hedge_without_budget(self):
+        api = self._api(HedgeBudget(ratio=0, burst=0))
+        calls = []
+
+        def timed_post(endpoint, params, timeout):
+            calls.append(endpoint)
+            threading.Event().wait(0.05)
+            return FakeResponse("slow")
+
+        api._timed_post = timed_post
+        try:
+            assert api._post("/x", {}, timeout=5).text == "slow"
+        finally:
+            api.close()
+
+        assert len(calls) == 1
+
+    def test_no_hedge_without_a_free_worker(self):
+        budget = HedgeBudget()
+        api = self._api(budget, hedge_workers=1)
+        calls = []
+
+        def timed_post(endpoint, params, timeout):
+            calls.append(threading.current_thread().name)
+            threading.Event().wait(0.05)
+            return FakeResponse("slow")
+
+        api._timed_post = timed_post
+        try:
+            assert api._post("/x", {}, timeout=5).text == "slow"
+        finally:
+            api.close()
+
+        assert len(calls) == 1
+        assert budget.hedges == 0
+
+        # Without any worker the request is sent from the calling thread
+        api = self._api(budget, hedge_workers=0)
+        api._timed_post = timed_post
+        assert api._post("/x", {}, timeout=5).text == "slow"
+        assert calls[-1] == threading.current_thread().name
+
+    def test_failed_requests_are_observed(self):
+        api = FipeApi()
+
+        class TimingOutSession:
+            def post(self, url, params, timeout):
+                raise requests.exceptions.Timeout
+
+        api._local.session = TimingOutSession()
+        for _ in range(api.latency.min_samples):
+            try:
+                api._timed_post("/x", {}, timeout=1)
+            except requests.exceptions.Timeout:
+                pass
+
+        assert api.latency.percentile("/x", 50) is not None
+
+    def test_timed_out_request_is_retried(self):
+        api = FipeApi()
+        timeouts = []
+
+        def post(endpoint, params, timeout):
+            timeouts.append(timeout)
+            if len(timeouts) == 1:
+                raise requests.exceptions.Timeout
+            return FakeResponse("[]")
+
+        api._post = post
+
+        assert api._make_request_raw("/x", {}) == "[]"
+        assert timeouts == [10.0, 10.0]
@@ -0,0 +1,253 @@
+import threading
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from db.coverage import CoverageGap
+from providers.fipe.api import FipeApi
+from providers.fipe.exceptions import (
+    CarPriceDoesNotExistException,
+    CircuitOpenException,
+)
+from providers.fipe.pipeline import PriceJob, PricePipeline, load_failed_jobs
+
+SAMPLE_PRICE_RESPONSE = {
+    "Valor": "R$ 125.383,00",
+    "Marca": "Ford",
+    "Modelo": "Fusion Titanium 2.0 GTDI Eco. Awd Aut.",
+    "AnoModelo": 2019,
+    "Combustivel": "Gasolina",
+    "CodigoFipe": "003376-6",
+    "MesReferencia": "junho de 2024 ",
+    "Autenticacao": "g2bmp6342sc9z",
+    "TipoVeiculo": 1,
+    "SiglaCombustivel": "G",
+    "DataConsulta": "quinta-feira, 27 de junho de 2024 13:24",
+}
+
+
+class FakeFipeApi:
+    def __init__(self):
+        self.requested = []
+
+    def get_price_response(self, reference_table_id, *args):
+        self.requested.append(reference_table_id)
+        if reference_table_id == "outage":
+            raise CircuitOpenException("open for 600s")
+
+        if reference_table_id == "missing":
+            raise LookupError(reference_table_id)
+
+        if reference_table_id == "no-price":
+            raise CarPriceDoesNotExistException(reference_table_id)
+
+        return dict(SAMPLE_PRICE_RESPONSE, Autenticacao=reference_table_id)
+
+    parse_price_response = staticmethod(FipeApi.parse_price_response)
+
+
+class FakeRepository:
+    def __init__(self, store, failing_commits=0):
+        self.store = store
+        self.pending = []
+        self.commits = 0
+        self.failing_commits = failing_commits
+
+    def persist_car_price_change(self, car_price, *args, commit=True):
+        # (model year, worker)
+        self.pending.append((args[2], self))
+
+    def persist_car_price(self, car_price, *args, commit=True):
+        if car_price.authentication == "bad-row":
+            raise KeyError("Unknown model year")
+        self.pending.append(car_price.authentication)
+
+    def commit(self):
+        if self.failing_commits:
+            self.failing_commits -= 1
+            raise OperationalError("COMMIT", {}, Exception("connection reset"))
+        self.store.extend(self.pending)
+        self.pending = []
+        self.commits += 1
+
+    def rollback(self):
+        self.pending = []
+
+
+def _job(reference_table_id):
+    return PriceJob(
+        reference_table_id=reference_table_id,
+        manufacturer_id="22",
+        model_id="5940",
+        model_year_id="2019-1",
+    )
+
+
+class TestPricePipeline:
+    def test_every_submitted_job_is_persisted_on_close(self):
+        store = []
+        pipeline = PricePipeline(
+            FakeFipeApi(),
+            fetch_workers=3,
+            queue_size=2,
+            commit_every=4,
+            repository_factory=lambda: FakeRepository(store),
+        )
+
+        for i in range(25):
+            pipeline.submit(_job(str(i)))
+        pipeline.close()
+
+        assert sorted(store, key=int) == [str(i) for i in range(25)]
+        assert pipeline.failed_jobs == 0
+
+    def test_failed_jobs_are_counted_and_skipped(self):
+        store = []
+        pipeline = PricePipeline(
+            FakeFipeApi(), repository_factory=lambda: FakeRepository(store)
+        )
+
+        pipeline.submit(_job("1"))
+        pipeline.submit(_job("missing"))
+        pipeline.submit(_job("2"))
+        pipeline.close()
+
+        assert sorted(store) == ["1", "2"]
+        assert pipeline.failed_jobs == 1
+
+    def test_missing_prices_are_not_failures(self):
+        store = []
+        pipeline = PricePipeline(
+            FakeFipeApi(), repository_factory=lambda: FakeRepository(store)
+        )
+
+        pipeline.submit(_job("no-price"))
+        pipeline.submit(_job("1"))
+        pipeline.close()
+
+        assert store == ["1"]
+        assert pipeline.missing_prices == 1
+        assert pipeline.failed_jobs == 0
+
+    def test_close_is_idempotent_and_joins_workers(self):
+        pipeline = PricePipeline(
+            FakeFipeApi(), repository_factory=lambda: FakeRepository([])
+        )
+        pipeline.close()
+        pipeline.close()
+
+        assert not [t for t in threading.enumerate() if t.name.startswith("fipe-")]
+
+    def test_failed_row_does_not_drop_its_batch(self, tmp_path):
+        store = []
+        failed_jobs_file = str(tmp_path / "failed_jobs.jsonl")
+        pipeline = PricePipeline(
+            FakeFipeApi(),
+            commit_every=10,
+            repository_factory=lambda: FakeRepository(store),
+            failed_jobs_file=failed_jobs_file,
+        )
+
+        for reference_table_id in ("1", "2", "bad-row", "3", "missing"):
+            pipeline.submit(_job(reference_table_id))
+        pipeline.close()
+
+        assert sorted(store) == ["1", "2", "3"]
+        assert pipeline.failed_jobs == 2
+        assert set(load_failed_jobs(failed_jobs_file)) == {
+            CoverageGap("bad-row", "22", "5940", "2019-1", 1),
+            CoverageGap("missing", "22", "5940", "2019-1", 1),
+        }
+
+    def test_failed_commit_is_retried_one_price_at_a_time(self):
+        store = []
+        pipeline = PricePipeline(
+            FakeFipeApi(),
+            commit_every=3,
+            repository_factory=lambda: FakeRepository(store, failing_commits=1),
+        )
+
+        for i in range(3):
+            pipeline.submit(_job(str(i)))
+        pipeline.close()
+
+        assert sorted(store) == ["0", "1", "2"]
+        assert pipeline.failed_jobs == 0
+
+    def test_open_circuit_cancels_queued_jobs(self, tmp_path):
+        store = []
+        api = FakeFipeApi()
+        failed_jobs_file = str(tmp_path / "failed_jobs.jsonl")
+        pipeline = PricePipeline(
+            api,
+            fetch_workers=1,
+            repository_factory=lambda: FakeRepository(store),
+            failed_jobs_file=failed_jobs_file,
+        )
+        queued, circuit_opened = threading.Event(), threading.Event()
+        pipeline._stages[0]._handler = _gated(pipeline._fetch, queued, circuit_opened)
+
+        pipeline.submit(_checkpointed_job("1", model=1))
+        pipeline.submit(_checkpointed_job("outage", model=2))
+        pipeline.submit(_checkpointed_job("3", model=3))
+        pipeline.submit(_job("4"))
+        queued.set()
+        circuit_opened.wait(timeout=5)
+        with pytest.raises(CircuitOpenException):
+            pipeline.submit(_job("5"))
+        pipeline.close()
+
+        assert store == ["1"]
+        assert api.requested == ["1", "outage"]
+        assert [job.reference_table_id for job in pipeline.cancelled_jobs] == [
+            "outage",
+            "3",
+            "4",
+        ]
+        assert pipeline.resume_checkpoint() == {"model": 2}
+        # Nothing to resume from, `repair` picks it up
+        assert [
+            gap.reference_table_id for gap in load_failed_jobs(failed_jobs_file)
+        ] == ["4"]
+
+
+def _checkpointed_job(reference_table_id, model):
+    job = _job(reference_table_id)
+    job.checkpoint = {"model": model}
+    return job
+
+
+def _gated(fetch, queued, circuit_opened):
+    """`fetch` that starts once every job is queued and signals the open circuit."""
+
+    def _fetch(context, job):
+        queued.wait(timeout=5)
+        result = fetch(context, job)
+        if job.reference_table_id == "outage":
+            circuit_opened.set()
+        return result
+
+    return _fetch
+
+
+def test_each_model_year_is_persisted_by_one_worker():
+    store = []
+    pipeline = PricePipeline(
+        FakeFipeApi(),
+        persist_workers=4,
+        storage_mode="changes",
+        repository_factory=lambda: FakeRepository(store),
+    )
+
+    for month in range(10):
+        for model_year_id in ("2019-1", "2020-1", "2021-1"):
+            job = _job(str(month))
+            job.model_year_id = model_year_id
+            pipeline.submit(job)
+    pipeline.close()
+
+    assert len(store) == 30
+    workers = {}
+    for model_year_id, repository in store:
+        workers.setdefault(model_year_id, set()).add(id(repository))
+    assert all(len(repositories) == 1 for repositories in workers.values())
@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from providers.fipe.prefetch import ListingPrefetcher
+
+
+class TestListingPrefetcher:
+    def test_get_reuses_scheduled_call(self):
+        calls = []
+
+        def listing(code):
+            calls.append(code)
+            return f"listing-{code}"
+
+        prefetcher = ListingPrefetcher(window=2)
+        prefetcher.schedule_many(listing, [("1",), ("2",), ("3",)])
+
+        assert prefetcher.get(listing, "1") == "listing-1"
+        assert prefetcher.get(listing, "2") == "listing-2"
+        assert prefetcher.get(listing, "3") == "listing-3"
+        prefetcher.close()
+
+        # "3" was outside of the window, so it was only requested once, inline
+        assert sorted(calls) == ["1", "2", "3"]
+
+    def test_scheduled_exceptions_are_raised_on_get(self):
+        def listing(code):
+            raise ValueError(code)
+
+        prefetcher = ListingPrefetcher(window=1)
+        prefetcher.schedule(listing, "1")
+
+        with pytest.raises(ValueError):
+            prefetcher.get(listing, "1")
+        prefetcher.close()
+
+    def test_zero_window_runs_inline(self):
+        thread_names = []
+
+        def listing():
+            thread_names.append(threading.current_thread().name)
+
+        prefetcher = ListingPrefetcher(window=0)
+        prefetcher.schedule(listing)
+        prefetcher.get(listing)
+        prefetcher.close()
+
+        assert thread_names == [threading.current_thread().name]
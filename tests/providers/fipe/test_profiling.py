@@ -0,0 +1,107 @@
+import json
+import pstats
+import threading
+import time
+
+from providers.fipe.profiling import ProfilingController, SamplingProfiler, StageTimer
+
+
+def _busy_loop(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestStageTimer:
+    def test_disabled_timer_records_nothing(self):
+        timer = StageTimer()
+        with timer.time("fetch.network"):
+            pass
+
+        assert timer.report() == {}
+
+    def test_records_calls_per_stage_slowest_first(self):
+        timer = StageTimer()
+        timer.enabled = True
+        for _ in range(3):
+            with timer.time("parse"):
+                pass
+        with timer.time("persist"):
+            time.sleep(0.01)
+
+        report = timer.report()
+        assert list(report) == ["persist", "parse"]
+        assert report["parse"]["calls"] == 3
+        assert report["persist"]["max_ms"] >= 10
+        assert "persist" in timer.format_report()
+
+    def test_timed_decorator(self):
+        timer = StageTimer()
+
+        @timer.timed("parse.month")
+        def parse(value):
+            return value * 2
+
+        assert parse(2) == 4
+        assert timer.report() == {}
+
+        timer.enabled = True
+        assert parse(3) == 6
+        assert timer.report()["parse.month"]["calls"] == 1
+
+
+def test_sampling_profiler_collapses_stacks_of_other_threads(tmp_path):
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_loop, args=(stop,), name="busy-worker")
+    worker.start()
+
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.1)
+    profiler.stop()
+    stop.set()
+    worker.join()
+
+    path = tmp_path / "profile.collapsed"
+    profiler.write_collapsed(str(path))
+
+    lines = path.read_text().splitlines()
+    assert any(
+        line.startswith("busy-worker;") and ":_busy_loop" in line for line in lines
+    )
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+class TestProfilingController:
+    def test_window_writes_stacks_and_stage_timings(self, tmp_path):
+        timer = StageTimer()
+        controller = ProfilingController(str(tmp_path), seconds=0.05, timer=timer)
+
+        assert controller.start_window()
+        assert not controller.start_window()
+        with timer.time("fetch.network"):
+            pass
+        controller.wait()
+
+        assert not timer.enabled
+        collapsed = list(tmp_path.glob("*.collapsed"))
+        stages = list(tmp_path.glob("*-stages.json"))
+        assert len(collapsed) == 1 and len(stages) == 1
+        assert json.loads(stages[0].read_text())["fetch.network"]["calls"] == 1
+
+    def test_stop_window_ends_it_early(self, tmp_path):
+        controller = ProfilingController(str(tmp_path), seconds=60, timer=StageTimer())
+        controller.start_window()
+
+        _start = time.monotonic()
+        controller.stop_window()
+
+        assert time.monotonic() - _start < 5
+        assert len(list(tmp_path.glob("*.collapsed"))) == 1
+
+    def test_profile_calls_writes_pstats(self, tmp_path):
+        controller = ProfilingController(str(tmp_path), timer=StageTimer())
+        with controller.profile_calls():
+            sum(range(1000))
+
+        (path,) = tmp_path.glob("*.pstats")
+        assert pstats.Stats(str(path)).total_calls > 0
@@ -0,0 +1,250 @@
+import pytest
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.orm import Session
+
+from db import services as db_services
+from db.create_db import create_db
+from db.engine import create_db_engine
+from db.intervals import month_ordinal
+from db.models import all_models as db_models
+from providers.fipe.api import FipeApi
+from providers.fipe import schemas as fipe_schemas
+from providers.fipe.services import FipeDatabaseRepository
+
+MONTHS = ["maio/2024", "junho/2024", "julho/2024", "agosto/2024"]
+
+
+def _car_price(value):
+    return FipeApi.parse_price_response(
+        {
+            "Valor": value,
+            "Marca": "Ford",
+            "Modelo": "Fusion Titanium 2.0 GTDI Eco. Awd Aut.",
+            "AnoModelo": 2019,
+            "Combustivel": "Gasolina",
+            "CodigoFipe": "003376-6",
+            "MesReferencia": "junho de 2024 ",
+            "Autenticacao": "g2bmp6342sc9z",
+            "TipoVeiculo": 1,
+            "SiglaCombustivel": "G",
+            "DataConsulta": "quinta-feira, 27 de junho de 2024 13:24",
+        }
+    )
+
+
+@pytest.fixture
+def engine():
+    _engine = create_engine("sqlite://")
+    create_db(_engine)
+
+    with Session(_engine) as db_session:
+        for index, display_name in enumerate(MONTHS):
+            db_session.add(
+                db_models.ReferenceTable(
+                    fipe_id=str(307 + index),
+                    display_name=display_name,
+                    month=5 + index,
+                    year=2024,
+                )
+            )
+        ford = db_models.Manufacturer(
+            fipe_id="22", display_name="Ford", vehicle_type_id=1
+        )
+        fusion = db_models.CarModel(
+            fipe_id="5940",
+            display_name="Fusion",
+            manufacturer_id="22",
+            manufacturer=ford,
+        )
+        focus = db_models.CarModel(
+            fipe_id="5941",
+            display_name="Focus",
+            manufacturer_id="22",
+            manufacturer=ford,
+        )
+        # Model year codes are only unique within their model
+        for model_id, car_model in (("5940", fusion), ("5941", focus)):
+            db_session.add(
+                db_models.CarModelYear(
+                    fipe_id="2019-1",
+                    model_id=model_id,
+                    car_model=car_model,
+                    display_name="2019 Gasolina",
+                    year=2019,
+                    fuel_type=1,
+                )
+            )
+        db_session.commit()
+
+    return _engine
+
+
+class TestPersistCarPriceChange:
+    def _persist(self, repository, reference_table_id, value):
+        return repository.persist_car_price_change(
+            _car_price(value), "22", "5940", "2019-1", 1, reference_table_id
+        )
+
+    def test_only_changes_are_stored(self, engine):
+        repository = FipeDatabaseRepository(engine)
+
+        assert self._persist(repository, "307", "R$ 100,00")
+        assert self._persist(repository, "308", "R$ 100,00")
+        assert not self._persist(repository, "308", "R$ 100,00")
+        assert self._persist(repository, "310", "R$ 90,00")
+        # Filling the hole with the previous price merges it into the first range
+        assert self._persist(repository, "309", "R$ 100,00")
+
+        with Session(engine) as db_session:
+            intervals = db_session.execute(
+                select(
+                    db_models.CarPriceInterval.valid_from_id,
+                    db_models.CarPriceInterval.valid_to_id,
+                    db_models.CarPriceInterval.value,
+                ).order_by(db_models.CarPriceInterval.valid_from)
+            ).all()
+            series = db_services.list_car_price_series(db_session, "5940", "2019-1")
+
+        assert intervals == [("307", "309", 100.0), ("310", "310", 90.0)]
+        assert [(row["reference_table_id"], row["value"]) for row in series] == [
+            ("307", 100.0),
+            ("308", 100.0),
+            ("309", 100.0),
+            ("310", 90.0),
+        ]
+
+    def test_dense_view(self, engine):
+        repository = FipeDatabaseRepository(engine)
+        self._persist(repository, "307", "R$ 100,00")
+        self._persist(repository, "309", "R$ 100,00")
+        self._persist(repository, "308", "R$ 100,00")
+
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT codigo_tabela_referencia, valor FROM preco_mensal"
+                " ORDER BY codigo_tabela_referencia"
+            ).all()
+
+        assert rows == [("307", 100.0), ("308", 100.0), ("309", 100.0)]
+
+    def test_same_model_year_code_of_another_model(self, engine):
+        repository = FipeDatabaseRepository(engine)
+        self._persist(repository, "307", "R$ 100,00")
+        repository.persist_car_price_change(
+            _car_price("R$ 80,00"), "22", "5941", "2019-1", 1, "307"
+        )
+
+        with Session(engine) as db_session:
+            fusion = db_services.list_car_price_series(db_session, "5940", "2019-1")
+            focus = db_services.list_car_price_series(db_session, "5941", "2019-1")
+
+        assert [row["value"] for row in fusion] == [100.0]
+        assert [row["value"] for row in focus] == [80.0]
+
+    def test_split_next_to_a_month_fipe_skipped(self, engine):
+        repository = FipeDatabaseRepository(engine)
+        with Session(engine) as db_session:
+            db_session.execute(
+                delete(db_models.ReferenceTable).where(
+                    db_models.ReferenceTable.fipe_id == "309"
+                )
+            )
+            db_session.add(
+                db_models.CarPriceInterval(
+                    model_year_key=1,
+                    manufacturer_id="22",
+                    model_id="5940",
+                    model_year_id="2019-1",
+                    vehicle_type_id=1,
+                    fipe_vehicle_code="003376-6",
+                    value=100.0,
+                    valid_from_id="307",
+                    valid_to_id="310",
+                    valid_from=month_ordinal(2024, 5),
+                    valid_to=month_ordinal(2024, 8),
+                )
+            )
+            db_session.commit()
+
+        assert self._persist(repository, "308", "R$ 90,00")
+
+        with Session(engine) as db_session:
+            intervals = db_session.execute(
+                select(
+                    db_models.CarPriceInterval.valid_from_id,
+                    db_models.CarPriceInterval.valid_to_id,
+                    db_models.CarPriceInterval.value,
+                ).order_by(db_models.CarPriceInterval.valid_from)
+            ).all()
+
+        assert intervals == [
+            ("307", "307", 100.0),
+            ("308", "308", 90.0),
+            ("310", "310", 100.0),
+        ]
+
+    def test_unknown_model_year(self, engine):
+        repository = FipeDatabaseRepository(engine)
+
+        with pytest.raises(KeyError):
+            repository.persist_car_price_change(
+                _car_price("R$ 80,00"), "22", "5942", "2019-1", 1, "307"
+            )
+
+
+def test_catalog_and_price_upserts_on_sqlite():
+    engine = create_db_engine("sqlite://")
+    create_db(engine)
+    repository = FipeDatabaseRepository(engine)
+
+    with Session(engine) as db_session:
+        db_session.add(
+            db_models.ReferenceTable(
+                fipe_id="308", display_name="junho/2024", month=6, year=2024
+            )
+        )
+        db_session.commit()
+
+    for _ in range(2):
+        repository.persist_manufacturers(
+            fipe_schemas.FipeApiManufacturersResponseSchema(
+                manufacturers=[{"Value": "22", "Label": "Ford"}]
+            ),
+            1,
+        )
+        repository.persist_car_models(
+            fipe_schemas.FipeApiCarModelsResponseSchema(
+                car_models=[
+                    {"Value": 5940, "Label": "Fusion"},
+                    {"Value": 5941, "Label": "Focus"},
+                ]
+            ),
+            "22",
+        )
+        for model_id in ("5940", "5941"):
+            repository.persist_car_model_years(
+                fipe_schemas.FipeApiCarModelYearsResponseSchema(
+                    car_model_years=[{"Value": "2019-1", "Label": "2019 Gasolina"}]
+                ),
+                "22",
+                model_id,
+            )
+
+    repository.persist_car_price(
+        _car_price("R$ 100,00"), "22", "5940", "2019-1", 1, "308"
+    )
+    repository.persist_car_price(
+        _car_price("R$ 90,00"), "22", "5940", "2019-1", 1, "308"
+    )
+
+    with Session(engine) as db_session:
+        model_years = db_session.scalars(select(db_models.CarModelYear)).all()
+        prices = db_session.execute(
+            select(db_models.CarPrice.model_id, db_models.CarPrice.value)
+        ).all()
+
+    assert [(row.model_id, row.fipe_id) for row in model_years] == [
+        ("5940", "2019-1"),
+        ("5941", "2019-1"),
+    ]
+    assert prices == [("5940", 90.0)]
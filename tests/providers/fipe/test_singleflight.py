@@ -0,0 +1,46 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from providers.fipe.singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_execution(self):
+        single_flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            release.wait(timeout=5)
+            return "response"
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(single_flight.do, "/ConsultarMarcas", fetch)
+                for _ in range(8)
+            ]
+            # Give every waiter the chance to join the in-flight call
+            while single_flight.in_flight() == 0:
+                time.sleep(0.001)
+            time.sleep(0.05)
+            release.set()
+
+            assert [f.result() for f in futures] == ["response"] * 8
+
+        assert len(calls) == 1
+        assert single_flight.in_flight() == 0
+
+    def test_exceptions_are_shared_and_key_is_released(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError("erro")
+
+        with pytest.raises(ValueError):
+            single_flight.do("key", fail)
+
+        assert single_flight.do("key", lambda: "ok") == "ok"
@@ -0,0 +1,210 @@
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from db import readers as db_readers
+from db.create_db import create_db
+from db.models import all_models as db_models
+from providers.fipe import schemas as fipe_schemas
+from providers.fipe import services as fipe_services
+from providers.fipe.exceptions import CircuitOpenException, FipeApiRequestException
+from providers.fipe.watcher import (
+    MAX_CRAWL_ATTEMPTS,
+    ReferenceTableWatcher,
+    freshness,
+    load_watch_state,
+)
+
+MONTHS = {"maio": 5, "junho": 6, "julho": 7}
+
+
+class FakeApi:
+    def __init__(self, reference_tables):
+        self.reference_tables = reference_tables
+
+    def get_reference_tables(self, cache_expire=None):
+        if isinstance(self.reference_tables, Exception):
+            raise self.reference_tables
+
+        return fipe_schemas.FipeApiReferenceTablesResponseSchema(
+            reference_tables=[
+                {"Codigo": code, "Mes": display_name}
+                for code, display_name in self.reference_tables
+            ]
+        )
+
+
+class FakeCrawler:
+    def __init__(self, crawled, checkpoint, error=None, failed_prices=0):
+        self.crawled = crawled
+        self.checkpoint = checkpoint
+        self.error = error
+        self.failed_prices = failed_prices
+        self.cancelled_prices = 0
+
+    def populate_prices_for_reference_table(self, reference_table_id, vehicle_type_id):
+        if self.error is not None:
+            self.checkpoint["manufacturer"] = 21
+            raise self.error
+        self.crawled.append((reference_table_id, dict(self.checkpoint)))
+
+    def get_checkpoint(self):
+        return self.checkpoint
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def month_names(monkeypatch):
+    # The pt_BR locale is not installed everywhere
+    monkeypatch.setattr(
+        fipe_services, "convert_month_str_to_int", lambda month: MONTHS[month.strip()]
+    )
+
+
+@pytest.fixture
+def engine():
+    _engine = create_engine("sqlite://")
+    create_db(_engine)
+
+    with Session(_engine) as db_session:
+        db_session.add(
+            db_models.ReferenceTable(
+                fipe_id="307", display_name="maio/2024", month=5, year=2024
+            )
+        )
+        db_session.commit()
+
+    return _engine
+
+
+def _watcher(engine, tmp_path, api, crawled, error=None):
+    return ReferenceTableWatcher(
+        engine,
+        lambda checkpoint: FakeCrawler(crawled, checkpoint, error),
+        fipe_api=api,
+        state_file=str(tmp_path / "watch_state.json"),
+    )
+
+
+def test_new_month_is_stored_and_crawled_once(engine, tmp_path):
+    crawled = []
+    api = FakeApi([("308", "junho/2024 "), ("307", "maio/2024 ")])
+    watcher = _watcher(engine, tmp_path, api, crawled)
+
+    assert watcher.poll() == ["308"]
+    assert watcher.crawl_pending() == ["308"]
+    assert watcher.poll() == []
+    assert watcher.crawl_pending() == []
+
+    with engine.connect() as conn:
+        assert [row.fipe_id for row in db_readers.read_reference_tables(conn)] == [
+            "307",
+            "308",
+        ]
+    assert crawled == [("308", {})]
+
+    summary = freshness(load_watch_state(watcher.state_file))
+    assert summary["latest_reference_table_id"] == "308"
+    assert summary["latest_crawled_reference_table_id"] == "308"
+    assert summary["pending"] == []
+    assert summary["publication_to_stored_s"] >= 0
+
+
+def test_interrupted_crawl_resumes_from_its_checkpoint(engine, tmp_path):
+    api = FakeApi([("308", "junho/2024 ")])
+    watcher = _watcher(engine, tmp_path, api, [], error=KeyboardInterrupt())
+    watcher.poll()
+
+    with pytest.raises(KeyboardInterrupt):
+        watcher.crawl_pending()
+
+    crawled = []
+    restarted = _watcher(engine, tmp_path, api, crawled)
+    assert restarted.crawl_pending() == ["308"]
+    assert crawled == [("308", {"manufacturer": 21})]
+
+
+def test_open_circuit_postpones_the_crawl(engine, tmp_path):
+    api = FakeApi([("308", "junho/2024 ")])
+    watcher = _watcher(engine, tmp_path, api, [], error=CircuitOpenException("open"))
+    watcher.poll()
+
+    assert watcher.crawl_pending() == []
+    assert watcher.state["pending"] == ["308"]
+
+
+def test_failed_poll_is_counted(engine, tmp_path):
+    watcher = _watcher(engine, tmp_path, FakeApi(FipeApiRequestException("down")), [])
+
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+    assert freshness(watcher.state)["consecutive_poll_failures"] == 2
+    assert freshness(watcher.state)["seconds_since_poll"] is None
+
+
+def test_on_crawled_failure_does_not_stop_the_watcher(engine, tmp_path):
+    notified = []
+
+    def on_crawled(reference_table_id):
+        notified.append(reference_table_id)
+        raise OSError("disk full")
+
+    watcher = ReferenceTableWatcher(
+        engine,
+        lambda checkpoint: FakeCrawler([], checkpoint),
+        fipe_api=FakeApi([("308", "junho/2024 ")]),
+        state_file=str(tmp_path / "watch_state.json"),
+        on_crawled=on_crawled,
+    )
+    watcher.poll()
+
+    assert watcher.crawl_pending() == ["308"]
+    assert notified == ["308"]
+    assert watcher.state["pending"] == []
+
+
+def test_month_with_failed_prices_stays_pending(engine, tmp_path):
+    crawled = []
+    watcher = ReferenceTableWatcher(
+        engine,
+        lambda checkpoint: FakeCrawler(crawled, checkpoint, failed_prices=2),
+        fipe_api=FakeApi([("308", "junho/2024 ")]),
+        state_file=str(tmp_path / "watch_state.json"),
+    )
+    watcher.poll()
+
+    assert watcher.crawl_pending() == []
+    assert watcher.state["pending"] == ["308"]
+    assert freshness(watcher.state).get("latest_crawled_reference_table_id") is None
+
+    # Left to `repair` after the last attempt
+    for _ in range(MAX_CRAWL_ATTEMPTS - 2):
+        watcher.crawl_pending()
+    assert watcher.crawl_pending() == ["308"]
+    assert len(crawled) == MAX_CRAWL_ATTEMPTS
+
+    summary = freshness(watcher.state)
+    assert summary["failed_prices"] == 2
+    assert summary["publication_to_stored_s"] is None
+
+
+def test_watch_state_is_read_without_the_crawler():
+    # `main.py status` must not pay for SQLAlchemy, requests and the crawler
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, providers.fipe.watch_state; "
+            "print(sorted({'sqlalchemy', 'requests'} & set(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"